@@ -1,10 +1,19 @@
 # -*- coding: utf-8 -*-
-import json
+import copy
 import datetime
+import re
 import settings
 import pickle
+import time
+from concurrent.futures import ThreadPoolExecutor
 
+from bson import Binary, ObjectId, _datetime_to_millis, _millis_to_datetime
+from bson.codec_options import DEFAULT_CODEC_OPTIONS
 from mongoengine.context_managers import switch_collection
+from mongoengine.queryset.visitor import Q
+from mongoengine.document import includes_cls
+from pymongo import InsertOne, ReplaceOne, UpdateOne
+from pymongo.errors import BulkWriteError, OperationFailure
 from mongoengine import (
     DateTimeField,
     Document,
@@ -14,7 +23,13 @@ from mongoengine import (
     BinaryField,
     ObjectIdField
 )
-from commons import logging
+from caches.document_cache import get_documents, invalidate_document, invalidate_documents
+from caches.query_cache import CachedQuerySet, invalidate_collection
+from commons import history_codec, logging
+from commons.history_archive import HistoryArchive
+from commons.history_writer import HistoryQueue
+from commons.pagination import InvalidCursor
+from commons.query_translator import get_translator
 from typing import (
     Any,
     Dict,
@@ -46,22 +61,141 @@ class BaseDocument(Document):
         获取字段映射关系
         :return:
         """
-        return getattr(self, '__mappings')
+        return self.get_field_mappings()
 
-    def get_db_field(self, clazz_field):
+    @classmethod
+    def get_field_mappings(cls):
+        """
+        获取字段映射关系(类字段名 -> 字段)
+        :return:
+        """
+        return getattr(cls, '__mappings', None) or cls._fields
+
+    @classmethod
+    def get_translator(cls):
+        """
+        获取查询字段映射器， 首次使用时创建
+        :return: commons.query_translator.FieldTranslator
+        """
+        return get_translator(cls)
+
+    @classmethod
+    def get_db_field(cls, clazz_field):
         """
         依据类字段名获取数据库字段
-        :param clazz_field: 类字段名
+        :param clazz_field: 类字段名， 支持 a.b 形式的嵌套字段(嵌入文档、列表、MapField)
         :return:
         """
         if isinstance(clazz_field, str):
-            if clazz_field == 'id':
-                return '_id'
-            ft = self.field_mappings.get(clazz_field)
-            if ft and ft.db_field:
-                return ft.db_field
+            return get_translator(cls).db_path(clazz_field)
         return clazz_field
 
+    @classmethod
+    def map_db_filter(cls, filtered):
+        """
+        映射查询条件中的类字段名为数据库字段， 返回新的查询条件， 支持 $and/$or/$nor 及 $elemMatch
+        :param filtered: 查询条件
+        :return:
+        """
+        return get_translator(cls).filter(filtered)
+
+    @classmethod
+    def map_db_sort(cls, sort):
+        """
+        映射排序中的类字段名为数据库字段
+        :param sort: '-created_time'、 ['-created_time', 'name'] 或 [('created_time', -1)]
+        :return: [(数据库字段, 1/-1)]
+        """
+        return get_translator(cls).sort(sort)
+
+    @classmethod
+    def map_db_projection(cls, projection):
+        """
+        映射投影中的类字段名为数据库字段
+        :param projection: 字段名列表或 {字段名: 0/1}
+        :return: dict
+        """
+        return get_translator(cls).projection(projection)
+
+    @classmethod
+    def async_objects(cls, as_dict=False, with_deleted=False):
+        """
+        获取异步数据访问对象
+        :param as_dict: True 返回dict(数据库字段)， False 返回文档对象
+        :param with_deleted: 是否包含已删除(is_delete=True)的文档
+        :return: AsyncCollection
+        """
+        from commons.mongo_async import AsyncCollection
+        return AsyncCollection(cls, as_dict, with_deleted)
+
+    @classmethod
+    async def export_rows(cls, filtered=None, fields=None, sort=None, batch_size=settings.OPT_ASYNC_BATCH_SIZE,
+                          with_deleted=False):
+        """
+        以服务端游标按批读取原始文档， 内存占用与集合大小无关
+        :param filtered: 查询条件(类字段名)
+        :param fields: 导出的类字段名列表， None：全部
+        :param sort: 排序
+        :param batch_size: 每批读取数量
+        :param with_deleted: 是否包含已删除(is_delete=True)的文档
+        :return: 异步迭代器， 元素为dict(数据库字段， _id 改为 id)
+        """
+        collection = cls.async_objects(as_dict=True, with_deleted=with_deleted)
+        async for son in collection.iterate(filtered, fields, sort, batch_size=batch_size):
+            son['id'] = son.pop('_id', None)
+            yield son
+
+    @classmethod
+    def export_response(cls, fmt='ndjson', filtered=None, fields=None, sort=None, filename=None,
+                        batch_size=settings.OPT_ASYNC_BATCH_SIZE, with_deleted=False, bom=False):
+        """
+        流式导出为NDJSON或CSV， ObjectId/datetime 的转换规则与 FrontendJsonEncoder 一致
+        :param fmt: ndjson|csv
+        :param filtered: 查询条件(类字段名)
+        :param fields: 导出的类字段名列表， None：全部； CSV按该顺序输出列
+        :param sort: 排序
+        :param filename: 下载文件名， None：不作为附件
+        :param batch_size: 每批读取数量
+        :param with_deleted: 是否包含已删除的文档
+        :param bom: CSV是否输出UTF-8 BOM(Excel打开时正确识别编码)
+        :return: StreamingResponse
+        """
+        from commons.stream_utils import attachment_headers, csv_response, ndjson_response
+        headers = attachment_headers(filename) if filename else None
+        # 父字段已导出时投影中不再包含子字段(路径冲突)
+        projection = [name for name in fields if name.partition('.')[0] == name
+                      or name.partition('.')[0] not in fields] if fields else None
+        rows = cls.export_rows(filtered, projection, sort, batch_size, with_deleted)
+        if fmt == 'csv':
+            names = fields or ['id'] + [name for name in cls._fields if name != 'id']
+            columns = [(name, 'id' if name in ('id', 'pk') else cls.get_db_field(name)) for name in names]
+            return csv_response(rows, columns, bom=bom, headers=headers)
+        return ndjson_response(rows, headers=headers)
+
+    @classmethod
+    def get_by_id(cls, oid, with_deleted=False):
+        """
+        按ID读取文档， 依次读取请求级标识映射、Redis缓存及数据库
+        :param oid: 文档ID
+        :param with_deleted: 是否包含已删除(is_delete=True)的文档
+        :return: 文档， 不存在或已删除时返回None
+        """
+        return cls.get_many_by_ids([oid], with_deleted)[0]
+
+    @classmethod
+    def get_many_by_ids(cls, ids, with_deleted=False):
+        """
+        按ID批量读取文档， 缓存未命中的ID以一次 $in 查询读取
+        缓存中包含已删除的文档， 与 SoftDeleteQuerySet 一致， 读取后再排除
+        :param ids: 文档ID列表
+        :param with_deleted: 是否包含已删除(is_delete=True)的文档
+        :return: 与ids顺序一致的文档列表， 不存在或已删除的为None
+        """
+        docs = get_documents(cls, list(ids))
+        if with_deleted or not cls._meta.get('soft_delete', True) or 'is_delete' not in cls._fields:
+            return docs
+        return [None if doc is not None and doc.is_delete else doc for doc in docs]
+
     def map_filter_2_field(self, filtered):
         """
         映射查询字段为数据库字段
@@ -69,19 +203,59 @@ class BaseDocument(Document):
         :return:
         """
         if isinstance(filtered, dict):
-            rf_list = []
-            for k, v in filtered.items():
-                db_field = self.get_db_field(k)
-                if not db_field == k:
-                    rf_list.append((k, db_field))
-            if rf_list:
-                for t in rf_list:
-                    filtered[t[1]] = filtered.pop(t[0])
+            mapped = self.map_db_filter(filtered)
+            filtered.clear()
+            filtered.update(mapped)
         return filtered
 
 
+# 已存在同名或同键但选项不同的索引
+_INDEX_CONFLICT_CODES = (85, 86)
+
+
+class SoftDeleteQuerySet(CachedQuerySet):
+    """
+    默认排除已删除(is_delete=True)文档的查询集， with_deleted() 包含已删除文档。
+    查询条件中已包含顶层 is_delete 条件时不再附加
+    """
+
+    _with_deleted = False
+
+    def _soft_delete_field(self):
+        if self._with_deleted or not self._document._meta.get('soft_delete', True):
+            return None
+        field = self._document._fields.get('is_delete')
+        return field.db_field if field else None
+
+    @property
+    def _query(self):
+        if self._mongo_query is None:
+            query = super(SoftDeleteQuerySet, self)._query
+            db_field = self._soft_delete_field()
+            if db_field and db_field not in query:
+                query[db_field] = False
+        return self._mongo_query
+
+    def _clone_into(self, new_qs):
+        new_qs = super(SoftDeleteQuerySet, self)._clone_into(new_qs)
+        new_qs._with_deleted = self._with_deleted
+        return new_qs
+
+    def with_deleted(self):
+        """
+        包含已删除的文档
+        :return: 新的查询集
+        """
+        queryset = self.clone()
+        queryset._with_deleted = True
+        queryset._mongo_query = None
+        return queryset
+
+
 class ModelBase(BaseDocument):
-    meta = {'abstract': True}
+    # 'distributed_cache': True 开启查询结果及按ID读取的分布式缓存(需同时启用 OPT_DISTRIBUTED_CACHED_ENABLE)
+    # 'soft_delete': False 查询及按ID读取时不排除已删除文档， 声明的索引不附加 partialFilterExpression
+    meta = {'abstract': True, 'queryset_class': SoftDeleteQuerySet}
 
     created_time = DateTimeField(default=datetime.datetime.now)
     creater_id = ObjectIdField()
@@ -93,13 +267,91 @@ class ModelBase(BaseDocument):
     def oid(self):
         return str(self.id)
 
+    @classmethod
+    def ensure_indexes(cls, background=None):
+        """
+        创建声明的索引， 非唯一、非稀疏且未指定 partialFilterExpression 的索引只包含未删除的文档
+        (partialFilterExpression: {is_delete: False})； 已存在选项不同的同名索引时记录日志并跳过，
+        删除旧索引后重新创建。
+        查询条件包含 is_delete: False 时才能使用这些部分索引： SoftDeleteQuerySet 及 async_objects 默认附加该条件，
+        with_deleted 的查询、聚合管道及直接使用 pymongo 的查询需自行附加， 否则无法使用
+        :param background: 是否以 background 方式创建， None：使用 meta['index_background']
+        :return:
+        """
+        if background is None:
+            background = cls._meta.get('index_background', False)
+        index_opts = dict(cls._meta.get('index_opts') or {})
+        index_cls = cls._meta.get('index_cls', True)
+        soft_delete = cls._meta.get('soft_delete', True)
+
+        collection = cls._get_collection()
+        if not collection.is_mongos and collection.read_preference > 1:
+            return
+
+        def _create(fields, opts):
+            try:
+                collection.create_index(fields, **opts)
+            except OperationFailure as e:
+                if e.code not in _INDEX_CONFLICT_CODES:
+                    raise
+                logger.error('[%s][index]%s' % (collection.name, e))
+
+        cls_indexed = False
+        for spec in cls._meta['index_specs'] or []:
+            spec = spec.copy()
+            fields = spec.pop('fields')
+            cls_indexed = cls_indexed or includes_cls(fields)
+            opts = dict(index_opts, background=background)
+            opts.update(spec)
+            opts.pop('cls', None)
+            if soft_delete and not (opts.get('unique') or opts.get('sparse') or 'partialFilterExpression' in opts):
+                opts['partialFilterExpression'] = {cls._fields['is_delete'].db_field: False}
+            _create(fields, opts)
+
+        if index_cls and not cls_indexed and cls._meta.get('allow_inheritance'):
+            index_opts.pop('cls', None)
+            _create('_cls', dict(index_opts, background=background))
+
     def to_dict(self):
-        from commons.common_utils import model_object_hook
-        d = json.loads(self.to_json(), object_hook=model_object_hook)
+        from commons.common_utils import son_to_dict
+        d = son_to_dict(self.to_mongo())
         d['id'] = self.oid
         d.pop('_id')
         return ObjectDict(d)
 
+    @classmethod
+    def paginate(cls, queryset=None, limit=settings.PAGINATION_DEFAULT_LIMIT, cursor=None, sort=None,
+                 with_total=False):
+        """
+        键集分页， 参考 commons.pagination.paginate
+        :param queryset: 查询集， 默认 cls.objects
+        :param limit: 每页数量
+        :param cursor: 上一次返回的 next_cursor 或 prev_cursor， None 时为第一页
+        :param sort: 排序， 默认 ('created_time', 'id')
+        :param with_total: 是否返回(估算)总数
+        :return: KeysetPage
+        """
+        from commons.pagination import paginate
+        return paginate(cls.objects if queryset is None else queryset, limit, cursor, sort, with_total)
+
+    @classmethod
+    def to_dicts(cls, queryset=None):
+        """
+        批量转换为dict， 直接读取原始文档(as_pymongo)， 不构建文档对象；
+        与 to_dict 不同， 数据库中缺失的字段不会以默认值补全
+        :param queryset: 查询集， 默认 cls.objects
+        :return:
+        """
+        from commons.common_utils import son_to_dict
+        if queryset is None:
+            queryset = cls.objects
+        result = []
+        for son in queryset.as_pymongo():
+            d = son_to_dict(son)
+            d['id'] = d.pop('_id')
+            result.append(ObjectDict(d))
+        return result
+
     def __unicode__(self):
         try:
             return self.name
@@ -126,7 +378,12 @@ class ModelBase(BaseDocument):
             # create
             self.created_time = datetime.datetime.now()
             self.creater_id = executer.id
-            self.save()
+            if isinstance(self._fields[self._meta['id_field']], ObjectIdField):
+                # 预先生成ID供历史记录使用， 由 my_save 一次插入(设置ID会清除 _created 标记)
+                self.id = ObjectId()
+                self._created = True
+            else:
+                self.save()
             return False
         else:
             # update
@@ -135,8 +392,10 @@ class ModelBase(BaseDocument):
             return True
 
     def my_save(self, executer, is_update=None):
+        force_insert = False
         if is_update is None:
             is_update = self._is_update(executer)
+            force_insert = not is_update and self._created
 
         self.pro_save(is_update)
 
@@ -144,9 +403,79 @@ class ModelBase(BaseDocument):
         if isinstance(self, HistoryBase):
             self.save_history(executer, is_update)
 
-        super(ModelBase, self).save()
+        super(ModelBase, self).save(force_insert=force_insert)
+        invalidate_collection(self._get_collection_name())
+        invalidate_document(self)
         self.after_save()
 
+    @classmethod
+    def bulk_save(cls, docs, executer, chunk_size=settings.OPT_BULK_WRITE_CHUNK_SIZE):
+        """
+        批量保存， 新建的文档 insert， 已存在的文档 $set/$unset 修改的字段， 每 chunk_size 个文档一次 bulk_write(ordered=False)
+        依次执行 pro_save、批量写入、写入成功的文档的历史记录、after_save； 不触发 mongoengine 的 save 信号
+        写入失败(BulkWriteError 等)时仍删除缓存并写入已成功文档的历史记录， 失败的文档保留修改及原版本号， 然后抛出异常
+        :param docs: 文档列表
+        :param executer: 操作人
+        :param chunk_size: 每批数量
+        :return: 文档列表
+        """
+        docs = list(docs)
+        if not docs:
+            return docs
+        is_updates = [doc._is_update(executer) for doc in docs]
+        for doc, is_update in zip(docs, is_updates):
+            doc.pro_save(is_update)
+            doc.validate()
+
+        histories = cls._prepare_histories(docs, executer, is_updates) if issubclass(cls, HistoryBase) else None
+
+        requests, owners = [], []
+        for index, (doc, is_update) in enumerate(zip(docs, is_updates)):
+            son = doc.to_mongo()
+            if not is_update:
+                requests.append(InsertOne(son))
+            elif doc._created:
+                # 指定了ID的新对象， 与 save 一致整体替换
+                requests.append(ReplaceOne({'_id': son['_id']}, son, upsert=True))
+            else:
+                update_doc = doc._get_update_doc()
+                if not update_doc:
+                    continue
+                requests.append(UpdateOne({'_id': son['_id']}, update_doc, upsert=True))
+            owners.append(index)
+
+        # 未确认写入成功的文档下标， 写入完成的批次中移除成功的文档
+        failed = set(owners)
+        try:
+            if requests:
+                collection = cls._get_collection()
+                chunk_size = chunk_size or len(requests)
+                for i in range(0, len(requests), chunk_size):
+                    chunk = owners[i:i + chunk_size]
+                    try:
+                        collection.bulk_write(requests[i:i + chunk_size], ordered=False)
+                        failed.difference_update(chunk)
+                    except BulkWriteError as e:
+                        errors = {chunk[error['index']] for error in e.details.get('writeErrors', [])}
+                        failed.difference_update(set(chunk) - errors)
+                        raise
+        finally:
+            for index, doc in enumerate(docs):
+                if index not in failed:
+                    doc._clear_changed_fields()
+                    doc._created = False
+                elif histories is not None:
+                    # 未写入的文档回退版本号， 重新保存时使用相同的版本号
+                    doc.history_seq -= 1
+            invalidate_collection(cls._get_collection_name())
+            invalidate_documents(docs)
+            if histories is not None:
+                cls._put_histories(history for index, history in enumerate(histories) if index not in failed)
+
+        for doc in docs:
+            doc.after_save()
+        return docs
+
     def after_save(self):
         pass
 
@@ -170,6 +499,10 @@ class History(BaseDocument):
     #   2: tail of history chain, mostly this means delete an instance
     p_id = IntField()
     ip = StringField()
+    # value format, see commons.history_codec; None means pickle
+    fmt = IntField()
+    # version number of the instance, increase by 1 on every save
+    seq = IntField()
 
     meta = {'db_alias': settings.DB_NAME_HIS}
 
@@ -180,6 +513,292 @@ history_position = {
     'tail': 2,  # mostly this means delete an instance
 }
 
+# 本进程已创建索引的历史记录集合
+_history_indexed = set()
+
+
+def ensure_history_indexes(cn):
+    """
+    为历史记录集合创建 (ref_id, time, _id) 索引及 (ref_id, seq) 唯一索引， 每个进程每个集合只执行一次
+    (ref_id, seq) 唯一索引只包含有版本号的记录， 多个进程基于同一版本保存时后写入的记录由 rebase_history 改为快照
+    :param cn: 历史记录集合名
+    :return:
+    """
+    if cn in _history_indexed:
+        return
+    try:
+        collection = History._get_db()[cn]
+        collection.create_index([('ref_id', 1), ('time', -1), ('_id', -1)], background=True)
+        _ensure_seq_index(collection)
+        _history_indexed.add(cn)
+    except Exception as e:
+        logger.error('[%s][index]%s' % (cn, e))
+
+
+def _ensure_seq_index(collection):
+    keys = [('ref_id', 1), ('seq', 1)]
+    options = {'unique': True, 'partialFilterExpression': {'seq': {'$exists': True}}, 'background': True}
+    try:
+        collection.create_index(keys, **options)
+    except OperationFailure as e:
+        # IndexOptionsConflict/IndexKeySpecsConflict: 旧版本创建的非唯一索引
+        if e.code not in (85, 86):
+            raise
+        collection.drop_index(keys)
+        try:
+            collection.create_index(keys, **options)
+        except OperationFailure:
+            # 已有重复的版本号， 保留非唯一索引
+            collection.create_index(keys, background=True)
+            raise
+
+
+def history_base_name(cn):
+    """
+    历史记录集合对应的基础集合名
+    :param cn: 历史记录集合名(分区或基础集合)
+    :return:
+    """
+    if settings.HISTORY_PARTITION_BY_MONTH and re.match(r'^.+_\d{6}$', cn):
+        return cn[:-7]
+    return cn
+
+
+# 历史记录分区列表缓存 {基础集合名: (过期时间, 分区列表)}
+_history_partitions = {}
+_history_executor = None
+
+
+def history_partition_name(base, when):
+    """
+    历史记录分区集合名
+    :param base: 基础集合名 history_<cname>
+    :param when: 记录时间
+    :return: <base>_<yyyymm>
+    """
+    return '%s_%s' % (base, when.strftime('%Y%m'))
+
+
+def list_history_partitions(base, refresh=False):
+    """
+    历史记录分区列表， 由新到旧， 未分区前的基础集合排在最后
+    :param base: 基础集合名
+    :param refresh: 是否忽略本地缓存
+    :return:
+    """
+    if not settings.HISTORY_PARTITION_BY_MONTH:
+        return [base]
+    cached = _history_partitions.get(base)
+    if cached and not refresh and cached[0] > time.time():
+        return cached[1]
+    names = {history_partition_name(base, datetime.datetime.now())}
+    try:
+        pattern = re.compile(r'^%s_\d{6}$' % re.escape(base))
+        names.update(name for name in History._get_db().list_collection_names() if pattern.match(name))
+    except Exception as e:
+        logger.error('[%s][partition]%s' % (base, e))
+    result = sorted(names, reverse=True) + [base]
+    _history_partitions[base] = (time.time() + settings.HISTORY_PARTITION_CACHE_TTL, result)
+    return result
+
+
+def _partition_in_range(base, cn, since, until):
+    """
+    分区月份是否与 [since, until] 有交集， 基础集合不限
+    """
+    if cn == base:
+        return True
+    month = cn[len(base) + 1:]
+    if since and month < since.strftime('%Y%m'):
+        return False
+    if until and month > until.strftime('%Y%m'):
+        return False
+    return True
+
+
+def _find_histories(cn, query, projection, sort, limit):
+    return [History._from_son(son) for son in
+            History._get_db()[cn].find(query, projection, sort=sort, limit=limit)]
+
+
+def find_histories(base, query, projection=None, sort=None, limit=0, since=None, until=None):
+    """
+    按分区由新到旧(升序排序时由旧到新)每次并发查询 HISTORY_PARTITION_FANOUT 个分区，
+    累计达到 limit 条后不再查询更早的分区。分区按时间划分， 结果依次拼接即为有序结果
+    :param base: 基础集合名
+    :param query: 查询条件(数据库字段)
+    :param projection: 投影
+    :param sort: 排序， 默认按时间倒序
+    :param limit: 限制数量， 0：不限
+    :param since: 记录时间下限， 用于跳过更早的分区
+    :param until: 记录时间上限， 用于跳过更晚的分区
+    :return: History 列表
+    """
+    global _history_executor
+    sort = sort or [('time', -1), ('_id', -1)]
+    names = [cn for cn in list_history_partitions(base) if _partition_in_range(base, cn, since, until)]
+    if sort[0][1] == 1:
+        names.reverse()
+    fanout = max(settings.HISTORY_PARTITION_FANOUT, 1)
+    result = []
+    for i in range(0, len(names), fanout):
+        wave = names[i:i + fanout]
+        remain = limit - len(result) if limit else 0
+        if len(wave) == 1:
+            rows = [_find_histories(wave[0], query, projection, sort, remain)]
+        else:
+            if _history_executor is None:
+                _history_executor = ThreadPoolExecutor(max_workers=fanout)
+            rows = list(_history_executor.map(
+                lambda cn: _find_histories(cn, query, projection, sort, remain), wave))
+        for histories in rows:
+            result.extend(histories)
+        if limit and len(result) >= limit:
+            return result[:limit]
+    return result
+
+
+def replay_histories(chain, wanted):
+    """
+    按版本号依次应用增量还原文档
+    版本号缺失或重复时该版本及之后的增量无法还原， 直到下一个(版本号不重复的)快照
+    :param chain: 按版本号升序排列的历史记录
+    :param wanted: 需要还原的版本号集合
+    :return: {版本号: 文档(dict)}
+    """
+    counts = {}
+    for h in chain:
+        counts[h.seq] = counts.get(h.seq, 0) + 1
+    states = {}
+    state, expected = None, None
+    for h in chain:
+        if counts[h.seq] > 1:
+            state = None
+        elif h.fmt == history_codec.FORMAT_SNAPSHOT:
+            state = history_codec.decode_snapshot(h.value)
+        elif state is not None and h.seq == expected:
+            state = history_codec.apply_delta(state, *history_codec.decode_delta(h.value))
+        else:
+            state = None
+        expected = h.seq + 1
+        if state is not None and h.seq in wanted:
+            states[h.seq] = copy.deepcopy(state)
+    return states
+
+
+def load_history_states(base, ref_id, wanted, earliest, latest):
+    """
+    还原文档的指定版本， 从不晚于最早版本的最近快照开始依次应用增量
+    :param base: 基础集合名
+    :param ref_id: 文档ID
+    :param wanted: 版本号集合
+    :param earliest: 最早版本的记录时间
+    :param latest: 最晚版本的记录时间
+    :return: {版本号: 文档(dict)}
+    """
+    ensure_history_indexes(base)
+    bases = find_histories(base, {'ref_id': ref_id, 'fmt': history_codec.FORMAT_SNAPSHOT,
+                                  'seq': {'$lte': min(wanted)}, 'time': {'$lte': earliest}},
+                           sort=[('seq', -1)], limit=1, until=earliest)
+    if not bases:
+        return _load_archived_states(base, ref_id, wanted, latest)
+    chain = find_histories(base, {'ref_id': ref_id, 'seq': {'$gte': bases[0].seq, '$lte': max(wanted)},
+                                  'time': {'$gte': bases[0].time, '$lte': latest}},
+                           sort=[('seq', 1), ('time', 1)], since=bases[0].time, until=latest)
+    return replay_histories(chain, wanted)
+
+
+def _load_archived_states(base, ref_id, wanted, latest):
+    """
+    最近快照所在分区已归档到冷数据集合时， 由冷数据集合及分区中的记录还原(归档为文件时无法还原)
+    :param base: 基础集合名
+    :param ref_id: 文档ID
+    :param wanted: 版本号集合
+    :param latest: 最晚版本的记录时间
+    :return: {版本号: 文档(dict)}
+    """
+    if not settings.HISTORY_PARTITION_BY_MONTH or HistoryArchive.mode != 'collection':
+        return {}
+    top = max(wanted)
+    chain = {}
+    for row in HistoryArchive.load_archived(base, ref_id):
+        if row.get('seq') is not None and row['seq'] <= top:
+            chain[row['_id']] = History._from_son(row)
+    if not chain:
+        return {}
+    # 归档后未能删除的分区中的记录与冷数据重复， 按ID去重
+    for h in find_histories(base, {'ref_id': ref_id, 'seq': {'$lte': top}, 'time': {'$lte': latest}}, until=latest):
+        chain[h.id] = h
+    return replay_histories(sorted(chain.values(), key=lambda h: (h.seq, h.time)), wanted)
+
+
+def rebase_history(cn, son):
+    """
+    多个进程基于同一版本保存时历史记录的版本号冲突， 冲突的记录改为完整快照(上一版本应用其增量)， 版本号为当前最大版本号+1
+    :param cn: 历史记录集合名
+    :param son: 版本号冲突的历史记录
+    :return: 新的历史记录， 无法还原上一版本时返回None
+    """
+    base = history_base_name(cn)
+    ref_id, seq = son['ref_id'], son['seq']
+    son = dict(son)
+    if son.get('fmt') == history_codec.FORMAT_DELTA:
+        state = load_history_states(base, ref_id, {seq - 1}, son['time'], son['time']).get(seq - 1)
+        if state is None:
+            return None
+        state = history_codec.apply_delta(state, *history_codec.decode_delta(son['value']))
+        son['value'] = Binary(history_codec.encode_snapshot(state))
+        son['fmt'] = history_codec.FORMAT_SNAPSHOT
+    latest = find_histories(base, {'ref_id': ref_id, 'seq': {'$exists': True}}, {'seq': 1},
+                            sort=[('seq', -1)], limit=1)
+    son['seq'] = max(latest[0].seq if latest else seq, seq) + 1
+    return son
+
+
+def _parse_history_cursor(cursor):
+    """
+    解析历史记录分页游标
+    :param cursor: '<记录时间(毫秒)>_<记录ID>'
+    :return: (记录时间, 记录ID)
+    """
+    millis, sep, oid = cursor.partition('_') if isinstance(cursor, str) else ('', '', '')
+    if not sep or not millis.isdigit() or not ObjectId.is_valid(oid):
+        raise InvalidCursor('invalid history cursor')
+    try:
+        until = _millis_to_datetime(int(millis), DEFAULT_CODEC_OPTIONS)
+    except (OverflowError, ValueError, OSError) as e:
+        raise InvalidCursor('invalid history cursor: %s' % e)
+    return until, ObjectId(oid)
+
+
+class HistoryPage(object):
+    """
+    一页历史记录， 文档在首次访问时整页还原
+    """
+
+    def __init__(self, owner, cname, ref_id, histories, next_cursor):
+        self._owner = owner
+        self._cname = cname
+        self._ref_id = ref_id
+        self._documents = None
+        self.histories = histories
+        self.next_cursor = next_cursor
+
+    def __iter__(self):
+        return iter(self.histories)
+
+    def __len__(self):
+        return len(self.histories)
+
+    @property
+    def documents(self):
+        if self._documents is None:
+            self._documents = self._owner.decode_histories(self._cname, self._ref_id, self.histories)
+        return self._documents
+
+    def items(self):
+        return list(zip(self.histories, self.documents))
+
 
 class HistoryBase(BaseDocument):
     """
@@ -189,6 +808,9 @@ class HistoryBase(BaseDocument):
     """
     meta = {'abstract': True}
 
+    # version number of the latest history
+    history_seq = IntField(default=0)
+
     def __init__(self, *args, **values):
         super(HistoryBase, self).__init__(*args, **values)
         self.history_position = history_position['body']
@@ -199,56 +821,226 @@ class HistoryBase(BaseDocument):
         ref_id = str(self.id)
         return cname, ref_id
 
-    def save_history(self, executer, is_update):
+    def _prepare_history(self, is_update):
+        """
+        生成历史记录的值： 新建、新对象及每 HISTORY_SNAPSHOT_INTERVAL 个版本保存完整快照， 其余保存修改字段的增量
+        :param is_update:
+        :return: (cname, ref_id, value, position, fmt, seq)
+        """
         if not is_update:
             self.history_position = history_position['head']
         elif self.history_position != history_position['tail']:
             self.history_position = history_position['body']
 
+        self.history_seq = (self.history_seq or 0) + 1
+        seq = self.history_seq
+        if not is_update or self._created or seq == 1 or (seq - 1) % settings.HISTORY_SNAPSHOT_INTERVAL == 0:
+            fmt = history_codec.FORMAT_SNAPSHOT
+            value = history_codec.encode_snapshot(self.to_mongo())
+        else:
+            fmt = history_codec.FORMAT_DELTA
+            set_data, unset_data = self._delta()
+            value = history_codec.encode_delta(set_data, unset_data)
+
         cname, ref_id = self._get_cname_and_ref_id()
-        value = pickle.dumps(self)
-        self.create_histroy(cname, ref_id, value, self.history_position, executer)
+        return cname, ref_id, value, self.history_position, fmt, seq
+
+    def save_history(self, executer, is_update):
+        cname, ref_id, value, position, fmt, seq = self._prepare_history(is_update)
+        self.create_histroy(cname, ref_id, value, position, executer, fmt, seq)
+
+    @classmethod
+    def save_histories(cls, docs, executer, is_updates):
+        """
+        批量写入历史记录， 经写入队列按集合 insert_many
+        :param docs: 文档列表
+        :param executer: 操作人
+        :param is_updates: 与docs对应的是否为修改
+        :return:
+        """
+        cls._put_histories(cls._prepare_histories(docs, executer, is_updates))
+
+    @classmethod
+    def _prepare_histories(cls, docs, executer, is_updates):
+        """
+        生成历史记录
+        :return: 与docs对应的 [(历史记录集合名, 历史记录)]
+        """
+        result = []
+        for doc, is_update in zip(docs, is_updates):
+            cname, ref_id, value, position, fmt, seq = doc._prepare_history(is_update)
+            history = doc._new_history(ref_id, value, position, executer, fmt, seq)
+            result.append((cls.get_collection_name(cname, history.time), history.to_mongo()))
+        return result
+
+    @staticmethod
+    def _put_histories(histories):
+        """
+        历史记录按集合放入写入队列
+        :param histories: [(历史记录集合名, 历史记录)]
+        :return:
+        """
+        groups = {}
+        for cn, history in histories:
+            groups.setdefault(cn, []).append(history)
+        for cn, items in groups.items():
+            HistoryQueue.put_many(cn, items)
 
     def get_history(self, count=0):
-        cname, ref_id = self._get_cname_and_ref_id()
-        cursor = self.get_histories(cname=cname, ref_id=ref_id)
-        if isinstance(count, int):
-            cursor = cursor[:count]
-        return [(h.time, pickle.loads(str(h.value))) for h in cursor]
+        return [(h.time, doc) for h, doc in self.get_history_info(count)]
 
     def get_history_info(self, count=0):
         cname, ref_id = self._get_cname_and_ref_id()
-        cursor = self.get_histories(cname=cname, ref_id=ref_id)
-        if isinstance(count, int):
-            cursor = cursor[:count]
-        return [(h, pickle.loads(str(h.value))) for h in cursor]
+        # count <= 0 时返回全部
+        limit = count if isinstance(count, int) and count > 0 else 0
+        histories = self.get_histories(cname, limit=limit, ref_id=ref_id)
+        return list(zip(histories, self.decode_histories(cname, ref_id, histories)))
 
-    def get_collection_name(self, cname):
+    def get_history_page(self, limit=20, cursor=None, with_value=False):
+        """
+        按时间倒序分页读取历史记录(键集分页)
+        :param limit: 每页数量
+        :param cursor: 上一页返回的 next_cursor， None 时从最新的记录开始， 格式不正确时抛出 InvalidCursor
+        :param with_value: 是否读取记录的值， False 时只读取元数据， 访问 documents 时再读取
+        :return: HistoryPage
+        """
+        cname, ref_id = self._get_cname_and_ref_id()
+        kwargs = {'ref_id': ref_id}
+        if cursor:
+            until, oid = _parse_history_cursor(cursor)
+            kwargs['until'] = until
+            kwargs['__raw__'] = {'$or': [{'time': {'$lt': until}}, {'time': until, '_id': {'$lt': oid}}]}
+        histories = self.get_histories(cname, limit=limit, with_value=with_value, **kwargs)
+        next_cursor = None
+        if len(histories) == limit:
+            last = histories[-1]
+            next_cursor = '%d_%s' % (_datetime_to_millis(last.time), last.id)
+        return HistoryPage(self, cname, ref_id, histories, next_cursor)
+
+    def decode_histories(self, cname, ref_id, histories):
+        """
+        还原历史版本， 从不晚于最早版本的最近快照开始依次应用增量， 参考 replay_histories
+        :param cname: 集合名
+        :param ref_id: 文档ID
+        :param histories: 同一文档的历史记录列表
+        :return: 与histories对应的文档列表
+        """
+        versioned = [h for h in histories if h.fmt in (history_codec.FORMAT_SNAPSHOT, history_codec.FORMAT_DELTA)]
+        states = {}
+        if versioned:
+            states = load_history_states(self.get_base_collection_name(cname), ref_id, {h.seq for h in versioned},
+                                         min(h.time for h in versioned), max(h.time for h in versioned))
+
+        # 只读取了元数据的旧格式记录
+        values = {}
+        missing = [h for h in histories if not h.fmt and h.value is None]
+        if missing:
+            values = {h.id: h.value for h in self.get_histories(
+                cname, since=min(h.time for h in missing), until=max(h.time for h in missing),
+                id__in=[h.id for h in missing])}
+
+        result = []
+        for h in histories:
+            if not h.fmt:
+                value = h.value if h.value is not None else values.get(h.id)
+                result.append(pickle.loads(value) if value is not None else None)
+            elif h.seq in states:
+                result.append(self.__class__._from_son(states[h.seq]))
+            else:
+                result.append(None)
+        return result
+
+    @classmethod
+    def migrate_histories(cls):
+        """
+        将旧格式(pickle)历史记录转换为快照+增量格式， 按时间顺序以负数版本号排在新格式记录之前
+        :return: 转换的记录数量
+        """
+        cname = cls._meta['collection']
+        # 旧格式记录只存在于未分区前的基础集合
+        cn = cls.get_base_collection_name(cname)
+        with switch_collection(History, cn) as _history:
+            collection = _history._get_collection()
+        migrated = 0
+        for ref_id in collection.distinct('ref_id', {'fmt': None}):
+            rows = list(collection.find({'ref_id': ref_id, 'fmt': None}, sort=[('time', 1)]))
+            requests = []
+            previous = None
+            for i, row in enumerate(rows):
+                try:
+                    state = pickle.loads(row['value']).to_mongo().to_dict()
+                except Exception as e:
+                    logger.error('[%s][%s][migrate]%s' % (cname, ref_id, e))
+                    previous = None
+                    continue
+                if previous is None or i % settings.HISTORY_SNAPSHOT_INTERVAL == 0:
+                    fmt, value = history_codec.FORMAT_SNAPSHOT, history_codec.encode_snapshot(state)
+                else:
+                    fmt = history_codec.FORMAT_DELTA
+                    value = history_codec.encode_delta(*history_codec.diff_states(previous, state))
+                previous = state
+                requests.append(UpdateOne({'_id': row['_id']},
+                                          {'$set': {'value': Binary(value), 'fmt': fmt, 'seq': i - len(rows)}}))
+            if requests:
+                collection.bulk_write(requests, ordered=False)
+                migrated += len(requests)
+        return migrated
+
+    @classmethod
+    def get_base_collection_name(cls, cname):
         result = 'history_%s' % cname
         result = result.lower()
         return result
 
-    def create_histroy(self, cname, ref_id, value, position, user):
+    @classmethod
+    def get_collection_name(cls, cname, when=None):
+        """
+        历史记录写入的集合， 按月分区时为记录时间所在月份的分区
+        :param cname: 集合名
+        :param when: 记录时间， 默认当前时间
+        :return:
+        """
+        result = cls.get_base_collection_name(cname)
+        if settings.HISTORY_PARTITION_BY_MONTH:
+            result = history_partition_name(result, when or datetime.datetime.now())
+        return result
+
+    def _new_history(self, ref_id, value, position, user, fmt=None, seq=None):
         history = History()
         history.ref_id = ref_id
         history.value = value
         history.p_id = position
         history.o_id = user.id
         history.ip = getattr(user, 'remote_ip', '')
+        history.fmt = fmt
+        history.seq = seq
+        return history
 
-        cn = self.get_collection_name(cname)
-        history.switch_collection(cn)
+    def create_histroy(self, cname, ref_id, value, position, user, fmt=None, seq=None):
+        history = self._new_history(ref_id, value, position, user, fmt, seq)
 
-        try:
-            history.save()
-        except Exception as e:
-            log_argus = (cname, ref_id, user.id, e)
-            logger.error('[%s][%s][%s]%s' % log_argus)
+        cn = self.get_collection_name(cname, history.time)
+        # 经写入队列批量写入， 写入失败记录在日志并溢出到本地文件
+        HistoryQueue.put(cn, history.to_mongo())
 
-    def get_histories(self, cname, **kwargs):
-        cn = self.get_collection_name(cname)
-
-        with switch_collection(History, cn) as _history:
-            cursor = _history.objects.filter(**kwargs)
-            result = cursor.order_by('-time')
-        return result
+    def get_histories(self, cname, limit=0, with_value=True, sort=None, since=None, until=None, **kwargs):
+        """
+        读取历史记录， 按月分区时跨分区查询， 参考 find_histories
+        :param cname: 集合名
+        :param limit: 限制数量， 0：不限
+        :param with_value: 是否读取记录的值
+        :param sort: 排序， 如 [('seq', 1)]， 默认按时间倒序
+        :param since: 记录时间下限(包含)
+        :param until: 记录时间上限(包含)
+        :param kwargs: 查询条件
+        :return: History 列表
+        """
+        base = self.get_base_collection_name(cname)
+        ensure_history_indexes(base)
+        if since:
+            kwargs['time__gte'] = since
+        if until:
+            kwargs['time__lte'] = until
+        query = Q(**kwargs).to_query(History)
+        projection = None if with_value else {'value': 0}
+        return find_histories(base, query, projection, sort, limit, since, until)
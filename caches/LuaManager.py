@@ -2,6 +2,10 @@
 
 import hashlib
 
+from redis.exceptions import NoScriptError
+
+import settings
+
 
 class LuaManager(type):
     def __new__(cls, name, bases, attrs):
@@ -18,17 +22,116 @@ class LuaManager(type):
         return super(LuaManager, cls).__new__(cls, name, bases, attrs)
 
 
+def is_noscript_error(result):
+    """
+    是否为脚本不存在错误(Redis重启或 SCRIPT FLUSH 后)
+    :param result: 异常或管道中的结果
+    :return:
+    """
+    # redis-py 转换为 NoScriptError(去掉了错误前缀)， aioredis 为 ReplyError
+    return isinstance(result, NoScriptError) or (isinstance(result, Exception) and 'NOSCRIPT' in str(result))
+
+
 class RedisLua(object, metaclass=LuaManager):
     def __init__(self, rcon):
         self.rcon = rcon
 
-    def run_script(self, keys, args):
+    def _track(self, client, keys, args):
+        """
+        记录管道中的脚本调用， 管道执行结果为NOSCRIPT时由 retry_noscript 重新执行
+        :param client: 管道
+        :return:
+        """
+        calls = getattr(client, 'lua_calls', None)
+        if calls is not None:
+            calls.append((len(client), self, keys, args))
+
+    def run_script(self, keys, args, client=None):
+        """
+        执行脚本
+        :param keys: 键列表
+        :param args: 参数列表
+        :param client: 管道， 指定时脚本命令加入管道， 由管道统一执行
+        :return:
+        """
+        keys, args = list(keys), list(args)
+        if client is not None:
+            if not self.flag:
+                self.rcon.script_load(self.lua)
+                self.flag = True
+            self._track(client, keys, args)
+            return client.evalsha(self.hashcode, len(keys), *(keys + args))
         if self.flag or self.rcon.script_exists(self.hashcode)[0]:
             self.flag = True
-            return self.rcon.evalsha(self.hashcode, len(keys), *(keys + args))
+            try:
+                return self.rcon.evalsha(self.hashcode, len(keys), *(keys + args))
+            except Exception as e:
+                if not is_noscript_error(e):
+                    raise
+                # 脚本已被清除， 下次执行时重新加载
+                self.flag = False
+                return self.rcon.eval(self.lua, len(keys), *(keys + args))
         else:
             return self.rcon.register_script(self.lua)(keys=keys, args=args)
 
+    async def async_run_script(self, keys, args, client=None):
+        """
+        执行脚本(异步客户端)
+        :param keys: 键列表
+        :param args: 参数列表
+        :param client: 管道， 指定时脚本命令加入管道， 由管道统一执行
+        :return:
+        """
+        keys, args = list(keys), list(args)
+        if not self.flag:
+            await self.rcon.script_load(self.lua)
+            self.flag = True
+        if client is not None:
+            self._track(client, keys, args)
+            return await client.evalsha(self.hashcode, len(keys), *(keys + args))
+        try:
+            return await self.rcon.evalsha(self.hashcode, len(keys), *(keys + args))
+        except Exception as e:
+            if not is_noscript_error(e):
+                raise
+            self.flag = False
+            return await self.rcon.eval(self.lua, len(keys), *(keys + args))
+
+
+def retry_noscript(calls, results):
+    """
+    管道中因脚本不存在而失败的脚本调用单独重新执行， 结果替换到原位置
+    重新执行的脚本在管道中其他命令之后执行
+    :param calls: 管道记录的脚本调用 [(位置, 脚本, 键列表, 参数列表)]
+    :param results: 管道执行结果(包含异常)
+    :return: results
+    """
+    for index, script, keys, args in calls:
+        if index < len(results) and is_noscript_error(results[index]):
+            script.flag = False
+            try:
+                results[index] = script.run_script(keys, args)
+            except Exception as e:
+                results[index] = e
+    return results
+
+
+async def async_retry_noscript(calls, results):
+    """
+    retry_noscript 的异步版本
+    :param calls: 管道记录的脚本调用 [(位置, 脚本, 键列表, 参数列表)]
+    :param results: 管道执行结果(包含异常)
+    :return: results
+    """
+    for index, script, keys, args in calls:
+        if index < len(results) and is_noscript_error(results[index]):
+            script.flag = False
+            try:
+                results[index] = await script.async_run_script(keys, args)
+            except Exception as e:
+                results[index] = e
+    return results
+
 
 class CheckProcessLua(RedisLua):
     lua = b"""\
@@ -92,9 +195,234 @@ class ScanDelWithPrefixLua(RedisLua):
     """
 
 
+class TagAddLua(RedisLua):
+    """
+        将缓存键加入标签集合， 标签集合的过期时间不小于其中任一缓存键的过期时间
+        KEYS[1]: 标签集合
+        ARGV[1]: 缓存键过期时间(秒)， 0: 永不超时
+        ARGV[2...]: 缓存键
+    """
+    lua = b"""\
+    local existed = redis.call('exists', KEYS[1])
+    local added = redis.call('sadd', KEYS[1], unpack(ARGV, 2))
+    local timeout = tonumber(ARGV[1])
+    if timeout == 0 then
+        redis.call('persist', KEYS[1])
+    else
+        local ttl = redis.call('ttl', KEYS[1])
+        if existed == 0 or (ttl >= 0 and ttl < timeout) then
+            redis.call('expire', KEYS[1], timeout)
+        end
+    end
+    return added
+    """
+
+
+class InvalidateTagsLua(RedisLua):
+    """
+        删除标签集合中的所有缓存键及标签集合， 并返回删除的缓存键数量
+        KEYS: 标签集合
+    """
+    lua = b"""\
+    redis.replicate_commands()
+    local delete_count = 0
+    for _, tag in ipairs(KEYS) do
+        local members = redis.call('smembers', tag)
+        for i = 1, #members, 1000 do
+            delete_count = delete_count + redis.call('del', unpack(members, i, math.min(i + 999, #members)))
+        end
+        redis.call('del', tag)
+    end
+    return delete_count
+    """
+
+
+def slot_key(name, suffix):
+    """
+    生成与name位于同一集群slot的关联键
+    :param name: 键
+    :param suffix: 关联键后缀
+    :return:
+    """
+    if isinstance(name, bytes):
+        name = name.decode('utf-8')
+    start = name.find('{')
+    if start != -1 and name.find('}', start + 1) > start + 1:
+        # name 已包含hash tag(第一个 { 与其后第一个 } 之间非空)， 直接追加后缀即可保持slot一致
+        return '%s:%s' % (name, suffix)
+    if '}' in name and settings.REDIS_CLUSTER:
+        # 没有hash tag(如 {}{x})时按整个键计算slot， 而包含 } 的键无法整体作为hash tag
+        raise ValueError('cannot derive a same-slot key for %r' % name)
+    return '{%s}:%s' % (name, suffix)
+
+
+class GetExpireLua(RedisLua):
+    """
+        获取值并顺延过期时间(滑动过期)
+        KEYS[1]: 键
+        ARGV[1]: 过期时间(秒)
+    """
+    lua = b"""\
+    local value = redis.call('get', KEYS[1])
+    if value then
+        redis.call('expire', KEYS[1], ARGV[1])
+    end
+    return value
+    """
+
+
+class GetOrLoadingLua(RedisLua):
+    """
+        获取值， 不存在时抢占加载锁
+        KEYS[1]: 键
+        KEYS[2]: 加载锁(与KEYS[1]同slot)
+        ARGV[1]: 加载锁超时时间(秒)
+        ARGV[2]: 加载锁持有者标识
+        返回 {2, 值}: 命中; {0}: 获得加载锁， 由调用方加载; {1}: 其他调用方正在加载
+    """
+    lua = b"""\
+    local value = redis.call('get', KEYS[1])
+    if value then
+        return {2, value}
+    end
+    if redis.call('set', KEYS[2], ARGV[2], 'NX', 'EX', ARGV[1]) then
+        return {0}
+    end
+    return {1}
+    """
+
+
+class HIncrCapLua(RedisLua):
+    """
+        dict形式值自增， 超过上限时不自增
+        KEYS[1]: 键
+        ARGV[1]: 值键
+        ARGV[2]: 步长
+        ARGV[3]: 上限
+        ARGV[4]: 过期时间(秒)， 仅在键未设置过期时间时设置， 0: 不设置
+        返回 {1, 自增后的值}: 成功; {0, 当前值}: 超过上限
+    """
+    lua = b"""\
+    local current = tonumber(redis.call('hget', KEYS[1], ARGV[1]) or '0')
+    local amount = tonumber(ARGV[2])
+    if current + amount > tonumber(ARGV[3]) then
+        return {0, current}
+    end
+    local value = redis.call('hincrby', KEYS[1], ARGV[1], amount)
+    local timeout = tonumber(ARGV[4])
+    if timeout > 0 and redis.call('ttl', KEYS[1]) == -1 then
+        redis.call('expire', KEYS[1], timeout)
+    end
+    return {1, value}
+    """
+
+
+class SetIfVersionGreaterLua(RedisLua):
+    """
+        版本号大于当前版本号时设置值
+        KEYS[1]: 键
+        KEYS[2]: 版本号键(与KEYS[1]同slot)
+        ARGV[1]: 值
+        ARGV[2]: 版本号
+        ARGV[3]: 过期时间(秒)， 0: 永不超时
+        返回 1: 已设置; 0: 版本号不大于当前版本号
+    """
+    lua = b"""\
+    local current = tonumber(redis.call('get', KEYS[2]))
+    if current and current >= tonumber(ARGV[2]) then
+        return 0
+    end
+    local timeout = tonumber(ARGV[3])
+    if timeout > 0 then
+        redis.call('set', KEYS[1], ARGV[1], 'EX', timeout)
+        redis.call('set', KEYS[2], ARGV[2], 'EX', timeout)
+    else
+        redis.call('set', KEYS[1], ARGV[1])
+        redis.call('set', KEYS[2], ARGV[2])
+    end
+    return 1
+    """
+
+
+class SetIfGenerationLua(RedisLua):
+    """
+        代数未变化时设置值(读穿缓存回填， 读取期间失效过的旧值不写入)
+        KEYS[1]: 键
+        KEYS[2]: 代数键(与KEYS[1]同slot)
+        ARGV[1]: 值
+        ARGV[2]: 读取前的代数， 空字符串: 代数键不存在
+        ARGV[3]: 过期时间(秒)， 0: 永不超时
+        返回 1: 已设置; 0: 代数已变化
+    """
+    lua = b"""\
+    local current = redis.call('get', KEYS[2]) or ''
+    if current ~= ARGV[2] then
+        return 0
+    end
+    local timeout = tonumber(ARGV[3])
+    if timeout > 0 then
+        redis.call('set', KEYS[1], ARGV[1], 'EX', timeout)
+    else
+        redis.call('set', KEYS[1], ARGV[1])
+    end
+    return 1
+    """
+
+
+class PopNLua(RedisLua):
+    """
+        从列表弹出多个元素
+        KEYS[1]: 键
+        ARGV[1]: 数量
+        ARGV[2]: 1: 从右侧弹出(顺序同多次RPOP)， 0: 从左侧弹出(顺序同多次LPOP)
+    """
+    lua = b"""\
+    local count = tonumber(ARGV[1])
+    if count <= 0 then
+        return {}
+    end
+    if ARGV[2] == '1' then
+        local items = redis.call('lrange', KEYS[1], -count, -1)
+        redis.call('ltrim', KEYS[1], 0, -count - 1)
+        local result = {}
+        for i = #items, 1, -1 do
+            result[#result + 1] = items[i]
+        end
+        return result
+    end
+    local items = redis.call('lrange', KEYS[1], 0, count - 1)
+    redis.call('ltrim', KEYS[1], count, -1)
+    return items
+    """
+
+
+class DeleteIfEqualLua(RedisLua):
+    """
+        值等于指定值时删除(释放持有的锁)
+        KEYS[1]: 键
+        ARGV[1]: 期望的值(锁持有者标识)
+        返回 1: 已删除; 0: 值不相等或键不存在
+    """
+    lua = b"""\
+    if redis.call('get', KEYS[1]) == ARGV[1] then
+        return redis.call('del', KEYS[1])
+    end
+    return 0
+    """
+
+
 LuaDict = {
     "IS_FIRST_PROCESS_LUA": CheckProcessLua,
     "INCR_EXPIRE_LUA": IncrExpireLua,
     "COUNT_KEY_WITH_PREFIX_LUA": CountKeyWithPrefixLua,
     "SCAN_DEL_WITH_PREFIXLUA": ScanDelWithPrefixLua,
+    "TAG_ADD_LUA": TagAddLua,
+    "INVALIDATE_TAGS_LUA": InvalidateTagsLua,
+    "GET_EXPIRE_LUA": GetExpireLua,
+    "GET_OR_LOADING_LUA": GetOrLoadingLua,
+    "HINCR_CAP_LUA": HIncrCapLua,
+    "SET_IF_VERSION_GREATER_LUA": SetIfVersionGreaterLua,
+    "SET_IF_GENERATION_LUA": SetIfGenerationLua,
+    "POP_N_LUA": PopNLua,
+    "DELETE_IF_EQUAL_LUA": DeleteIfEqualLua,
 }
@@ -0,0 +1,175 @@
+# !/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+位图ID映射
+
+位图以整数偏移量作为成员标识， ObjectId 等非整数ID需要先映射成稠密的整数偏移量：
+    bitmap:{name}:offsets   hash, ID -> 偏移量
+    bitmap:{name}:ids       hash, 偏移量 -> ID
+    bitmap:{name}:seq       计数器, 已分配的偏移量数量
+三个键使用相同的hash tag， 集群模式下位于同一个slot。
+"""
+
+from caches.redis_utils import RedisCache, AsyncRedisCache
+
+
+def _to_str(value):
+    if isinstance(value, bytes):
+        return value.decode('utf-8')
+    return str(value)
+
+
+def bitmap_offsets(value):
+    """
+    解析原始位图数据， 返回所有值为1的偏移量
+    :param value: GET 得到的位图数据(bytes)
+    :return: 偏移量列表
+    """
+    offsets = []
+    if value:
+        for index, byte in enumerate(bytearray(value)):
+            if byte:
+                for bit in range(8):
+                    if byte & (0x80 >> bit):
+                        offsets.append(index * 8 + bit)
+    return offsets
+
+
+class _OffsetMapperBase(object):
+    def __init__(self, name, cache=None):
+        if not name:
+            raise ValueError('Bitmap mapping name not specified.')
+        self.name = name
+        self.cache = cache
+        self.offsets_key = 'bitmap:{%s}:offsets' % name
+        self.ids_key = 'bitmap:{%s}:ids' % name
+        self.seq_key = 'bitmap:{%s}:seq' % name
+
+    @staticmethod
+    def _unique_missing(ids, values):
+        missing = []
+        for oid, value in zip(ids, values):
+            if value is None and oid not in missing:
+                missing.append(oid)
+        return missing
+
+    @staticmethod
+    def _merge(ids, values, assigned):
+        return [int(value) if value is not None else assigned.get(oid)
+                for oid, value in zip(ids, values)]
+
+
+class ObjectIdOffsetMapper(_OffsetMapperBase):
+    """
+    ObjectId与位图偏移量的映射(同步)
+    """
+
+    def __init__(self, name, cache=None):
+        super(ObjectIdOffsetMapper, self).__init__(name, cache or RedisCache)
+
+    def get_offsets(self, ids, create=True):
+        """
+        批量获取ID对应的偏移量
+        :param ids: ID列表(ObjectId或字符串)
+        :param create: 未分配偏移量时是否分配
+        :return: 偏移量列表， 与参数顺序对应， 未分配且create=False时为None
+        """
+        ids = [_to_str(oid) for oid in ids]
+        if not ids:
+            return []
+        values = self.cache.hmget(self.offsets_key, ids)
+        missing = self._unique_missing(ids, values)
+        assigned = {}
+        if missing and create:
+            assigned = self._assign(missing)
+        return self._merge(ids, values, assigned)
+
+    def get_offset(self, oid, create=True):
+        """
+        获取ID对应的偏移量
+        :param oid: ID(ObjectId或字符串)
+        :param create: 未分配偏移量时是否分配
+        :return:
+        """
+        return self.get_offsets([oid], create)[0]
+
+    def get_ids(self, offsets):
+        """
+        批量获取偏移量对应的ID
+        :param offsets: 偏移量列表
+        :return: ID字符串列表， 与参数顺序对应， 不存在时为None
+        """
+        if not offsets:
+            return []
+        values = self.cache.hmget(self.ids_key, list(offsets))
+        return [_to_str(value) if value is not None else None for value in values]
+
+    def _assign(self, missing):
+        end = self.cache.incr(self.seq_key, len(missing))
+        start = end - len(missing)
+        pipe = self.cache.pipeline
+        for index, oid in enumerate(missing):
+            # 并发分配时以先写入者为准， 落选的偏移量不会被任何位图使用
+            pipe.hsetnx(self.offsets_key, oid, start + index)
+            pipe.hsetnx(self.ids_key, start + index, oid)
+        pipe.hmget(self.offsets_key, missing)
+        results = pipe.execute()
+        return {oid: int(value) for oid, value in zip(missing, results[-1])}
+
+
+class AsyncObjectIdOffsetMapper(_OffsetMapperBase):
+    """
+    ObjectId与位图偏移量的映射(异步)
+    """
+
+    def __init__(self, name, cache=None):
+        super(AsyncObjectIdOffsetMapper, self).__init__(name, cache or AsyncRedisCache)
+
+    async def get_offsets(self, ids, create=True):
+        """
+        批量获取ID对应的偏移量
+        :param ids: ID列表(ObjectId或字符串)
+        :param create: 未分配偏移量时是否分配
+        :return: 偏移量列表， 与参数顺序对应， 未分配且create=False时为None
+        """
+        ids = [_to_str(oid) for oid in ids]
+        if not ids:
+            return []
+        values = await self.cache.hmget(self.offsets_key, ids)
+        missing = self._unique_missing(ids, values)
+        assigned = {}
+        if missing and create:
+            assigned = await self._assign(missing)
+        return self._merge(ids, values, assigned)
+
+    async def get_offset(self, oid, create=True):
+        """
+        获取ID对应的偏移量
+        :param oid: ID(ObjectId或字符串)
+        :param create: 未分配偏移量时是否分配
+        :return:
+        """
+        return (await self.get_offsets([oid], create))[0]
+
+    async def get_ids(self, offsets):
+        """
+        批量获取偏移量对应的ID
+        :param offsets: 偏移量列表
+        :return: ID字符串列表， 与参数顺序对应， 不存在时为None
+        """
+        if not offsets:
+            return []
+        values = await self.cache.hmget(self.ids_key, list(offsets))
+        return [_to_str(value) if value is not None else None for value in values]
+
+    async def _assign(self, missing):
+        end = await self.cache.incr(self.seq_key, len(missing))
+        start = end - len(missing)
+        pipe = self.cache.pipeline
+        for index, oid in enumerate(missing):
+            # 并发分配时以先写入者为准， 落选的偏移量不会被任何位图使用
+            await pipe.hsetnx(self.offsets_key, oid, start + index)
+            await pipe.hsetnx(self.ids_key, start + index, oid)
+        await pipe.hmget(self.offsets_key, missing)
+        results = await pipe.execute()
+        return {oid: int(value) for oid, value in zip(missing, results[-1])}
@@ -0,0 +1,178 @@
+# !/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+计数器本地聚合(写回)
+
+自增先累加在进程内存中， 每隔 COUNTER_FLUSH_INTERVAL_MS 毫秒或累计 COUNTER_FLUSH_THRESHOLD
+次自增后， 以一个管道批量 INCRBY/HINCRBY 写入Redis； 应用关闭时写入剩余增量。
+读取时可选择精确值(本地未写入的增量 + Redis值)或仅Redis值。
+"""
+
+import asyncio
+
+import settings
+from caches.redis_utils import AsyncRedisCache
+from commons import logging
+
+logger = logging.get_logging()
+
+
+class WriteBehindCounter(object):
+    def __init__(self, cache=None,
+                 interval_ms=settings.COUNTER_FLUSH_INTERVAL_MS,
+                 threshold=settings.COUNTER_FLUSH_THRESHOLD,
+                 batch_size=settings.REDIS_PIPELINE_MAX_BUFFER):
+        self.cache = cache or AsyncRedisCache
+        self.interval_ms = interval_ms
+        self.threshold = threshold
+        self.batch_size = batch_size
+        # {(键, 值键): 增量}， 值键为None时为普通计数器
+        self._pending = {}
+        self._pending_count = 0
+        # 正在写入的增量， 写入确认前仍计入精确值
+        self._inflight = {}
+        self._lock = None
+        self._flushing = None
+        self._task = None
+
+    def incr(self, name, amount=1, key=None):
+        """
+        自增(本地累加)
+        :param name: 键
+        :param amount: 步长
+        :param key: 值键， 指定时对dict形式的值自增
+        :return:
+        """
+        counter_key = (name, key)
+        self._pending[counter_key] = self._pending.get(counter_key, 0) + amount
+        self._pending_count += 1
+        if self.threshold and self._pending_count >= self.threshold and not self._flushing:
+            self._flushing = asyncio.ensure_future(self._flush_in_background())
+
+    def pending(self, name, key=None):
+        """
+        获取本地未写入(含正在写入)的增量
+        :param name: 键
+        :param key: 值键
+        :return:
+        """
+        counter_key = (name, key)
+        return self._pending.get(counter_key, 0) + self._inflight.get(counter_key, 0)
+
+    async def get(self, name, key=None, exact=True):
+        """
+        获取计数
+        :param name: 键
+        :param key: 值键
+        :param exact: True 精确值(本地未写入的增量 + Redis值)， False 仅Redis值；
+                      写入已到达Redis但尚未确认时精确值可能短暂偏大
+        :return:
+        """
+        if key is None:
+            value = await self.cache.get(name)
+        else:
+            value = await self.cache.hget(name, key)
+        value = int(value) if value is not None else 0
+        if exact:
+            value += self.pending(name, key)
+        return value
+
+    def _restore(self, counter_key, amount):
+        self._pending[counter_key] = self._pending.get(counter_key, 0) + amount
+        self._pending_count += 1
+
+    async def _execute(self, batch):
+        pipe = self.cache.pipeline
+        for (name, key), amount in batch:
+            if key is None:
+                await pipe.incr(name, amount)
+            else:
+                await pipe.hincrby(name, key, amount)
+        return await pipe.execute(return_exceptions=True)
+
+    async def flush(self):
+        """
+        将本地累加的增量批量写入Redis， 同一时间只有一次写入
+        :return: 写入的计数器数量
+        """
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            return await self._flush()
+
+    async def _flush(self):
+        pending, self._pending, self._pending_count = self._pending, {}, 0
+        items = [(counter_key, amount) for counter_key, amount in pending.items() if amount]
+        if not items:
+            return 0
+        self._inflight = dict(items)
+        written = 0
+        batch_size = self.batch_size or len(items)
+        try:
+            await self.cache.setup()
+            for start in range(0, len(items), batch_size):
+                batch = items[start:start + batch_size]
+                execution = asyncio.ensure_future(self._execute(batch))
+                cancelled = False
+                try:
+                    results = await asyncio.shield(execution)
+                except asyncio.CancelledError:
+                    # 已发送的命令等待结果， 确认写入情况后再取消
+                    cancelled = True
+                    results = await execution
+                for (counter_key, amount), result in zip(batch, results):
+                    del self._inflight[counter_key]
+                    if isinstance(result, Exception):
+                        # 只重试失败的命令， 已写入的不会重复累加
+                        self._restore(counter_key, amount)
+                        logger.error('[counter][%s]%s' % (counter_key[0], result))
+                    else:
+                        written += 1
+                if cancelled:
+                    raise asyncio.CancelledError()
+        except Exception as e:
+            logger.error('[counter]%s' % e)
+        finally:
+            # 未发送或整批执行失败的增量合并回本地， 下次重试
+            for counter_key, amount in self._inflight.items():
+                self._restore(counter_key, amount)
+            self._inflight = {}
+        return written
+
+    async def _flush_in_background(self):
+        try:
+            await self.flush()
+        finally:
+            self._flushing = None
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval_ms / 1000.0)
+            await self.flush()
+
+    async def start(self):
+        """
+        启动定时写入任务
+        :return:
+        """
+        if not self._task:
+            self._task = asyncio.ensure_future(self._run())
+
+    async def stop(self):
+        """
+        停止定时写入任务并写入剩余增量
+        :return:
+        """
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._flushing:
+            await self._flushing
+        await self.flush()
+
+
+Counters = WriteBehindCounter()
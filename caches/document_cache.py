@@ -0,0 +1,194 @@
+# !/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+按ID读取文档: 请求级标识映射 + Redis读穿缓存
+
+读取顺序：
+    1. 请求级标识映射(contextvars)， 同一请求内同一文档只加载一次
+    2. Redis doc:<集合名>:<ID>， 一次MGET(模型 meta 设置 'distributed_cache': True 时)
+    3. 剩余ID以一次 $in 查询读取， 并写回Redis
+ModelBase.my_save 后删除对应的Redis缓存并递增其代数(generation_key)； 回填时代数与读取前不一致则不写入，
+避免保存前开始读取的旧文档在删除后写回。格式不正确的ID按不存在处理。
+标识映射由 IdentityMapMiddleware 在每个请求开始时创建， 请求外可使用 identity_scope()。
+"""
+
+import contextlib
+import contextvars
+
+from mongoengine.errors import ValidationError
+from mongoengine.queryset import QuerySet
+
+import settings
+from caches.query_cache import encode_docs, decode_docs
+from caches.redis_utils import RedisCache
+from commons import logging
+from commons.mongo_util import MongoDBConf
+
+logger = logging.get_logging()
+
+_IDENTITY_MAP = contextvars.ContextVar('identity_map', default=None)
+
+
+@contextlib.contextmanager
+def identity_scope():
+    """
+    创建标识映射作用域
+    :return:
+    """
+    token = _IDENTITY_MAP.set({})
+    try:
+        yield
+    finally:
+        _IDENTITY_MAP.reset(token)
+
+
+class IdentityMapMiddleware(object):
+    """
+    每个请求创建独立的标识映射
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] not in ('http', 'websocket'):
+            await self.app(scope, receive, send)
+            return
+        token = _IDENTITY_MAP.set({})
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            _IDENTITY_MAP.reset(token)
+
+
+def document_key(collection_name, oid):
+    """
+    文档缓存键
+    :param collection_name: 集合名
+    :param oid: 文档ID
+    :return:
+    """
+    return 'doc:%s:%s' % (collection_name, oid)
+
+
+def _cache_enabled(document_cls):
+    return MongoDBConf().distributed_cached_enable and document_cls._meta.get('distributed_cache', False)
+
+
+def get_documents(document_cls, ids):
+    """
+    按ID批量读取文档
+    :param document_cls: 文档类
+    :param ids: ID列表(str或ObjectId)
+    :return: 与ids顺序一致的文档列表， 不存在的为None
+    """
+    if not ids:
+        return []
+    id_field = document_cls._fields[document_cls._meta['id_field']]
+    collection_name = document_cls._get_collection_name()
+    identity_map = _IDENTITY_MAP.get()
+    found = {}
+
+    pending, seen = [], set()
+    for oid in ids:
+        key = str(oid)
+        if key in seen:
+            continue
+        seen.add(key)
+        if identity_map is not None and (collection_name, key) in identity_map:
+            found[key] = identity_map[(collection_name, key)]
+        else:
+            pending.append(key)
+
+    cache_enabled = pending and _cache_enabled(document_cls)
+    generations = {}
+    if cache_enabled:
+        try:
+            names = [document_key(collection_name, key) for key in pending]
+            values = RedisCache.mget(names + [RedisCache.generation_key(name) for name in names])
+            missing = []
+            for key, value, generation in zip(pending, values, values[len(names):]):
+                if value is None:
+                    missing.append(key)
+                    generations[key] = generation
+                else:
+                    found[key] = document_cls._from_son(decode_docs(value)[0])
+            pending = missing
+        except Exception as e:
+            logger.error('[document_cache][%s]%s' % (collection_name, e))
+
+    oids = []
+    for key in pending:
+        try:
+            oids.append(id_field.to_mongo(key))
+        except ValidationError:
+            # ID格式不正确， 按不存在处理
+            pass
+    if oids:
+        queryset = QuerySet(document_cls, document_cls._get_collection())
+        sons = list(queryset.filter(pk__in=oids).as_pymongo())
+        for son in sons:
+            found[str(son['_id'])] = document_cls._from_son(son)
+        if cache_enabled and sons:
+            try:
+                # 集群管道不支持脚本， 逐个执行
+                pipe = None if settings.REDIS_CLUSTER else RedisCache.pipeline
+                timeout = MongoDBConf().distributed_cached_timeout
+                for son in sons:
+                    RedisCache.set_if_generation(document_key(collection_name, son['_id']), encode_docs([son]),
+                                                 generations.get(str(son['_id'])), timeout=timeout, pipe=pipe)
+                if pipe is not None:
+                    pipe.execute()
+            except Exception as e:
+                logger.error('[document_cache][%s]%s' % (collection_name, e))
+
+    if identity_map is not None:
+        for key, doc in found.items():
+            identity_map[(collection_name, key)] = doc
+    return [found.get(str(oid)) for oid in ids]
+
+
+def invalidate_document(doc):
+    """
+    删除文档的Redis缓存并递增代数， 并以当前对象更新标识映射
+    :param doc: 文档
+    :return:
+    """
+    if doc.pk is None:
+        return
+    collection_name = doc._get_collection_name()
+    identity_map = _IDENTITY_MAP.get()
+    if identity_map is not None:
+        identity_map[(collection_name, str(doc.pk))] = doc
+    if not _cache_enabled(doc.__class__):
+        return
+    try:
+        RedisCache.bump_generation(document_key(collection_name, doc.pk),
+                                   timeout=MongoDBConf().distributed_cached_timeout)
+    except Exception as e:
+        logger.error('[document_cache][%s]%s' % (collection_name, e))
+
+
+def invalidate_documents(docs):
+    """
+    批量删除文档的Redis缓存并递增代数， 一次往返
+    :param docs: 文档列表
+    :return:
+    """
+    docs = [doc for doc in docs if doc.pk is not None]
+    if not docs:
+        return
+    identity_map = _IDENTITY_MAP.get()
+    if identity_map is not None:
+        for doc in docs:
+            identity_map[(doc._get_collection_name(), str(doc.pk))] = doc
+    if not _cache_enabled(docs[0].__class__):
+        return
+    try:
+        pipe = RedisCache.pipeline
+        timeout = MongoDBConf().distributed_cached_timeout
+        for doc in docs:
+            RedisCache.bump_generation(document_key(doc._get_collection_name(), doc.pk), timeout=timeout, pipe=pipe)
+        pipe.execute()
+    except Exception as e:
+        logger.error('[document_cache]%s' % e)
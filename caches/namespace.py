@@ -0,0 +1,143 @@
+# !/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+缓存命名空间
+
+逻辑键映射为带命名空间版本号的物理键: ns:<命名空间>:v<版本号>:<逻辑键>，
+版本号保存在 ns_version:<命名空间>， 进程内缓存 REDIS_NAMESPACE_VERSION_TTL 秒。
+invalidate() 对版本号执行一次 INCR， 旧版本的键不再被访问， 随超时时间自然淘汰；
+其他进程最迟在本地版本号缓存过期后切换到新版本。
+"""
+
+import time
+
+import settings
+
+# 进程内版本号缓存 {命名空间: (版本号, 过期时间)}
+_VERSIONS = {}
+
+
+class _NamespaceBase(object):
+    def __init__(self, name, cache, version_ttl=settings.REDIS_NAMESPACE_VERSION_TTL):
+        if not name:
+            raise ValueError('Cache namespace name not specified.')
+        self.name = name
+        self.cache = cache
+        self.version_ttl = version_ttl
+        self.version_key = 'ns_version:%s' % name
+
+    def _cached_version(self):
+        cached = _VERSIONS.get(self.name)
+        if cached and cached[1] > time.monotonic():
+            return cached[0]
+        return None
+
+    def _cache_version(self, version):
+        version = int(version)
+        _VERSIONS[self.name] = (version, time.monotonic() + self.version_ttl)
+        return version
+
+    def _key(self, version, key):
+        return 'ns:%s:v%s:%s' % (self.name, version, key)
+
+
+class CacheNamespace(_NamespaceBase):
+    """
+    缓存命名空间(同步)
+    """
+
+    def version(self):
+        """
+        获取当前版本号
+        :return:
+        """
+        version = self._cached_version()
+        if version is None:
+            version = self.cache.get(self.version_key)
+            if version is None:
+                # 以当前时间初始化， 版本键被淘汰后重建的版本号不会与旧版本重复
+                self.cache.setnx(self.version_key, int(time.time()), timeout=None)
+                version = self.cache.get(self.version_key)
+            version = self._cache_version(version)
+        return version
+
+    def key(self, key):
+        """
+        获取逻辑键对应的物理键
+        :param key: 逻辑键
+        :return:
+        """
+        return self._key(self.version(), key)
+
+    def get(self, key):
+        return self.cache.get(self.key(key))
+
+    def mget(self, keys):
+        version = self.version()
+        return self.cache.mget([self._key(version, key) for key in keys])
+
+    def set(self, key, value=None, timeout=settings.REDIS_CACHED_TIMEOUT, existed=None):
+        return self.cache.set(self.key(key), value, timeout=timeout, existed=existed)
+
+    def delete(self, key):
+        return self.cache.delete(self.key(key))
+
+    def invalidate(self):
+        """
+        使命名空间下所有的键失效
+        :return: 新版本号
+        """
+        # 先初始化版本号， 避免版本键不存在时INCR从1开始与旧版本重复
+        self.version()
+        return self._cache_version(self.cache.incr(self.version_key))
+
+
+class AsyncCacheNamespace(_NamespaceBase):
+    """
+    缓存命名空间(异步)
+    """
+
+    async def version(self):
+        """
+        获取当前版本号
+        :return:
+        """
+        version = self._cached_version()
+        if version is None:
+            version = await self.cache.get(self.version_key)
+            if version is None:
+                # 以当前时间初始化， 版本键被淘汰后重建的版本号不会与旧版本重复
+                await self.cache.setnx(self.version_key, int(time.time()), timeout=None)
+                version = await self.cache.get(self.version_key)
+            version = self._cache_version(version)
+        return version
+
+    async def key(self, key):
+        """
+        获取逻辑键对应的物理键
+        :param key: 逻辑键
+        :return:
+        """
+        return self._key(await self.version(), key)
+
+    async def get(self, key):
+        return await self.cache.get(await self.key(key))
+
+    async def mget(self, keys):
+        version = await self.version()
+        return await self.cache.mget([self._key(version, key) for key in keys])
+
+    async def set(self, key, value=None, timeout=settings.REDIS_CACHED_TIMEOUT, existed=None):
+        return await self.cache.set(await self.key(key), value, timeout=timeout, existed=existed)
+
+    async def delete(self, key):
+        return await self.cache.delete(await self.key(key))
+
+    async def invalidate(self):
+        """
+        使命名空间下所有的键失效
+        :return: 新版本号
+        """
+        # 先初始化版本号， 避免版本键不存在时INCR从1开始与旧版本重复
+        await self.version()
+        return self._cache_version(await self.cache.incr(self.version_key))
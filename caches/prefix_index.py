@@ -0,0 +1,247 @@
+# !/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+键前缀索引
+
+为已注册的前缀维护成员集合 prefix_index:<前缀>， 集合基数即该前缀下键的数量：
+    - 缓存客户端的 set/setnx/delete/incr/mset/hset/hmset/lpush/rpush/sadd/setbit/setbits/bitop/set_loaded
+      在写入的同一管道中同步 SADD/SREM， set_expire 设置负数超时(立即删除)时同一管道中 SREM；
+      集群模式下 mset/bitop 无法进入管道， 写入后单独 SADD
+    - 通过 db/pipeline 直接执行的命令及脚本写入的键不会加入索引， 需要调用 repair(full=True) 补充；
+      删除的键由定期修复任务清理
+    - 过期及淘汰的键通过键空间通知(__keyevent@<db>__:expired/evicted)移除
+    - 定期修复任务清理集合中已不存在的键， 补偿丢失的通知
+统计数量为 SCARD(O(1))， 枚举前缀下的键使用 SSCAN， 不再需要全库 SCAN。
+"""
+
+import asyncio
+
+import settings
+from commons import logging
+
+logger = logging.get_logging()
+
+# 需要的键空间通知标志： E 键事件通知， x 过期， e 淘汰
+NOTIFY_FLAGS = 'Exe'
+
+
+class PrefixIndex(object):
+    def __init__(self, prefixes=None):
+        self._prefixes = tuple(prefixes or ())
+
+    @property
+    def prefixes(self):
+        return self._prefixes
+
+    def register(self, *prefixes):
+        """
+        注册需要维护索引的前缀
+        :param prefixes: 前缀
+        :return:
+        """
+        for prefix in prefixes:
+            if prefix and prefix not in self._prefixes:
+                self._prefixes += (prefix,)
+
+    def unregister(self, *prefixes):
+        """
+        取消注册， 已有的索引集合需要自行删除
+        :param prefixes: 前缀
+        :return:
+        """
+        self._prefixes = tuple(p for p in self._prefixes if p not in prefixes)
+
+    def is_registered(self, prefix):
+        return prefix in self._prefixes
+
+    def match(self, name):
+        """
+        获取键匹配的已注册前缀
+        :param name: 键
+        :return: 前缀列表
+        """
+        if not self._prefixes:
+            return []
+        if isinstance(name, bytes):
+            name = name.decode('utf-8')
+        elif not isinstance(name, str):
+            name = str(name)
+        return [prefix for prefix in self._prefixes if name.startswith(prefix)]
+
+    @staticmethod
+    def index_key(prefix):
+        """
+        前缀索引集合键
+        :param prefix: 前缀
+        :return:
+        """
+        return 'prefix_index:%s' % prefix
+
+
+PrefixIndexes = PrefixIndex(getattr(settings, 'REDIS_PREFIX_INDEX', None))
+
+
+class PrefixIndexMaintainer(object):
+    """
+    前缀索引维护任务: 监听键过期/淘汰通知， 定期修复索引
+    """
+
+    def __init__(self, cache=None, index=None,
+                 repair_interval=settings.REDIS_PREFIX_INDEX_REPAIR_INTERVAL,
+                 batch_size=settings.REDIS_SCAN_COUNT):
+        self._cache = cache
+        self.index = index or PrefixIndexes
+        self.repair_interval = repair_interval
+        self.batch_size = batch_size
+        self._tasks = []
+        self._receiver = None
+        self._connection = None
+
+    @property
+    def cache(self):
+        if self._cache is None:
+            from caches.redis_utils import AsyncRedisCache
+            self._cache = AsyncRedisCache
+        return self._cache
+
+    async def repair(self, prefix, full=False):
+        """
+        修复前缀索引
+        :param prefix: 前缀
+        :param full: True 时额外全库SCAN补充缺失的键， 开销较大
+        :return: (移除数量, 补充数量)
+        """
+        index_key = self.index.index_key(prefix)
+        removed = added = 0
+        members = []
+        async for member in self.cache.sscan_iter(index_key, count=self.batch_size):
+            members.append(member)
+            if len(members) >= self.batch_size:
+                removed += await self._remove_missing(index_key, members)
+                members = []
+        if members:
+            removed += await self._remove_missing(index_key, members)
+
+        if full:
+            cursor = 0
+            while True:
+                cursor, names = await self.cache.db.scan(cursor=cursor, match='%s*' % prefix, count=self.batch_size)
+                if names:
+                    pipe = self.cache.pipeline
+                    await pipe.sadd(index_key, *names)
+                    added += (await pipe.execute())[0]
+                if not cursor:
+                    break
+        return removed, added
+
+    async def _remove_missing(self, index_key, members):
+        pipe = self.cache.pipeline
+        for member in members:
+            await pipe.exists(member)
+        missing = [member for member, existed in zip(members, await pipe.execute()) if not existed]
+        if missing:
+            pipe = self.cache.pipeline
+            await pipe.srem(index_key, *missing)
+            await pipe.execute()
+        return len(missing)
+
+    async def repair_all(self, full=False):
+        """
+        修复所有已注册前缀的索引
+        :param full: True 时额外全库SCAN补充缺失的键
+        :return:
+        """
+        for prefix in self.index.prefixes:
+            try:
+                await self.repair(prefix, full)
+            except Exception as e:
+                logger.error('[prefix_index][%s]%s' % (prefix, e))
+
+    async def _on_removed(self, name):
+        prefixes = self.index.match(name)
+        if prefixes:
+            pipe = self.cache.pipeline
+            for prefix in prefixes:
+                await pipe.srem(self.index.index_key(prefix), name)
+            await pipe.execute()
+
+    async def _ensure_notify_flags(self):
+        """
+        在服务端已有的 notify-keyspace-events 上追加需要的标志， 不覆盖其他订阅方需要的标志
+        :return:
+        """
+        current = (await self._connection.config_get('notify-keyspace-events')).get('notify-keyspace-events') or ''
+        if isinstance(current, bytes):
+            current = current.decode('utf-8')
+        # A 为 g$lshzxet 的别名， 包含 x(过期)和 e(淘汰)
+        present = set(current) | (set('g$lshzxet') if 'A' in current else set())
+        missing = ''.join(flag for flag in NOTIFY_FLAGS if flag not in present)
+        if missing:
+            await self._connection.config_set('notify-keyspace-events', current + missing)
+
+    async def _listen(self):
+        from aioredis.pubsub import Receiver
+
+        try:
+            self._connection = await self.cache.create_pubsub_connection()
+            if self._connection is None:
+                return
+            try:
+                await self._ensure_notify_flags()
+            except Exception as e:
+                # 托管Redis可能禁用CONFIG命令， 需在服务端配置 notify-keyspace-events(至少包含 Exe)
+                logger.error('[prefix_index]%s' % e)
+            db_index = settings.REDIS_DB_INDEX
+            self._receiver = Receiver()
+            await self._connection.subscribe(
+                self._receiver.channel('__keyevent@%s__:expired' % db_index),
+                self._receiver.channel('__keyevent@%s__:evicted' % db_index)
+            )
+        except Exception as e:
+            logger.error('[prefix_index]%s' % e)
+            return
+        async for _, name in self._receiver.iter():
+            try:
+                await self._on_removed(name)
+            except Exception as e:
+                logger.error('[prefix_index][%s]%s' % (name, e))
+
+    async def _run_repair(self):
+        while True:
+            await asyncio.sleep(self.repair_interval)
+            await self.repair_all()
+
+    async def start(self):
+        """
+        启动索引维护任务， 未注册前缀时不启动
+        :return:
+        """
+        if self._tasks or not self.index.prefixes:
+            return
+        await self.cache.setup()
+        self._tasks = [asyncio.ensure_future(self._listen()),
+                       asyncio.ensure_future(self._run_repair())]
+
+    async def stop(self):
+        """
+        停止索引维护任务
+        :return:
+        """
+        if self._receiver:
+            self._receiver.stop()
+            self._receiver = None
+        for task in self._tasks:
+            task.cancel()
+        for task in self._tasks:
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        self._tasks = []
+        if self._connection:
+            self._connection.close()
+            await self._connection.wait_closed()
+            self._connection = None
+
+
+PrefixIndexMaintenance = PrefixIndexMaintainer()
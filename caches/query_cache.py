@@ -0,0 +1,225 @@
+# !/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+数据库查询结果分布式缓存
+
+OPT_DISTRIBUTED_CACHED_ENABLE 启用时， meta 中设置 'distributed_cache': True 的 ModelBase 子类的查询集按 集合、查询条件、投影、排序、
+skip/limit 生成缓存键， 查询结果(原始文档)以BSON拼接并按需压缩后写入Redis。
+失效通过集合级缓存命名空间(query:<集合名>)的版本号实现： ModelBase.my_save/my_delete 及
+查询集的 update/delete/insert/modify 执行后递增版本号， 旧版本的缓存不再被访问。
+其他进程最迟在命名空间版本号本地缓存(REDIS_NAMESPACE_VERSION_TTL)过期后读取到新数据；
+直接调用 Document.save/update/delete 不会使缓存失效。
+因此缓存需要在模型中显式开启， 开启的模型应只通过 my_save/my_delete 或查询集写入。
+"""
+
+import hashlib
+import itertools
+import zlib
+
+import bson
+from bson.son import SON
+from mongoengine.queryset import QuerySet
+
+import settings
+from caches.redis_utils import RedisCache
+from commons import logging
+from commons.mongo_util import MongoDBConf
+
+logger = logging.get_logging()
+
+_RAW_FLAG = b'b'
+_COMPRESS_FLAG = b'z'
+
+
+def encode_docs(docs, compress_min_size=settings.OPT_DISTRIBUTED_CACHED_COMPRESS_MIN_SIZE):
+    """
+    编码原始文档列表
+    :param docs: 原始文档列表
+    :param compress_min_size: 达到该大小时压缩， 0：不压缩
+    :return: bytes
+    """
+    data = b''.join(bson.encode(doc) for doc in docs)
+    if compress_min_size and len(data) >= compress_min_size:
+        return _COMPRESS_FLAG + zlib.compress(data)
+    return _RAW_FLAG + data
+
+
+def decode_docs(data):
+    """
+    解码原始文档列表
+    :param data: encode_docs 编码的数据
+    :return: 原始文档列表
+    """
+    if data[:1] == _COMPRESS_FLAG:
+        return bson.decode_all(zlib.decompress(data[1:]))
+    return bson.decode_all(data[1:])
+
+
+def query_namespace(collection_name):
+    """
+    获取集合的查询缓存命名空间
+    :param collection_name: 集合名
+    :return:
+    """
+    return RedisCache.namespace('query:%s' % collection_name)
+
+
+def invalidate_collection(collection_name):
+    """
+    使集合的查询缓存失效
+    :param collection_name: 集合名
+    :return:
+    """
+    if not MongoDBConf().distributed_cached_enable:
+        return
+    try:
+        query_namespace(collection_name).invalidate()
+    except Exception as e:
+        logger.error('[query_cache][%s]%s' % (collection_name, e))
+
+
+class CachedQuerySet(QuerySet):
+    """
+    查询结果缓存到Redis的查询集
+    """
+
+    _raw_docs = None
+
+    def _cache_enabled(self):
+        return (MongoDBConf().distributed_cached_enable
+                and self._document._meta.get('distributed_cache', False)
+                and not self._where_clause
+                and not self._search_text)
+
+    def _cache_key(self):
+        """
+        由查询条件、投影、排序及skip/limit生成的缓存键
+        :return:
+        """
+        ordering = self._ordering
+        if ordering is None and self._document._meta['ordering']:
+            ordering = self._get_order_by(self._document._meta['ordering'])
+        spec = SON([
+            ('q', self._query),
+            ('p', self._cursor_args.get('projection')),
+            ('s', ordering or None),
+            ('k', self._skip),
+            ('l', self._limit),
+            ('h', self._hint if self._hint != -1 else None),
+            ('c', self._collation),
+        ])
+        return hashlib.sha1(bson.encode(spec)).hexdigest()
+
+    def _cache_name(self, suffix=''):
+        """
+        缓存物理键， 读写使用同一版本， 查询期间缓存失效时结果写入旧版本
+        :param suffix: 后缀
+        :return:
+        """
+        return query_namespace(self._document._get_collection_name()).key(self._cache_key() + suffix)
+
+    def _iter_raw_docs(self):
+        """
+        获取原始文档迭代器， 优先读取缓存
+        :return:
+        """
+        if not self._cache_enabled():
+            return self._cursor
+        try:
+            name = self._cache_name()
+            data = RedisCache.get(name)
+            if data is not None:
+                return iter(decode_docs(data))
+        except Exception as e:
+            logger.error('[query_cache]%s' % e)
+            return self._cursor
+
+        max_docs = settings.OPT_DISTRIBUTED_CACHED_MAX_DOCS
+        cursor = self._cursor
+        docs = list(itertools.islice(cursor, max_docs + 1))
+        if len(docs) > max_docs:
+            return itertools.chain(docs, cursor)
+        try:
+            RedisCache.set(name, encode_docs(docs), timeout=MongoDBConf().distributed_cached_timeout)
+        except Exception as e:
+            logger.error('[query_cache]%s' % e)
+        return iter(docs)
+
+    def __next__(self):
+        if self._none or self._empty:
+            raise StopIteration
+
+        if self._raw_docs is None:
+            self._raw_docs = self._iter_raw_docs()
+        raw_doc = next(self._raw_docs)
+
+        if self._as_pymongo:
+            return raw_doc
+
+        doc = self._document._from_son(
+            raw_doc,
+            _auto_dereference=self._auto_dereference,
+        )
+
+        if self._scalar:
+            return self._get_scalar(doc)
+
+        return doc
+
+    def __getitem__(self, key):
+        # 按下标读取转换为 skip/limit 查询， 使 first()/get() 同样命中缓存
+        if isinstance(key, int) and key >= 0 and self._cache_enabled():
+            if self._limit is not None and key >= self._limit:
+                raise IndexError('no such item for Cursor instance')
+            queryset = self.clone()
+            queryset._empty = False
+            queryset = queryset.skip((queryset._skip or 0) + key).limit(1)
+            for doc in queryset:
+                return doc
+            raise IndexError('no such item for Cursor instance')
+        return super(CachedQuerySet, self).__getitem__(key)
+
+    def rewind(self):
+        self._raw_docs = None
+        return super(CachedQuerySet, self).rewind()
+
+    def count(self, with_limit_and_skip=False):
+        if self._none or self._empty or not self._cache_enabled():
+            return super(CachedQuerySet, self).count(with_limit_and_skip)
+        try:
+            name = self._cache_name(':count:%d' % bool(with_limit_and_skip))
+            value = RedisCache.get(name)
+            if value is not None:
+                return int(value)
+        except Exception as e:
+            logger.error('[query_cache]%s' % e)
+            return super(CachedQuerySet, self).count(with_limit_and_skip)
+        value = super(CachedQuerySet, self).count(with_limit_and_skip)
+        try:
+            RedisCache.set(name, value, timeout=MongoDBConf().distributed_cached_timeout)
+        except Exception as e:
+            logger.error('[query_cache]%s' % e)
+        return value
+
+    def _invalidate(self):
+        invalidate_collection(self._document._get_collection_name())
+
+    def insert(self, *args, **kwargs):
+        result = super(CachedQuerySet, self).insert(*args, **kwargs)
+        self._invalidate()
+        return result
+
+    def update(self, *args, **kwargs):
+        result = super(CachedQuerySet, self).update(*args, **kwargs)
+        self._invalidate()
+        return result
+
+    def modify(self, *args, **kwargs):
+        result = super(CachedQuerySet, self).modify(*args, **kwargs)
+        self._invalidate()
+        return result
+
+    def delete(self, *args, **kwargs):
+        result = super(CachedQuerySet, self).delete(*args, **kwargs)
+        self._invalidate()
+        return result
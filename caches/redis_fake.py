@@ -60,7 +60,9 @@ class AsyncFakeStrictRedis(FakeStrictRedis, metaclass=AsyncMetaClass):
     hvals = AsyncCommand()
     hexists = AsyncCommand()
     hdel = AsyncCommand()
+    hincrby = AsyncCommand()
     hrange = AsyncCommand()
+    hscan = AsyncCommand()
     lpush = AsyncCommand()
     rpush = AsyncCommand()
     rpop = AsyncCommand()
@@ -77,10 +79,31 @@ class AsyncFakeStrictRedis(FakeStrictRedis, metaclass=AsyncMetaClass):
     sunionstore = AsyncCommand()
     sdiffstore = AsyncCommand()
     spop = AsyncCommand()
+    sscan = AsyncCommand()
+    zscan = AsyncCommand()
+    zadd = AsyncCommand()
+    zrem = AsyncCommand()
+    zcard = AsyncCommand()
+    zcount = AsyncCommand()
+    zrange = AsyncCommand()
+    zrevrange = AsyncCommand()
+    zrangebyscore = AsyncCommand()
+    zrevrangebyscore = AsyncCommand()
+    zremrangebyrank = AsyncCommand()
+    zremrangebyscore = AsyncCommand()
+    setbit = AsyncCommand()
+    getbit = AsyncCommand()
+    bitcount = AsyncCommand()
+    bitop = AsyncCommand()
+    scan = AsyncCommand()
+    scard = AsyncCommand()
     expire = AsyncCommand()
     expireat = AsyncCommand()
+    ttl = AsyncCommand()
     register_script = AsyncCommand()
+    eval = AsyncCommand()
     evalsha = AsyncCommand()
+    script_load = AsyncCommand()
     flushall = AsyncCommand()
 
     def pipeline(self, transaction=True, shard_hint=None):
@@ -96,11 +119,20 @@ class AsyncFakeStrictRedis(FakeStrictRedis, metaclass=AsyncMetaClass):
 class AsyncStrictPipeline(Pipeline, AsyncFakeStrictRedis, metaclass=AsyncMetaClass):
     watch = AsyncCommand()
     unwatch = AsyncCommand()
-    execute = AsyncCommand()
     load_script = AsyncCommand()
 
+    async def execute(self, raise_on_error=True, return_exceptions=None):
+        # 兼容异步管道的 return_exceptions 参数
+        if return_exceptions is not None:
+            raise_on_error = not return_exceptions
+        return Pipeline.execute(self, raise_on_error)
+
     async def __aenter__(self):
         return self
 
-    async def __aexit__(self, *args):
-        self.reset()
+    async def __aexit__(self, exc_type, exc, tb):
+        try:
+            if exc_type is None and self.command_stack:
+                await self.execute()
+        finally:
+            self.reset()
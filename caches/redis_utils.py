@@ -3,16 +3,34 @@
 import datetime
 import asyncio
 import functools
+import uuid
 
 from redis import StrictRedis, ConnectionPool
+from redis.client import Pipeline as SyncPipeline
 from aioredis import (
     create_pool as async_create_pool,
+    create_redis as async_create_redis,
     Redis as AioRedis
 )
+from aioredis.abc import AbcPool
 from aioredis.commands.transaction import Pipeline, MultiExec
+from aioredis.util import wait_convert
 
 import settings
-from caches.LuaManager import LuaDict
+from caches.LuaManager import LuaDict, slot_key, retry_noscript, async_retry_noscript
+from caches.prefix_index import PrefixIndexes
+
+# 集群管道不支持的多键写入命令
+_CLUSTER_PIPELINE_BLOCKED = ('mset', 'bitop')
+
+
+def _index_pairs(*names):
+    """
+    写入的键及其匹配的前缀索引集合
+    :param names: 键
+    :return: [(索引集合键, 键)]
+    """
+    return [(PrefixIndexes.index_key(prefix), name) for name in names for prefix in PrefixIndexes.match(name)]
 
 
 class _AioContext(object):
@@ -39,8 +57,109 @@ class _AioContext(object):
         return attr
 
 
-class _AioPipeline(_AioContext, Pipeline):
-    pass
+class _AioPipeline(Pipeline):
+    """
+    异步管道
+    命令只在本地缓冲， 不为每个命令创建任务； 调用 execute() 或退出上下文时，
+    缓冲的命令编码后一次写入连接， 结果按命令顺序返回。
+    缓冲命令数达到 max_buffer 时自动提交一批， 结果在 execute() 时一并返回。
+    """
+
+    def __init__(self, pool_or_conn, commands_factory, max_buffer=settings.REDIS_PIPELINE_MAX_BUFFER):
+        super(_AioPipeline, self).__init__(pool_or_conn, commands_factory)
+        self._max_buffer = max_buffer
+        self._flushed_results = []
+        # 管道中的脚本调用， 脚本不存在时重新执行
+        self.lua_calls = []
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        if exc_type is None and not self._done:
+            await self.execute()
+
+    def __getattr__(self, name):
+        assert not self._done, "Pipeline already executed. Create new one."
+        attr = getattr(self._redis, name)
+        if callable(attr):
+
+            @functools.wraps(attr)
+            async def wrapper(*args, **kw):
+                try:
+                    # 命令在调用时写入缓冲区， 返回的 future/协程留到提交时再等待
+                    result = attr(*args, **kw)
+                except Exception as exc:
+                    result = asyncio.get_event_loop().create_future()
+                    result.set_exception(exc)
+                self._results.append(result)
+                if self._max_buffer and len(self._pipeline) >= self._max_buffer:
+                    await self.flush()
+            return wrapper
+        return attr
+
+    def __len__(self):
+        return len(self._flushed_results) + len(self._results)
+
+    async def flush(self):
+        """
+        提交当前缓冲的命令， 结果暂存到 execute() 时返回
+        :return:
+        """
+        assert not self._done, "Pipeline already executed. Create new one."
+        self._flushed_results.extend(await self._execute_buffer())
+
+    async def _execute_buffer(self):
+        try:
+            if not self._pipeline:
+                return await self._gather_result(True)
+            if isinstance(self._pool_or_conn, AbcPool):
+                async with self._pool_or_conn.get() as conn:
+                    return await self._do_execute(conn, return_exceptions=True)
+            return await self._do_execute(self._pool_or_conn, return_exceptions=True)
+        finally:
+            # _RedisBuffer 持有同一个列表， 只能原地清空
+            del self._pipeline[:]
+            self._results = []
+
+    async def execute(self, *, return_exceptions=False):
+        """
+        提交所有缓冲的命令
+        :param return_exceptions: True 时异常作为结果返回， 否则抛出 PipelineError
+        :return: 结果列表， 与命令顺序对应
+        """
+        assert not self._done, "Pipeline already executed. Create new one."
+        self._done = True
+        results = self._flushed_results + await self._execute_buffer()
+        self._flushed_results = []
+        if self.lua_calls:
+            await async_retry_noscript(self.lua_calls, results)
+        if not return_exceptions:
+            errors = [result for result in results if isinstance(result, Exception)]
+            if errors:
+                raise self.error_class(errors)
+        return results
+
+
+class _ScriptPipeline(SyncPipeline):
+    """
+    同步管道， 其中的脚本因Redis重启或 SCRIPT FLUSH 不存在时重新加载并单独执行
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(_ScriptPipeline, self).__init__(*args, **kwargs)
+        self.lua_calls = []
+
+    def execute(self, raise_on_error=True):
+        calls, self.lua_calls = self.lua_calls, []
+        if not calls:
+            return super(_ScriptPipeline, self).execute(raise_on_error)
+        results = retry_noscript(calls, super(_ScriptPipeline, self).execute(False))
+        if raise_on_error:
+            for result in results:
+                if isinstance(result, Exception):
+                    raise result
+        return results
 
 
 class _AioMultiExec(_AioContext, MultiExec):
@@ -62,6 +181,96 @@ class _AioMultiExec(_AioContext, MultiExec):
         pass
 
 
+class _AioRedis(AioRedis):
+    """
+    aioredis 命令适配为 redis-py 的参数形式
+    """
+
+    def set(self, key, value, ex=None, px=None, nx=None, xx=None):
+        exist = None
+        if nx:
+            exist = self.SET_IF_NOT_EXIST
+        elif xx:
+            exist = self.SET_IF_EXIST
+        return super(_AioRedis, self).set(key, value,
+                                          expire=ex or 0,
+                                          pexpire=px or 0,
+                                          exist=exist)
+
+    def incr(self, key, increment=1):
+        return super(_AioRedis, self).incrby(key, increment)
+
+    def pipeline(self, is_transaction=False, watches=None, shard_hint=None,
+                 max_buffer=settings.REDIS_PIPELINE_MAX_BUFFER):
+        if is_transaction:
+            return _AioMultiExec(self, watches=watches)
+        else:
+            return _AioPipeline(self._pool_or_conn, self.__class__, max_buffer=max_buffer)
+
+    def hmset(self, key, kv_dict):
+        pairs = []
+        for k, v in kv_dict.items():
+            pairs.append(k)
+            pairs.append(v)
+        return super(_AioRedis, self).hmset(key, *pairs)
+
+    def hmget(self, key, fields):
+        return super(_AioRedis, self).hmget(key, *fields)
+
+    def mget(self, keys, *args):
+        if isinstance(keys, (list, tuple)):
+            return super(_AioRedis, self).mget(*keys, *args)
+        return super(_AioRedis, self).mget(keys, *args)
+
+    def zrangebyscore(self, name, min, max, start=None, num=None, withscores=False):
+        return super(_AioRedis, self).zrangebyscore(
+            name, min, max, withscores=withscores, offset=start, count=num
+        )
+
+    def zrevrangebyscore(self, name, max, min, start=None, num=None, withscores=False):
+        return super(_AioRedis, self).zrevrangebyscore(
+            name, max, min, withscores=withscores, offset=start, count=num
+        )
+
+    def zadd(self, name, mapping):
+        pairs = []
+        for member, score in mapping.items():
+            pairs.append(score)
+            pairs.append(member)
+        return super(_AioRedis, self).zadd(name, *pairs)
+
+    def zrange(self, name, start, end, desc=False, withscores=False):
+        if desc:
+            return self.zrevrange(name, start, end, withscores)
+        return super(_AioRedis, self).zrange(name, start, end, withscores)
+
+    def hscan(self, name, cursor=0, match=None, count=None):
+        return wait_convert(
+            super(_AioRedis, self).hscan(name, cursor=cursor, match=match, count=count),
+            lambda result: (result[0], dict(result[1]))
+        )
+
+    def eval(self, script, numkeys, *keys_and_args):
+        return super(_AioRedis, self).eval(
+            script, keys=list(keys_and_args[:numkeys]), args=list(keys_and_args[numkeys:]))
+
+    def evalsha(self, sha, numkeys, *keys_and_args):
+        return super(_AioRedis, self).evalsha(
+            sha, keys=list(keys_and_args[:numkeys]), args=list(keys_and_args[numkeys:]))
+
+    def bitop(self, operation, dest, *keys):
+        operation = operation.upper()
+        if operation == 'AND':
+            return self.bitop_and(dest, *keys)
+        elif operation == 'OR':
+            return self.bitop_or(dest, *keys)
+        elif operation == 'XOR':
+            return self.bitop_xor(dest, *keys)
+        elif operation == 'NOT':
+            return self.bitop_not(dest, *keys)
+        raise ValueError('Unsupported bitop operation: %s' % operation)
+
+
 class AIORedisDB(object):
     def __init__(self):
         self.__redis = None
@@ -75,69 +284,44 @@ class AIORedisDB(object):
 
     async def setup(self):
         if not self.__redis:
-            class _AioRedis(AioRedis):
-                def set(self, key, value, ex=None, px=None, nx=None, xx=None):
-                    exist = None
-                    if nx:
-                        exist = self.SET_IF_NOT_EXIST
-                    elif xx:
-                        exist = self.SET_IF_EXIST
-                    return super(_AioRedis, self).set(key, value,
-                                                      expire=ex or 0,
-                                                      pexpire=px or 0,
-                                                      exist=exist)
-
-                def incr(self, key, increment=1):
-                    return super(_AioRedis, self).incrby(key, increment)
-
-                def pipeline(self, is_transaction=False, watches=None, shard_hint=None):
-                    if is_transaction:
-                        return _AioMultiExec(self, watches=watches)
-                    else:
-                        return _AioPipeline(self._pool_or_conn, self.__class__)
-
-                def hmset(self, key, kv_dict):
-                    pairs = []
-                    for k, v in kv_dict.items():
-                        pairs.append(k)
-                        pairs.append(v)
-                    return super(_AioRedis, self).hmset(key, *pairs)
-
-                def hmget(self, key, fields):
-                    return super(_AioRedis, self).hmget(key, *fields)
-
-                def zrangebyscore(self, name, min, max, start=None, num=None, withscores=False):
-                    return super(_AioRedis, self).zrangebyscore(
-                        name, min, max, withscores=withscores, offset=start, count=num
-                    )
-
-                def zrange(self, name, start, end, desc=False, withscores=False):
-                    if desc:
-                        return self.zrevrange(name, start, end, withscores)
-                    return super(_AioRedis, self).zrange(name, start, end, withscores)
-
             if hasattr(settings, 'REDIS_MOCK'):
                 if settings.REDIS_MOCK:
                     from .redis_fake import AsyncFakeStrictRedis
                     self.__redis = AsyncFakeStrictRedis(
                         db=self._db_index, **settings.REDIS_OPTIONS)
+                    self.LuaDict = {key: redis_lua(self.__redis)
+                                    for key, redis_lua in LuaDict.items()}
                     return self.__redis
 
-            default_node = self._startup_nodes[0]
-            if not default_node:
-                raise ValueError('Redis server node not specified.')
-            host, port = default_node.split(':')
-            if not host:
-                raise ValueError('Redis server host not specified.')
-            if not port:
-                port = 6379
-            password = settings.REDIS_PASSWORD
             connection_pool = await async_create_pool(
-                (host, port), db=self._db_index, password=password)
+                self._get_address(), db=self._db_index, password=settings.REDIS_PASSWORD)
             self.__redis = _AioRedis(connection_pool)
+            self.LuaDict = {key: redis_lua(self.__redis)
+                            for key, redis_lua in LuaDict.items()}
 
         return self.__redis
 
+    def _get_address(self):
+        default_node = self._startup_nodes[0]
+        if not default_node:
+            raise ValueError('Redis server node not specified.')
+        host, port = default_node.split(':')
+        if not host:
+            raise ValueError('Redis server host not specified.')
+        if not port:
+            port = 6379
+        return host, port
+
+    async def create_pubsub_connection(self):
+        """
+        创建独立的订阅连接， 模拟模式下不支持订阅， 返回None
+        :return:
+        """
+        if getattr(settings, 'REDIS_MOCK', False):
+            return None
+        return await async_create_redis(
+            self._get_address(), db=self._db_index, password=settings.REDIS_PASSWORD)
+
     @property
     def __rc(self):
         return self.__redis
@@ -164,21 +348,68 @@ class AIORedisDB(object):
         """
         return self.__rc.pipeline(True, watches=watches, shard_hint=shard_hint)
 
-    async def set(self, name, value=None, timeout=settings.REDIS_CACHED_TIMEOUT, existed=None):
+    def namespace(self, name, version_ttl=settings.REDIS_NAMESPACE_VERSION_TTL):
+        """
+        获取缓存命名空间， 通过版本号实现命名空间下所有键的批量失效
+        :param name: 命名空间名称
+        :param version_ttl: 版本号本地缓存时间(单位：秒)
+        :return:
+        """
+        from caches.namespace import AsyncCacheNamespace
+        return AsyncCacheNamespace(name, self, version_ttl)
+
+    def timeline(self, name, max_length=settings.TIMELINE_MAX_LENGTH, max_age=settings.TIMELINE_MAX_AGE):
+        """
+        获取有界时间线， 写入时按数量和时间窗口自动裁剪
+        :param name: 时间线名称
+        :param max_length: 最大长度， 0：不限
+        :param max_age: 最长保留时间(单位：秒)， 0：不限
+        :return:
+        """
+        from caches.timeline import AsyncTimeline
+        return AsyncTimeline(name, self, max_length, max_age)
+
+    async def set(self, name, value=None, timeout=settings.REDIS_CACHED_TIMEOUT, existed=None, tags=None):
         """
         设置值
         :param name: 键
         :param value: 值
         :param timeout: 超时时间，None 时永不超时
         :param existed: True 已存在时设置， False 不存在时设置， None 所有情况下设置
+        :param tags: 标签列表， 任一标签失效(invalidate_tags)时删除该键
         :return:
         """
+        # existed=True 时键已存在， 已在前缀索引中
+        prefixes = PrefixIndexes.match(name) if existed is not True else []
+        rc = self.__rc
+        if tags or prefixes:
+            rc = self.pipeline
         if existed is None:
-            await self.__rc.set(name, value, ex=timeout)
+            await rc.set(name, value, ex=timeout)
         elif existed is False:
-            await self.__rc.set(name, value, ex=timeout, nx=True)
+            await rc.set(name, value, ex=timeout, nx=True)
         elif existed is True:
-            await self.__rc.set(name, value, ex=timeout, xx=True)
+            await rc.set(name, value, ex=timeout, xx=True)
+        for prefix in prefixes:
+            await rc.sadd(PrefixIndexes.index_key(prefix), name)
+        if tags and not settings.REDIS_CLUSTER:
+            for tag in tags:
+                await self.LuaDict['TAG_ADD_LUA'].async_run_script([self.tag_key(tag)], [timeout or 0, name], client=rc)
+        if tags or prefixes:
+            await rc.execute()
+        if tags and settings.REDIS_CLUSTER:
+            # 与同步客户端一致， 标签集合与键通常不在同一slot， 逐个执行
+            for tag in tags:
+                await self.LuaDict['TAG_ADD_LUA'].async_run_script([self.tag_key(tag)], [timeout or 0, name])
+
+    @staticmethod
+    def tag_key(tag):
+        """
+        标签集合键
+        :param tag: 标签
+        :return:
+        """
+        return 'tag:%s' % tag
 
     async def setnx(self, name, value=None, timeout=settings.REDIS_CACHED_TIMEOUT):
         """
@@ -191,7 +422,16 @@ class AIORedisDB(object):
         """
         if value is None:
             value = ''
-        if 0 == await self.__rc.set(name, value, ex=timeout, nx=True):
+        prefixes = PrefixIndexes.match(name)
+        if prefixes:
+            pipe = self.pipeline
+            await pipe.set(name, value, ex=timeout, nx=True)
+            for prefix in prefixes:
+                await pipe.sadd(PrefixIndexes.index_key(prefix), name)
+            result = (await pipe.execute())[0]
+        else:
+            result = await self.__rc.set(name, value, ex=timeout, nx=True)
+        if not result:
             return False
         return True
 
@@ -217,7 +457,82 @@ class AIORedisDB(object):
         :param name: 键
         :return:
         """
-        await self.__rc.delete(name)
+        prefixes = PrefixIndexes.match(name)
+        if prefixes:
+            pipe = self.pipeline
+            await pipe.delete(name)
+            for prefix in prefixes:
+                await pipe.srem(PrefixIndexes.index_key(prefix), name)
+            await pipe.execute()
+        else:
+            await self.__rc.delete(name)
+
+    async def release_lock(self, name, token):
+        """
+        释放锁， 仅当锁仍由token持有时删除， 锁已超时并被其他调用方获取时不删除
+        :param name: 锁键
+        :param token: 获取锁时写入的值
+        :return: 是否已释放
+        """
+        result = await self.LuaDict['DELETE_IF_EQUAL_LUA'].async_run_script([name], [token])
+        if result:
+            for prefix in PrefixIndexes.match(name):
+                await self.__rc.srem(PrefixIndexes.index_key(prefix), name)
+        return result == 1
+
+    async def _write_indexed(self, names, command, *args, **kwargs):
+        """
+        执行写入命令， 写入的键加入匹配的前缀索引； SADD 与写入命令在同一管道中， 一次往返
+        :param names: 写入的键
+        :param command: 写入命令名称
+        :param args: 命令参数
+        :param kwargs: 命令参数
+        :return: 写入命令的结果
+        """
+        pairs = _index_pairs(*names)
+        if not pairs:
+            return await getattr(self.__rc, command)(*args, **kwargs)
+        pipe = self.pipeline
+        await getattr(pipe, command)(*args, **kwargs)
+        for index_key, name in pairs:
+            await pipe.sadd(index_key, name)
+        return (await pipe.execute())[0]
+
+    async def count_keys(self, prefix):
+        """
+        统计前缀下键的数量， 已注册索引的前缀为O(1)， 否则全库扫描
+        :param prefix: 前缀
+        :return:
+        """
+        if PrefixIndexes.is_registered(prefix):
+            return await self.__rc.scard(PrefixIndexes.index_key(prefix))
+        return await self.run_script('COUNT_KEY_WITH_PREFIX_LUA', ['%s*' % prefix], [])
+
+    async def invalidate_tags(self, *tags):
+        """
+        删除标签关联的所有键
+        :param tags: 标签
+        :return: 删除的键数量
+        """
+        if not tags:
+            return 0
+        tag_keys = [self.tag_key(tag) for tag in tags]
+        if not settings.REDIS_CLUSTER:
+            return await self.LuaDict['INVALIDATE_TAGS_LUA'].async_run_script(tag_keys, [])
+        # 集群模式下缓存键分布在不同的slot， 分两次管道完成: 读取标签集合、 逐键删除
+        pipe = self.pipeline
+        for tag_key in tag_keys:
+            await pipe.smembers(tag_key)
+        names = set()
+        for members in await pipe.execute():
+            names.update(members)
+        pipe = self.pipeline
+        for name in names:
+            await pipe.delete(name)
+        for tag_key in tag_keys:
+            await pipe.delete(tag_key)
+        results = await pipe.execute()
+        return sum(results[:len(names)])
 
     async def incr(self, name, amount=1):
         """
@@ -226,7 +541,7 @@ class AIORedisDB(object):
         :param amount: 步长
         :return:
         """
-        return await self.__rc.incr(name, amount)
+        return await self._write_indexed([name], 'incr', name, amount)
 
     async def mset(self, **kwargs):
         """
@@ -234,7 +549,7 @@ class AIORedisDB(object):
         :param kwargs: 参数列表（key-value）
         :return:
         """
-        await self.__rc.mset(**kwargs)
+        await self._write_indexed(list(kwargs), 'mset', **kwargs)
 
     async def mget(self, names):
         """
@@ -252,7 +567,7 @@ class AIORedisDB(object):
         :param value: 值
         :return:
         """
-        await self.__rc.hset(name, key, value)
+        await self._write_indexed([name], 'hset', name, key, value)
 
     async def hget(self, name, key):
         """
@@ -270,7 +585,7 @@ class AIORedisDB(object):
         :param kv_dict: 值(dict)
         :return:
         """
-        await self.__rc.hmset(name, kv_dict)
+        await self._write_indexed([name], 'hmset', name, kv_dict)
 
     async def hmget(self, name, keys):
         """
@@ -348,7 +663,7 @@ class AIORedisDB(object):
         :param vals: 多个值
         :return:
         """
-        await self.__rc.lpush(name, *vals)
+        await self._write_indexed([name], 'lpush', name, *vals)
 
     async def rpush(self, name, *values):
         """
@@ -357,7 +672,7 @@ class AIORedisDB(object):
         :param values:
         :return:
         """
-        await self.__rc.rpush(name, *values)
+        await self._write_indexed([name], 'rpush', name, *values)
 
     async def rpop(self, name):
         """
@@ -392,7 +707,7 @@ class AIORedisDB(object):
         :param vals: 多个值
         :return:
         """
-        await self.__rc.sadd(name, vals)
+        await self._write_indexed([name], 'sadd', name, vals)
 
     async def slen(self, name):
         """
@@ -410,6 +725,89 @@ class AIORedisDB(object):
         """
         return await self.__rc.smembers(name)
 
+    async def hscan_iter(self, name, match=None, count=settings.REDIS_SCAN_COUNT):
+        """
+        基于HSCAN分页迭代dict形式所有的值， 不一次性加载
+        :param name: 键
+        :param match: 值键匹配模式
+        :param count: 每页数量
+        :return: 异步迭代器，元素为(值键, 值)
+        """
+        cursor = 0
+        while True:
+            cursor, data = await self.__rc.hscan(name, cursor=cursor, match=match, count=count)
+            for item in data.items():
+                yield item
+            if not cursor:
+                break
+
+    async def sscan_iter(self, name, match=None, count=settings.REDIS_SCAN_COUNT):
+        """
+        基于SSCAN分页迭代集合所有成员
+        :param name: 键
+        :param match: 成员匹配模式
+        :param count: 每页数量
+        :return: 异步迭代器，元素为成员
+        """
+        cursor = 0
+        while True:
+            cursor, data = await self.__rc.sscan(name, cursor=cursor, match=match, count=count)
+            for item in data:
+                yield item
+            if not cursor:
+                break
+
+    async def zscan_iter(self, name, match=None, count=settings.REDIS_SCAN_COUNT):
+        """
+        基于ZSCAN分页迭代有序集合所有成员
+        :param name: 键
+        :param match: 成员匹配模式
+        :param count: 每页数量
+        :return: 异步迭代器，元素为(成员, 分数)
+        """
+        cursor = 0
+        while True:
+            cursor, data = await self.__rc.zscan(name, cursor=cursor, match=match, count=count)
+            for item in data:
+                yield item
+            if not cursor:
+                break
+
+    async def lrange_iter(self, name, count=settings.REDIS_SCAN_COUNT):
+        """
+        分段LRANGE迭代list所有元素
+        :param name: 键
+        :param count: 每页数量
+        :return: 异步迭代器，元素为列表值
+        """
+        start = 0
+        while True:
+            data = await self.__rc.lrange(name, start, start + count - 1)
+            for item in data:
+                yield item
+            if len(data) < count:
+                break
+            start += count
+
+    async def iter_prefix_keys(self, prefix, count=settings.REDIS_SCAN_COUNT):
+        """
+        迭代前缀下所有的键， 已注册索引的前缀基于SSCAN， 否则全库SCAN
+        :param prefix: 前缀
+        :param count: 每页数量
+        :return: 异步迭代器，元素为键
+        """
+        if PrefixIndexes.is_registered(prefix):
+            async for name in self.sscan_iter(PrefixIndexes.index_key(prefix), count=count):
+                yield name
+        else:
+            cursor = 0
+            while True:
+                cursor, names = await self.__rc.scan(cursor=cursor, match='%s*' % prefix, count=count)
+                for name in names:
+                    yield name
+                if not cursor:
+                    break
+
     async def sismember(self, name, value):
         """
         判断值是否存在与集合中
@@ -427,6 +825,77 @@ class AIORedisDB(object):
         """
         await self.__rc.spop(name)
 
+    async def setbit(self, name, offset: int, value=1):
+        """
+        设置位图指定偏移量的值
+        :param name: 键
+        :param offset: 偏移量(整数ID)
+        :param value: 1 或 0
+        :return: 偏移量原来的值
+        """
+        return await self._write_indexed([name], 'setbit', name, offset, 1 if value else 0)
+
+    async def getbit(self, name, offset: int):
+        """
+        获取位图指定偏移量的值
+        :param name: 键
+        :param offset: 偏移量(整数ID)
+        :return: 1 或 0
+        """
+        return await self.__rc.getbit(name, offset)
+
+    async def setbits(self, name, offsets, value=1):
+        """
+        批量设置位图偏移量的值， 一次往返完成
+        :param name: 键
+        :param offsets: 偏移量列表
+        :param value: 1 或 0
+        :return: 各偏移量原来的值列表，与参数顺序对应
+        """
+        if not offsets:
+            return []
+        value = 1 if value else 0
+        pipe = self.pipeline
+        for offset in offsets:
+            await pipe.setbit(name, offset, value)
+        for index_key, _ in _index_pairs(name):
+            await pipe.sadd(index_key, name)
+        return (await pipe.execute())[:len(offsets)]
+
+    async def getbits(self, name, offsets):
+        """
+        批量测试位图偏移量的值， 一次往返完成
+        :param name: 键
+        :param offsets: 偏移量列表
+        :return: 各偏移量的值列表(1 或 0)，与参数顺序对应
+        """
+        if not offsets:
+            return []
+        pipe = self.pipeline
+        for offset in offsets:
+            await pipe.getbit(name, offset)
+        return await pipe.execute()
+
+    async def bitcount(self, name, start=None, end=None):
+        """
+        统计位图中值为1的数量
+        :param name: 键
+        :param start: 起始字节位置， 与end同时指定
+        :param end: 结束字节位置， 与start同时指定
+        :return:
+        """
+        return await self.__rc.bitcount(name, start, end)
+
+    async def bitop(self, operation, dest, *names):
+        """
+        多个位图之间的位运算， 结果保存到dest
+        :param operation: AND|OR|XOR|NOT
+        :param dest: 结果键
+        :param names: 参与运算的键
+        :return: 结果位图的字节长度
+        """
+        return await self._write_indexed([dest], 'bitop', operation, dest, *names)
+
     async def set_expire(self, name, seconds: int = settings.REDIS_CACHED_TIMEOUT):
         """
         设置健超时时长
@@ -435,7 +904,15 @@ class AIORedisDB(object):
         :return:
         """
         if name and seconds:
-            return await self.__rc.expire(name, seconds)
+            # 负数超时立即删除键， SREM 与 EXPIRE 在同一管道中
+            pairs = _index_pairs(name) if seconds < 0 else []
+            if not pairs:
+                return await self.__rc.expire(name, seconds)
+            pipe = self.pipeline
+            await pipe.expire(name, seconds)
+            for index_key, _ in pairs:
+                await pipe.srem(index_key, name)
+            return (await pipe.execute())[0]
 
     async def set_expire_dt(self, name, dt: datetime.datetime):
         """
@@ -448,6 +925,153 @@ class AIORedisDB(object):
             if dt > datetime.datetime.now():
                 return await self.__rc.expireat(name, dt)
 
+    async def ttl(self, name):
+        """
+        获取健剩余超时时长
+        :param name:
+        :return: 剩余秒数， -1: 永不超时， -2: 健不存在
+        """
+        return await self.__rc.ttl(name)
+
+    async def get_expire(self, name, seconds: int = settings.REDIS_CACHED_TIMEOUT, pipe=None):
+        """
+        获取值并顺延过期时间(滑动过期)， 一次往返
+        :param name: 键
+        :param seconds: 过期时间(秒)
+        :param pipe: 管道， 指定时命令加入管道， 结果在管道执行结果中
+        :return: 值
+        """
+        return await self.LuaDict['GET_EXPIRE_LUA'].async_run_script([name], [seconds], client=pipe)
+
+    @staticmethod
+    def loading_key(name):
+        """
+        加载锁键， 与name位于同一slot
+        :param name: 键
+        :return:
+        """
+        return slot_key(name, 'loading')
+
+    async def get_or_mark_loading(self, name, lock_timeout: int = settings.REDIS_LOADING_TIMEOUT, pipe=None):
+        """
+        获取值， 不存在时抢占加载锁， 一次往返
+        获得加载锁的调用方加载数据后调用 set_loaded 写入并以令牌释放锁
+        :param name: 键
+        :param lock_timeout: 加载锁超时时间(秒)
+        :param pipe: 管道， 指定时命令加入管道， 结果在管道执行结果中(未经转换， [0] 表示获得加载锁)
+        :return: (值, 加载锁令牌)， 令牌不为None时由调用方加载， 其他调用方正在加载时返回 (None, None)；
+                 指定管道时返回本次使用的令牌
+        """
+        token = uuid.uuid4().hex
+        result = await self.LuaDict['GET_OR_LOADING_LUA'].async_run_script(
+            [name, self.loading_key(name)], [lock_timeout, token], client=pipe)
+        if pipe is not None:
+            return token
+        if result[0] == 2:
+            return result[1], None
+        return None, token if result[0] == 0 else None
+
+    async def set_loaded(self, name, value, token, timeout=settings.REDIS_CACHED_TIMEOUT):
+        """
+        写入加载的值并释放加载锁， 一次往返； 加载锁已超时并被其他调用方获取时不删除
+        :param name: 键
+        :param value: 值
+        :param token: get_or_mark_loading 返回的加载锁令牌
+        :param timeout: 超时时间，None 时永不超时
+        :return: 是否已释放加载锁
+        """
+        pipe = self.pipeline
+        await pipe.set(name, value, ex=timeout)
+        await self.LuaDict['DELETE_IF_EQUAL_LUA'].async_run_script([self.loading_key(name)], [token], client=pipe)
+        for index_key, _ in _index_pairs(name):
+            await pipe.sadd(index_key, name)
+        return (await pipe.execute())[1] == 1
+
+    async def hincr_capped(self, name, key, amount: int = 1, cap: int = 0, timeout: int = 0, pipe=None):
+        """
+        dict形式值自增， 超过上限时不自增， 一次往返
+        :param name: 键
+        :param key: 值键
+        :param amount: 步长
+        :param cap: 上限
+        :param timeout: 过期时间(秒)， 仅在键未设置过期时间时设置， 0: 不设置
+        :param pipe: 管道， 指定时命令加入管道， 结果在管道执行结果中(未经转换)
+        :return: (是否自增, 当前值)
+        """
+        result = await self.LuaDict['HINCR_CAP_LUA'].async_run_script([name], [key, amount, cap, timeout], client=pipe)
+        if pipe is not None:
+            return result
+        return result[0] == 1, int(result[1])
+
+    async def set_if_version_greater(self, name, value, version: int, timeout=settings.REDIS_CACHED_TIMEOUT, pipe=None):
+        """
+        版本号大于当前版本号时设置值， 一次往返
+        :param name: 键
+        :param value: 值
+        :param version: 版本号
+        :param timeout: 超时时间，None 时永不超时
+        :param pipe: 管道， 指定时命令加入管道， 结果在管道执行结果中(未经转换)
+        :return: 是否已设置
+        """
+        result = await self.LuaDict['SET_IF_VERSION_GREATER_LUA'].async_run_script(
+            [name, slot_key(name, 'version')], [value, version, timeout or 0], client=pipe)
+        if pipe is not None:
+            return result
+        return result == 1
+
+    @staticmethod
+    def generation_key(name):
+        """
+        代数键， 与name位于同一slot
+        :param name: 键
+        :return:
+        """
+        return slot_key(name, 'generation')
+
+    async def bump_generation(self, name, timeout=settings.REDIS_CACHED_TIMEOUT, pipe=None):
+        """
+        删除值并递增代数， 之前读取的代数无法再回填
+        :param name: 键
+        :param timeout: 代数键超时时间，None 时永不超时
+        :param pipe: 管道， 指定时命令加入管道， 由调用方执行
+        :return:
+        """
+        client = pipe if pipe is not None else self.pipeline
+        generation_key = self.generation_key(name)
+        await client.incr(generation_key)
+        if timeout:
+            await client.expire(generation_key, timeout)
+        await client.delete(name)
+        if pipe is None:
+            await client.execute()
+
+    async def set_if_generation(self, name, value, generation, timeout=settings.REDIS_CACHED_TIMEOUT, pipe=None):
+        """
+        代数未变化时设置值， 一次往返
+        :param name: 键
+        :param value: 值
+        :param generation: 读取数据前 generation_key 的值， 不存在时为None
+        :param timeout: 超时时间，None 时永不超时
+        :param pipe: 管道， 指定时命令加入管道， 结果在管道执行结果中(未经转换)
+        :return: 是否已设置
+        """
+        result = await self.LuaDict['SET_IF_GENERATION_LUA'].async_run_script(
+            [name, self.generation_key(name)], [value, generation or '', timeout or 0], client=pipe)
+        if pipe is not None:
+            return result
+        return result == 1
+
+    async def pop_n(self, name, count: int, right=False, pipe=None):
+        """
+        从列表弹出多个元素， 一次往返
+        :param name: 键
+        :param count: 数量
+        :param right: True 从右侧弹出(顺序同多次rpop)， False 从左侧弹出
+        :param pipe: 管道， 指定时命令加入管道， 结果在管道执行结果中
+        :return: 元素列表
+        """
+        return await self.LuaDict['POP_N_LUA'].async_run_script([name], [count, 1 if right else 0], client=pipe)
+
     async def register_script(self, script):
         return await self.db.register_script(script)
 
@@ -463,7 +1087,7 @@ class AIORedisDB(object):
         :return:
         """
         if script_name in self.LuaDict:
-            return await self.LuaDict[script_name].run_script(keys, args)
+            return await self.LuaDict[script_name].async_run_script(keys, args)
         else:
             raise Exception(u"暂时未定义该脚本")
 
@@ -542,7 +1166,11 @@ class RedisDB(object):
         :param shard_hint:
         :return:
         """
-        return self.__rc.pipeline()
+        rc = self.__rc
+        if self._cluster:
+            # 集群管道不支持脚本(EVALSHA)
+            return rc.pipeline()
+        return _ScriptPipeline(rc.connection_pool, rc.response_callbacks, True, None)
 
     def transaction(self, watches=None, shard_hint=None):
         """
@@ -552,21 +1180,68 @@ class RedisDB(object):
         """
         return self.__rc.pipeline(True, watches=watches, shard_hint=shard_hint)
 
-    def set(self, name, value=None, timeout=settings.REDIS_CACHED_TIMEOUT, existed=None):
+    def namespace(self, name, version_ttl=settings.REDIS_NAMESPACE_VERSION_TTL):
+        """
+        获取缓存命名空间， 通过版本号实现命名空间下所有键的批量失效
+        :param name: 命名空间名称
+        :param version_ttl: 版本号本地缓存时间(单位：秒)
+        :return:
+        """
+        from caches.namespace import CacheNamespace
+        return CacheNamespace(name, self, version_ttl)
+
+    def timeline(self, name, max_length=settings.TIMELINE_MAX_LENGTH, max_age=settings.TIMELINE_MAX_AGE):
+        """
+        获取有界时间线， 写入时按数量和时间窗口自动裁剪
+        :param name: 时间线名称
+        :param max_length: 最大长度， 0：不限
+        :param max_age: 最长保留时间(单位：秒)， 0：不限
+        :return:
+        """
+        from caches.timeline import Timeline
+        return Timeline(name, self, max_length, max_age)
+
+    def set(self, name, value=None, timeout=settings.REDIS_CACHED_TIMEOUT, existed=None, tags=None):
         """
         设置值
         :param name: 键
         :param value: 值
         :param timeout: 超时时间，None 时永不超时
         :param existed: True 已存在时设置， False 不存在时设置， None 所有情况下设置
+        :param tags: 标签列表， 任一标签失效(invalidate_tags)时删除该键
         :return:
         """
+        # existed=True 时键已存在， 已在前缀索引中
+        prefixes = PrefixIndexes.match(name) if existed is not True else []
+        rc = self.__rc
+        if tags or prefixes:
+            rc = self.pipeline
         if existed is None:
-            self.__rc.set(name, value, ex=timeout)
+            rc.set(name, value, ex=timeout)
         elif existed is False:
-            self.__rc.set(name, value, ex=timeout, nx=True)
+            rc.set(name, value, ex=timeout, nx=True)
         elif existed is True:
-            self.__rc.set(name, value, ex=timeout, xx=True)
+            rc.set(name, value, ex=timeout, xx=True)
+        for prefix in prefixes:
+            rc.sadd(PrefixIndexes.index_key(prefix), name)
+        if tags and not self._cluster:
+            for tag in tags:
+                self.LuaDict['TAG_ADD_LUA'].run_script([self.tag_key(tag)], [timeout or 0, name], client=rc)
+        if tags or prefixes:
+            rc.execute()
+        if tags and self._cluster:
+            # 集群管道不支持脚本， 标签集合与键通常不在同一slot， 逐个执行
+            for tag in tags:
+                self.LuaDict['TAG_ADD_LUA'].run_script([self.tag_key(tag)], [timeout or 0, name])
+
+    @staticmethod
+    def tag_key(tag):
+        """
+        标签集合键
+        :param tag: 标签
+        :return:
+        """
+        return 'tag:%s' % tag
 
     def setnx(self, name, value=None, timeout=settings.REDIS_CACHED_TIMEOUT):
         """
@@ -579,7 +1254,16 @@ class RedisDB(object):
         """
         if value is None:
             value = ''
-        if 0 == self.__rc.set(name, value, ex=timeout, nx=True):
+        prefixes = PrefixIndexes.match(name)
+        if prefixes:
+            pipe = self.pipeline
+            pipe.set(name, value, ex=timeout, nx=True)
+            for prefix in prefixes:
+                pipe.sadd(PrefixIndexes.index_key(prefix), name)
+            result = (pipe.execute())[0]
+        else:
+            result = self.__rc.set(name, value, ex=timeout, nx=True)
+        if not result:
             return False
         return True
 
@@ -605,7 +1289,90 @@ class RedisDB(object):
         :param name: 键
         :return:
         """
-        self.__rc.delete(name)
+        prefixes = PrefixIndexes.match(name)
+        if prefixes:
+            pipe = self.pipeline
+            pipe.delete(name)
+            for prefix in prefixes:
+                pipe.srem(PrefixIndexes.index_key(prefix), name)
+            pipe.execute()
+        else:
+            self.__rc.delete(name)
+
+    def release_lock(self, name, token):
+        """
+        释放锁， 仅当锁仍由token持有时删除， 锁已超时并被其他调用方获取时不删除
+        :param name: 锁键
+        :param token: 获取锁时写入的值
+        :return: 是否已释放
+        """
+        result = self.LuaDict['DELETE_IF_EQUAL_LUA'].run_script([name], [token])
+        if result:
+            for prefix in PrefixIndexes.match(name):
+                self.__rc.srem(PrefixIndexes.index_key(prefix), name)
+        return result == 1
+
+    def _write_indexed(self, names, command, *args, **kwargs):
+        """
+        执行写入命令， 写入的键加入匹配的前缀索引； SADD 与写入命令在同一管道(事务)中， 一次往返
+        :param names: 写入的键
+        :param command: 写入命令名称
+        :param args: 命令参数
+        :param kwargs: 命令参数
+        :return: 写入命令的结果
+        """
+        pairs = _index_pairs(*names)
+        if not pairs:
+            return getattr(self.__rc, command)(*args, **kwargs)
+        if self._cluster and command in _CLUSTER_PIPELINE_BLOCKED:
+            # 集群管道不支持多键命令， 写入后单独提交 SADD
+            result = getattr(self.__rc, command)(*args, **kwargs)
+            pipe = self.pipeline
+            for index_key, name in pairs:
+                pipe.sadd(index_key, name)
+            pipe.execute()
+            return result
+        pipe = self.pipeline
+        getattr(pipe, command)(*args, **kwargs)
+        for index_key, name in pairs:
+            pipe.sadd(index_key, name)
+        return pipe.execute()[0]
+
+    def count_keys(self, prefix):
+        """
+        统计前缀下键的数量， 已注册索引的前缀为O(1)， 否则全库扫描
+        :param prefix: 前缀
+        :return:
+        """
+        if PrefixIndexes.is_registered(prefix):
+            return self.__rc.scard(PrefixIndexes.index_key(prefix))
+        return self.run_script('COUNT_KEY_WITH_PREFIX_LUA', ['%s*' % prefix], [])
+
+    def invalidate_tags(self, *tags):
+        """
+        删除标签关联的所有键
+        :param tags: 标签
+        :return: 删除的键数量
+        """
+        if not tags:
+            return 0
+        tag_keys = [self.tag_key(tag) for tag in tags]
+        if not self._cluster:
+            return self.LuaDict['INVALIDATE_TAGS_LUA'].run_script(tag_keys, [])
+        # 集群模式下缓存键分布在不同的slot， 分两次管道完成: 读取标签集合、 逐键删除
+        pipe = self.pipeline
+        for tag_key in tag_keys:
+            pipe.smembers(tag_key)
+        names = set()
+        for members in pipe.execute():
+            names.update(members)
+        pipe = self.pipeline
+        for name in names:
+            pipe.delete(name)
+        for tag_key in tag_keys:
+            pipe.delete(tag_key)
+        results = pipe.execute()
+        return sum(results[:len(names)])
 
     def incr(self, name, amount=1):
         """
@@ -614,7 +1381,7 @@ class RedisDB(object):
         :param amount: 步长
         :return:
         """
-        return self.__rc.incr(name, amount)
+        return self._write_indexed([name], 'incr', name, amount)
 
     def mset(self, **kwargs):
         """
@@ -622,7 +1389,7 @@ class RedisDB(object):
         :param kwargs: 参数列表（key-value）
         :return:
         """
-        self.__rc.mset(**kwargs)
+        self._write_indexed(list(kwargs), 'mset', **kwargs)
 
     def mget(self, names):
         """
@@ -640,7 +1407,7 @@ class RedisDB(object):
         :param value: 值
         :return:
         """
-        self.__rc.hset(name, key, value)
+        self._write_indexed([name], 'hset', name, key, value)
 
     def hget(self, name, key):
         """
@@ -658,7 +1425,7 @@ class RedisDB(object):
         :param kv_dict: 值(dict)
         :return:
         """
-        self.__rc.hmset(name, kv_dict)
+        self._write_indexed([name], 'hmset', name, kv_dict)
 
     def hmget(self, name, keys):
         """
@@ -736,7 +1503,7 @@ class RedisDB(object):
         :param vals: 多个值
         :return:
         """
-        self.__rc.lpush(name, *vals)
+        self._write_indexed([name], 'lpush', name, *vals)
 
     def rpush(self, name, *values):
         """
@@ -745,7 +1512,7 @@ class RedisDB(object):
         :param values:
         :return:
         """
-        self.__rc.rpush(name, *values)
+        self._write_indexed([name], 'rpush', name, *values)
 
     def rpop(self, name):
         """
@@ -780,7 +1547,7 @@ class RedisDB(object):
         :param vals: 多个值
         :return:
         """
-        self.__rc.sadd(name, vals)
+        self._write_indexed([name], 'sadd', name, vals)
 
     def slen(self, name):
         """
@@ -798,6 +1565,63 @@ class RedisDB(object):
         """
         return self.__rc.smembers(name)
 
+    def hscan_iter(self, name, match=None, count=settings.REDIS_SCAN_COUNT):
+        """
+        基于HSCAN分页迭代dict形式所有的值， 不一次性加载
+        :param name: 键
+        :param match: 值键匹配模式
+        :param count: 每页数量
+        :return: 迭代器，元素为(值键, 值)
+        """
+        return self.__rc.hscan_iter(name, match=match, count=count)
+
+    def sscan_iter(self, name, match=None, count=settings.REDIS_SCAN_COUNT):
+        """
+        基于SSCAN分页迭代集合所有成员
+        :param name: 键
+        :param match: 成员匹配模式
+        :param count: 每页数量
+        :return: 迭代器，元素为成员
+        """
+        return self.__rc.sscan_iter(name, match=match, count=count)
+
+    def zscan_iter(self, name, match=None, count=settings.REDIS_SCAN_COUNT):
+        """
+        基于ZSCAN分页迭代有序集合所有成员
+        :param name: 键
+        :param match: 成员匹配模式
+        :param count: 每页数量
+        :return: 迭代器，元素为(成员, 分数)
+        """
+        return self.__rc.zscan_iter(name, match=match, count=count)
+
+    def lrange_iter(self, name, count=settings.REDIS_SCAN_COUNT):
+        """
+        分段LRANGE迭代list所有元素
+        :param name: 键
+        :param count: 每页数量
+        :return: 迭代器，元素为列表值
+        """
+        start = 0
+        while True:
+            data = self.__rc.lrange(name, start, start + count - 1)
+            for item in data:
+                yield item
+            if len(data) < count:
+                break
+            start += count
+
+    def iter_prefix_keys(self, prefix, count=settings.REDIS_SCAN_COUNT):
+        """
+        迭代前缀下所有的键， 已注册索引的前缀基于SSCAN， 否则全库SCAN
+        :param prefix: 前缀
+        :param count: 每页数量
+        :return: 迭代器，元素为键
+        """
+        if PrefixIndexes.is_registered(prefix):
+            return self.sscan_iter(PrefixIndexes.index_key(prefix), count=count)
+        return self.__rc.scan_iter(match='%s*' % prefix, count=count)
+
     def sismember(self, name, value):
         """
         判断值是否存在与集合中
@@ -815,6 +1639,77 @@ class RedisDB(object):
         """
         self.__rc.spop(name)
 
+    def setbit(self, name, offset: int, value=1):
+        """
+        设置位图指定偏移量的值
+        :param name: 键
+        :param offset: 偏移量(整数ID)
+        :param value: 1 或 0
+        :return: 偏移量原来的值
+        """
+        return self._write_indexed([name], 'setbit', name, offset, 1 if value else 0)
+
+    def getbit(self, name, offset: int):
+        """
+        获取位图指定偏移量的值
+        :param name: 键
+        :param offset: 偏移量(整数ID)
+        :return: 1 或 0
+        """
+        return self.__rc.getbit(name, offset)
+
+    def setbits(self, name, offsets, value=1):
+        """
+        批量设置位图偏移量的值， 一次往返完成
+        :param name: 键
+        :param offsets: 偏移量列表
+        :param value: 1 或 0
+        :return: 各偏移量原来的值列表，与参数顺序对应
+        """
+        if not offsets:
+            return []
+        value = 1 if value else 0
+        pipe = self.pipeline
+        for offset in offsets:
+            pipe.setbit(name, offset, value)
+        for index_key, _ in _index_pairs(name):
+            pipe.sadd(index_key, name)
+        return (pipe.execute())[:len(offsets)]
+
+    def getbits(self, name, offsets):
+        """
+        批量测试位图偏移量的值， 一次往返完成
+        :param name: 键
+        :param offsets: 偏移量列表
+        :return: 各偏移量的值列表(1 或 0)，与参数顺序对应
+        """
+        if not offsets:
+            return []
+        pipe = self.pipeline
+        for offset in offsets:
+            pipe.getbit(name, offset)
+        return pipe.execute()
+
+    def bitcount(self, name, start=None, end=None):
+        """
+        统计位图中值为1的数量
+        :param name: 键
+        :param start: 起始字节位置， 与end同时指定
+        :param end: 结束字节位置， 与start同时指定
+        :return:
+        """
+        return self.__rc.bitcount(name, start, end)
+
+    def bitop(self, operation, dest, *names):
+        """
+        多个位图之间的位运算， 结果保存到dest
+        :param operation: AND|OR|XOR|NOT
+        :param dest: 结果键
+        :param names: 参与运算的键
+        :return: 结果位图的字节长度
+        """
+        return self._write_indexed([dest], 'bitop', operation, dest, *names)
+
     def set_expire(self, name, seconds: int = settings.REDIS_CACHED_TIMEOUT):
         """
         设置健超时时长
@@ -823,7 +1718,15 @@ class RedisDB(object):
         :return:
         """
         if name and seconds:
-            return self.__rc.expire(name, seconds)
+            # 负数超时立即删除键， SREM 与 EXPIRE 在同一管道中
+            pairs = _index_pairs(name) if seconds < 0 else []
+            if not pairs:
+                return self.__rc.expire(name, seconds)
+            pipe = self.pipeline
+            pipe.expire(name, seconds)
+            for index_key, _ in pairs:
+                pipe.srem(index_key, name)
+            return (pipe.execute())[0]
 
     def set_expire_dt(self, name, dt: datetime.datetime):
         """
@@ -836,6 +1739,158 @@ class RedisDB(object):
             if dt > datetime.datetime.now():
                 return self.__rc.expireat(name, dt)
 
+    def ttl(self, name):
+        """
+        获取健剩余超时时长
+        :param name:
+        :return: 剩余秒数， -1: 永不超时， -2: 健不存在
+        """
+        return self.__rc.ttl(name)
+
+    def get_expire(self, name, seconds: int = settings.REDIS_CACHED_TIMEOUT, pipe=None):
+        """
+        获取值并顺延过期时间(滑动过期)， 一次往返
+        :param name: 键
+        :param seconds: 过期时间(秒)
+        :param pipe: 管道， 指定时命令加入管道， 结果在管道执行结果中
+        :return: 值
+        """
+        return self.LuaDict['GET_EXPIRE_LUA'].run_script([name], [seconds], client=pipe)
+
+    @staticmethod
+    def loading_key(name):
+        """
+        加载锁键， 与name位于同一slot
+        :param name: 键
+        :return:
+        """
+        return slot_key(name, 'loading')
+
+    def get_or_mark_loading(self, name, lock_timeout: int = settings.REDIS_LOADING_TIMEOUT, pipe=None):
+        """
+        获取值， 不存在时抢占加载锁， 一次往返
+        获得加载锁的调用方加载数据后调用 set_loaded 写入并以令牌释放锁
+        :param name: 键
+        :param lock_timeout: 加载锁超时时间(秒)
+        :param pipe: 管道， 指定时命令加入管道， 结果在管道执行结果中(未经转换， [0] 表示获得加载锁)
+        :return: (值, 加载锁令牌)， 令牌不为None时由调用方加载， 其他调用方正在加载时返回 (None, None)；
+                 指定管道时返回本次使用的令牌
+        """
+        token = uuid.uuid4().hex
+        result = self.LuaDict['GET_OR_LOADING_LUA'].run_script(
+            [name, self.loading_key(name)], [lock_timeout, token], client=pipe)
+        if pipe is not None:
+            return token
+        if result[0] == 2:
+            return result[1], None
+        return None, token if result[0] == 0 else None
+
+    def set_loaded(self, name, value, token, timeout=settings.REDIS_CACHED_TIMEOUT):
+        """
+        写入加载的值并释放加载锁， 一次往返； 加载锁已超时并被其他调用方获取时不删除
+        :param name: 键
+        :param value: 值
+        :param token: get_or_mark_loading 返回的加载锁令牌
+        :param timeout: 超时时间，None 时永不超时
+        :return: 是否已释放加载锁
+        """
+        pipe = self.pipeline
+        pipe.set(name, value, ex=timeout)
+        if not self._cluster:
+            self.LuaDict['DELETE_IF_EQUAL_LUA'].run_script([self.loading_key(name)], [token], client=pipe)
+        for index_key, _ in _index_pairs(name):
+            pipe.sadd(index_key, name)
+        results = pipe.execute()
+        if self._cluster:
+            # 集群管道不支持脚本， 单独释放
+            return self.release_lock(self.loading_key(name), token)
+        return results[1] == 1
+
+    def hincr_capped(self, name, key, amount: int = 1, cap: int = 0, timeout: int = 0, pipe=None):
+        """
+        dict形式值自增， 超过上限时不自增， 一次往返
+        :param name: 键
+        :param key: 值键
+        :param amount: 步长
+        :param cap: 上限
+        :param timeout: 过期时间(秒)， 仅在键未设置过期时间时设置， 0: 不设置
+        :param pipe: 管道， 指定时命令加入管道， 结果在管道执行结果中(未经转换)
+        :return: (是否自增, 当前值)
+        """
+        result = self.LuaDict['HINCR_CAP_LUA'].run_script([name], [key, amount, cap, timeout], client=pipe)
+        if pipe is not None:
+            return result
+        return result[0] == 1, int(result[1])
+
+    def set_if_version_greater(self, name, value, version: int, timeout=settings.REDIS_CACHED_TIMEOUT, pipe=None):
+        """
+        版本号大于当前版本号时设置值， 一次往返
+        :param name: 键
+        :param value: 值
+        :param version: 版本号
+        :param timeout: 超时时间，None 时永不超时
+        :param pipe: 管道， 指定时命令加入管道， 结果在管道执行结果中(未经转换)
+        :return: 是否已设置
+        """
+        result = self.LuaDict['SET_IF_VERSION_GREATER_LUA'].run_script(
+            [name, slot_key(name, 'version')], [value, version, timeout or 0], client=pipe)
+        if pipe is not None:
+            return result
+        return result == 1
+
+    @staticmethod
+    def generation_key(name):
+        """
+        代数键， 与name位于同一slot
+        :param name: 键
+        :return:
+        """
+        return slot_key(name, 'generation')
+
+    def bump_generation(self, name, timeout=settings.REDIS_CACHED_TIMEOUT, pipe=None):
+        """
+        删除值并递增代数， 之前读取的代数无法再回填
+        :param name: 键
+        :param timeout: 代数键超时时间，None 时永不超时
+        :param pipe: 管道， 指定时命令加入管道， 由调用方执行
+        :return:
+        """
+        client = pipe if pipe is not None else self.pipeline
+        generation_key = self.generation_key(name)
+        client.incr(generation_key)
+        if timeout:
+            client.expire(generation_key, timeout)
+        client.delete(name)
+        if pipe is None:
+            client.execute()
+
+    def set_if_generation(self, name, value, generation, timeout=settings.REDIS_CACHED_TIMEOUT, pipe=None):
+        """
+        代数未变化时设置值， 一次往返
+        :param name: 键
+        :param value: 值
+        :param generation: 读取数据前 generation_key 的值， 不存在时为None
+        :param timeout: 超时时间，None 时永不超时
+        :param pipe: 管道， 指定时命令加入管道， 结果在管道执行结果中(未经转换)
+        :return: 是否已设置
+        """
+        result = self.LuaDict['SET_IF_GENERATION_LUA'].run_script(
+            [name, self.generation_key(name)], [value, generation or '', timeout or 0], client=pipe)
+        if pipe is not None:
+            return result
+        return result == 1
+
+    def pop_n(self, name, count: int, right=False, pipe=None):
+        """
+        从列表弹出多个元素， 一次往返
+        :param name: 键
+        :param count: 数量
+        :param right: True 从右侧弹出(顺序同多次rpop)， False 从左侧弹出
+        :param pipe: 管道， 指定时命令加入管道， 结果在管道执行结果中
+        :return: 元素列表
+        """
+        return self.LuaDict['POP_N_LUA'].run_script([name], [count, 1 if right else 0], client=pipe)
+
     def register_script(self, script):
         return self.db.register_script(script)
 
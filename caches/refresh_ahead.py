@@ -0,0 +1,214 @@
+# !/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+热点缓存提前刷新
+
+调用方注册键及其加载函数， 通过 get/touch 记录访问热度。后台任务定期检查已注册的键，
+对剩余超时时间进入刷新窗口且仍然热门的键重新加载并写回缓存；冷门键任其自然过期。
+刷新通过Redis锁保证多进程下同一键只有一个进程执行。
+"""
+
+import asyncio
+import inspect
+import uuid
+
+import settings
+from caches.redis_utils import AsyncRedisCache
+from commons import logging
+
+logger = logging.get_logging()
+
+
+class _RefreshEntry(object):
+    __slots__ = ('key', 'loader', 'timeout', 'hits', 'score')
+
+    def __init__(self, key, loader, timeout):
+        self.key = key
+        self.loader = loader
+        self.timeout = timeout
+        self.hits = 0
+        self.score = 0.0
+
+    def decay(self):
+        """
+        结算本周期访问次数， 历史热度每周期减半
+        :return: 当前热度
+        """
+        self.score = self.score / 2 + self.hits
+        self.hits = 0
+        return self.score
+
+
+class RefreshAheadScheduler(object):
+    def __init__(self, cache=None,
+                 interval=settings.REFRESH_AHEAD_INTERVAL,
+                 window=settings.REFRESH_AHEAD_WINDOW,
+                 min_hits=settings.REFRESH_AHEAD_MIN_HITS,
+                 concurrency=settings.REFRESH_AHEAD_CONCURRENCY,
+                 lock_timeout=settings.REFRESH_AHEAD_LOCK_TIMEOUT):
+        self.cache = cache or AsyncRedisCache
+        self.interval = interval
+        self.window = window
+        self.min_hits = min_hits
+        self.concurrency = concurrency
+        self.lock_timeout = lock_timeout
+        self._entries = {}
+        self._refreshing = set()
+        self._task = None
+
+    def register(self, key, loader, timeout=settings.REDIS_CACHED_TIMEOUT):
+        """
+        注册需要提前刷新的键
+        :param key: 缓存键
+        :param loader: 加载函数(普通函数或协程函数)， 无参数， 返回需要缓存的值
+        :param timeout: 缓存超时时间， None或0时永不超时(不需要提前刷新)
+        :return:
+        """
+        entry = self._entries.get(key)
+        if entry:
+            entry.loader = loader
+            entry.timeout = timeout
+        else:
+            self._entries[key] = _RefreshEntry(key, loader, timeout)
+
+    def unregister(self, key):
+        """
+        取消注册
+        :param key: 缓存键
+        :return:
+        """
+        self._entries.pop(key, None)
+
+    def touch(self, key):
+        """
+        记录一次访问
+        :param key: 缓存键
+        :return:
+        """
+        entry = self._entries.get(key)
+        if entry:
+            entry.hits += 1
+
+    async def get(self, key):
+        """
+        获取缓存值并记录访问， 未命中时同步加载
+        :param key: 缓存键
+        :return:
+        """
+        self.touch(key)
+        value = await self.cache.get(key)
+        if value is None and key in self._entries:
+            value = await self.refresh(key)
+        return value
+
+    async def refresh(self, key):
+        """
+        重新加载并写回缓存， 其他进程正在刷新时直接返回
+        :param key: 缓存键
+        :return: 加载的值， 未获取到刷新锁时返回None
+        """
+        entry = self._entries.get(key)
+        if not entry or key in self._refreshing:
+            return None
+        lock_key = 'refresh_ahead:lock:%s' % key
+        # 锁的值为本次刷新的唯一标识， 加载超过锁超时时间后不会释放其他进程获取的锁
+        token = '%s:%s' % (settings.FORK_ID or 0, uuid.uuid4().hex)
+        self._refreshing.add(key)
+        try:
+            if not await self.cache.setnx(lock_key, token, timeout=self.lock_timeout):
+                return None
+            try:
+                value = await self._load(entry.loader)
+                if value is not None:
+                    await self.cache.set(key, value, timeout=entry.timeout or None)
+                return value
+            finally:
+                await self.cache.release_lock(lock_key, token)
+        finally:
+            self._refreshing.discard(key)
+
+    @staticmethod
+    async def _load(loader):
+        """
+        执行加载函数， 普通函数在线程池中执行， 不阻塞事件循环
+        :param loader: 加载函数
+        :return:
+        """
+        if inspect.iscoroutinefunction(loader):
+            return await loader()
+        value = await asyncio.get_event_loop().run_in_executor(None, loader)
+        if inspect.isawaitable(value):
+            value = await value
+        return value
+
+    async def tick(self):
+        """
+        执行一次检查， 刷新进入刷新窗口的热门键
+        :return: 刷新的键数量
+        """
+        candidates = []
+        for entry in list(self._entries.values()):
+            if entry.decay() >= self.min_hits and entry.timeout and entry.key not in self._refreshing:
+                candidates.append(entry)
+        if not candidates:
+            return 0
+
+        pipe = self.cache.pipeline
+        for entry in candidates:
+            await pipe.ttl(entry.key)
+        ttl_list = await pipe.execute()
+
+        expiring = []
+        for entry, ttl in zip(candidates, ttl_list):
+            # -1: 永不超时; -2: 已过期, 热门键同样需要重新加载
+            if ttl == -1:
+                continue
+            if ttl <= max(self.interval * 2, entry.timeout * self.window):
+                expiring.append(entry.key)
+        if not expiring:
+            return 0
+
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def _refresh(key):
+            async with semaphore:
+                try:
+                    await self.refresh(key)
+                except Exception as e:
+                    logger.error('[refresh_ahead][%s]%s' % (key, e))
+
+        await asyncio.gather(*[_refresh(key) for key in expiring])
+        return len(expiring)
+
+    async def _run(self):
+        await self.cache.setup()
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.tick()
+            except Exception as e:
+                logger.error('[refresh_ahead]%s' % e)
+
+    async def start(self):
+        """
+        启动后台刷新任务
+        :return:
+        """
+        if not self._task:
+            self._task = asyncio.ensure_future(self._run())
+
+    async def stop(self):
+        """
+        停止后台刷新任务
+        :return:
+        """
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+
+RefreshAhead = RefreshAheadScheduler()
@@ -0,0 +1,315 @@
+# !/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+有界时间线(有序集合)
+
+成员以时间戳为分数写入 timeline:<名称>， 写入时在同一管道中按数量(ZREMRANGEBYRANK)和
+时间窗口(ZREMRANGEBYSCORE)裁剪并续期， 内存占用有上限；读取"最近N条"和"时间区间"
+均为 O(log n + k)。有序集合中成员唯一， 同一成员重复写入时只更新时间戳。
+"""
+
+import datetime
+import time
+
+import settings
+
+
+class _TimelineBase(object):
+    def __init__(self, name, cache,
+                 max_length=settings.TIMELINE_MAX_LENGTH,
+                 max_age=settings.TIMELINE_MAX_AGE):
+        if not name:
+            raise ValueError('Timeline name not specified.')
+        self.name = name
+        self.cache = cache
+        self.max_length = max_length
+        self.max_age = max_age
+        self.key = self.timeline_key(name)
+
+    @staticmethod
+    def timeline_key(name):
+        """
+        时间线键
+        :param name: 时间线名称
+        :return:
+        """
+        return 'timeline:%s' % name
+
+    @staticmethod
+    def _score(timestamp=None):
+        if timestamp is None:
+            return time.time()
+        if isinstance(timestamp, datetime.datetime):
+            return timestamp.timestamp()
+        return float(timestamp)
+
+    def _min_score(self):
+        if self.max_age:
+            return time.time() - self.max_age
+        return float('-inf')
+
+    def _range(self, start=None, end=None):
+        """
+        时间区间对应的分数区间， 起始时间不早于时间窗口
+        :param start: 起始时间戳或datetime
+        :param end: 结束时间戳或datetime
+        :return: (最小分数, 最大分数)
+        """
+        min_score = self._min_score()
+        if start is not None:
+            min_score = max(min_score, self._score(start))
+        max_score = float('inf') if end is None else self._score(end)
+        return min_score, max_score
+
+    @staticmethod
+    def _mapping(items):
+        mapping = {}
+        for item in items:
+            if isinstance(item, (list, tuple)):
+                member, timestamp = item
+            else:
+                member, timestamp = item, None
+            mapping[member] = _TimelineBase._score(timestamp)
+        return mapping
+
+    def _trim_commands(self):
+        """
+        裁剪及续期命令
+        :return: [(命令, 参数)]
+        """
+        commands = []
+        if self.max_age:
+            commands.append(('zremrangebyscore', (self.key, float('-inf'), time.time() - self.max_age)))
+        if self.max_length:
+            commands.append(('zremrangebyrank', (self.key, 0, -self.max_length - 1)))
+        if self.max_age:
+            commands.append(('expire', (self.key, int(self.max_age) + 1)))
+        return commands
+
+
+class Timeline(_TimelineBase):
+    """
+    有界时间线(同步)
+    """
+
+    def _append(self, pipe, mapping):
+        pipe.zadd(self.key, mapping)
+        for command, args in self._trim_commands():
+            getattr(pipe, command)(*args)
+
+    def append(self, member, timestamp=None):
+        """
+        写入成员并裁剪
+        :param member: 成员
+        :param timestamp: 时间戳(秒)或datetime， 默认当前时间
+        :return: 新增的成员数量
+        """
+        return self.extend([(member, timestamp)])
+
+    def extend(self, items):
+        """
+        批量写入成员并裁剪
+        :param items: 成员或(成员, 时间戳)列表
+        :return: 新增的成员数量
+        """
+        mapping = self._mapping(items)
+        if not mapping:
+            return 0
+        pipe = self.cache.pipeline
+        self._append(pipe, mapping)
+        return pipe.execute()[0]
+
+    @classmethod
+    def fan_out(cls, names, member, timestamp=None, cache=None,
+                max_length=settings.TIMELINE_MAX_LENGTH, max_age=settings.TIMELINE_MAX_AGE):
+        """
+        将同一成员写入多条时间线， 一个管道完成
+        :param names: 时间线名称列表
+        :param member: 成员
+        :param timestamp: 时间戳(秒)或datetime， 默认当前时间
+        :param cache: 缓存客户端， 默认 RedisCache
+        :param max_length: 最大长度
+        :param max_age: 最长保留时间(单位：秒)
+        :return: 写入的时间线数量
+        """
+        if not names:
+            return 0
+        if cache is None:
+            from caches.redis_utils import RedisCache
+            cache = RedisCache
+        mapping = {member: cls._score(timestamp)}
+        pipe = cache.pipeline
+        for name in names:
+            cls(name, cache, max_length, max_age)._append(pipe, mapping)
+        pipe.execute()
+        return len(names)
+
+    def latest(self, count=10, withscores=False):
+        """
+        获取最近N条， 按时间倒序
+        :param count: 数量
+        :param withscores: 是否返回时间戳
+        :return:
+        """
+        if count <= 0:
+            return []
+        if self.max_age:
+            return self.cache.db.zrevrangebyscore(self.key, float('inf'), self._min_score(),
+                                                  start=0, num=count, withscores=withscores)
+        return self.cache.db.zrevrange(self.key, 0, count - 1, withscores=withscores)
+
+    def between(self, start=None, end=None, offset=None, count=None, desc=True, withscores=False):
+        """
+        获取时间区间[start, end]内的成员
+        :param start: 起始时间戳或datetime， 默认不限(仍受时间窗口限制)
+        :param end: 结束时间戳或datetime， 默认不限
+        :param offset: 偏移量， 需与count同时指定
+        :param count: 数量
+        :param desc: True 按时间倒序， False 按时间正序
+        :param withscores: 是否返回时间戳
+        :return:
+        """
+        min_score, max_score = self._range(start, end)
+        if count is not None and offset is None:
+            offset = 0
+        if desc:
+            return self.cache.db.zrevrangebyscore(self.key, max_score, min_score,
+                                                  start=offset, num=count, withscores=withscores)
+        return self.cache.db.zrangebyscore(self.key, min_score, max_score,
+                                           start=offset, num=count, withscores=withscores)
+
+    def length(self):
+        """
+        获取时间窗口内的成员数量
+        :return:
+        """
+        if self.max_age:
+            return self.cache.db.zcount(self.key, self._min_score(), float('inf'))
+        return self.cache.db.zcard(self.key)
+
+    def remove(self, *members):
+        """
+        移除成员
+        :param members: 成员
+        :return: 移除的数量
+        """
+        if not members:
+            return 0
+        return self.cache.db.zrem(self.key, *members)
+
+    def clear(self):
+        return self.cache.delete(self.key)
+
+
+class AsyncTimeline(_TimelineBase):
+    """
+    有界时间线(异步)
+    """
+
+    async def _append(self, pipe, mapping):
+        await pipe.zadd(self.key, mapping)
+        for command, args in self._trim_commands():
+            await getattr(pipe, command)(*args)
+
+    async def append(self, member, timestamp=None):
+        """
+        写入成员并裁剪
+        :param member: 成员
+        :param timestamp: 时间戳(秒)或datetime， 默认当前时间
+        :return: 新增的成员数量
+        """
+        return await self.extend([(member, timestamp)])
+
+    async def extend(self, items):
+        """
+        批量写入成员并裁剪
+        :param items: 成员或(成员, 时间戳)列表
+        :return: 新增的成员数量
+        """
+        mapping = self._mapping(items)
+        if not mapping:
+            return 0
+        pipe = self.cache.pipeline
+        await self._append(pipe, mapping)
+        return (await pipe.execute())[0]
+
+    @classmethod
+    async def fan_out(cls, names, member, timestamp=None, cache=None,
+                      max_length=settings.TIMELINE_MAX_LENGTH, max_age=settings.TIMELINE_MAX_AGE):
+        """
+        将同一成员写入多条时间线， 一个管道完成
+        :param names: 时间线名称列表
+        :param member: 成员
+        :param timestamp: 时间戳(秒)或datetime， 默认当前时间
+        :param cache: 缓存客户端， 默认 AsyncRedisCache
+        :param max_length: 最大长度
+        :param max_age: 最长保留时间(单位：秒)
+        :return: 写入的时间线数量
+        """
+        if not names:
+            return 0
+        if cache is None:
+            from caches.redis_utils import AsyncRedisCache
+            cache = AsyncRedisCache
+        mapping = {member: cls._score(timestamp)}
+        pipe = cache.pipeline
+        for name in names:
+            await cls(name, cache, max_length, max_age)._append(pipe, mapping)
+        await pipe.execute()
+        return len(names)
+
+    async def latest(self, count=10, withscores=False):
+        """
+        获取最近N条， 按时间倒序
+        :param count: 数量
+        :param withscores: 是否返回时间戳
+        :return:
+        """
+        if count <= 0:
+            return []
+        if self.max_age:
+            return await self.cache.db.zrevrangebyscore(self.key, float('inf'), self._min_score(),
+                                                        start=0, num=count, withscores=withscores)
+        return await self.cache.db.zrevrange(self.key, 0, count - 1, withscores=withscores)
+
+    async def between(self, start=None, end=None, offset=None, count=None, desc=True, withscores=False):
+        """
+        获取时间区间[start, end]内的成员
+        :param start: 起始时间戳或datetime， 默认不限(仍受时间窗口限制)
+        :param end: 结束时间戳或datetime， 默认不限
+        :param offset: 偏移量， 需与count同时指定
+        :param count: 数量
+        :param desc: True 按时间倒序， False 按时间正序
+        :param withscores: 是否返回时间戳
+        :return:
+        """
+        min_score, max_score = self._range(start, end)
+        if count is not None and offset is None:
+            offset = 0
+        if desc:
+            return await self.cache.db.zrevrangebyscore(self.key, max_score, min_score,
+                                                        start=offset, num=count, withscores=withscores)
+        return await self.cache.db.zrangebyscore(self.key, min_score, max_score,
+                                                 start=offset, num=count, withscores=withscores)
+
+    async def length(self):
+        """
+        获取时间窗口内的成员数量
+        :return:
+        """
+        if self.max_age:
+            return await self.cache.db.zcount(self.key, self._min_score(), float('inf'))
+        return await self.cache.db.zcard(self.key)
+
+    async def remove(self, *members):
+        """
+        移除成员
+        :param members: 成员
+        :return: 移除的数量
+        """
+        if not members:
+            return 0
+        return await self.cache.db.zrem(self.key, *members)
+
+    async def clear(self):
+        return await self.cache.delete(self.key)
@@ -13,7 +13,7 @@ import datetime
 import os
 from json import JSONEncoder, JSONDecoder
 from json.decoder import WHITESPACE
-from bson import ObjectId, _millis_to_datetime
+from bson import ObjectId, json_util, _millis_to_datetime, _datetime_to_millis
 from bson.codec_options import DEFAULT_CODEC_OPTIONS
 from encoder import XML2Dict
 from basedoc import ModelBase
@@ -449,3 +449,26 @@ def model_object_hook(dic):
     elif dic.get('$date'):
         return _millis_to_datetime(dic['$date'], DEFAULT_CODEC_OPTIONS).strftime(settings.TIME_FORMAT)
     return dic
+
+
+def son_to_dict(son):
+    """
+    原始文档(SON/dict)转换为dict， 结果与 json.loads(json_util.dumps(son), object_hook=model_object_hook) 一致，
+    不经过JSON文本： ObjectId 转换为字符串， datetime 按 TIME_FORMAT 格式化
+    :param son:
+    :return:
+    """
+    if isinstance(son, dict):
+        d = {}
+        for k, v in son.items():
+            d[k] = son_to_dict(v)
+        return d
+    elif isinstance(son, (list, tuple)):
+        return [son_to_dict(v) for v in son]
+    elif isinstance(son, ObjectId):
+        return str(son)
+    elif isinstance(son, datetime.datetime):
+        return _millis_to_datetime(_datetime_to_millis(son), DEFAULT_CODEC_OPTIONS).strftime(settings.TIME_FORMAT)
+    elif son is None or isinstance(son, (str, bool, int, float)):
+        return son
+    return json.loads(json_util.dumps(son), object_hook=model_object_hook)
@@ -0,0 +1,241 @@
+# !/usr/bin/python
+# -*- coding:utf-8 -*-
+"""
+历史记录分区归档
+
+HISTORY_PARTITION_BY_MONTH 启用时历史记录按月写入 history_<cname>_<yyyymm> 集合。
+后台任务每隔 HISTORY_ARCHIVE_INTERVAL 秒检查早于 HISTORY_RETENTION_MONTHS 个月的分区， 按
+HISTORY_ARCHIVE_MODE 归档后删除该分区：
+    - collection: 按 ref_id 每 HISTORY_ARCHIVE_CHUNK_SIZE 条记录压缩为一个文档写入 history_<cname>_archive，
+                  文档ID由分区、ref_id及序号组成， 中断后重新归档覆盖写入
+    - file: 导出为 HISTORY_ARCHIVE_DIR/<分区>.bson.gz (BSON拼接)
+归档的记录数量与分区记录数量一致时才删除分区。
+归档通过Redis锁保证多进程下只有一个进程执行。
+冷数据集合中的记录在还原历史版本时使用(最近快照已归档时， 参考 basedoc.load_history_states)， 导出的文件不再读取。
+"""
+
+import asyncio
+import datetime
+import gzip
+import os
+import re
+import uuid
+import zlib
+
+import bson
+from bson import Binary
+from pymongo import ReplaceOne
+
+import settings
+from caches.redis_utils import AsyncRedisCache
+from commons import logging
+
+logger = logging.get_logging()
+
+_PARTITION_RE = re.compile(r'^(history_.+)_(\d{4})(\d{2})$')
+
+
+def archive_collection_name(base):
+    """
+    冷数据集合名
+    :param base: 基础集合名 history_<cname>
+    :return:
+    """
+    return '%s_archive' % base
+
+
+class HistoryArchiver(object):
+    def __init__(self, cache=None,
+                 retention_months=settings.HISTORY_RETENTION_MONTHS,
+                 mode=settings.HISTORY_ARCHIVE_MODE,
+                 archive_dir=settings.HISTORY_ARCHIVE_DIR,
+                 chunk_size=settings.HISTORY_ARCHIVE_CHUNK_SIZE,
+                 interval=settings.HISTORY_ARCHIVE_INTERVAL,
+                 lock_timeout=settings.HISTORY_ARCHIVE_LOCK_TIMEOUT):
+        self.cache = cache or AsyncRedisCache
+        self.retention_months = retention_months
+        self.mode = mode
+        self.archive_dir = archive_dir
+        self.chunk_size = chunk_size
+        self.interval = interval
+        self.lock_timeout = lock_timeout
+        self._task = None
+
+    @staticmethod
+    def _db():
+        from basedoc import History
+        return History._get_db()
+
+    def expired_partitions(self, now=None):
+        """
+        早于保留期的分区
+        :param now: 当前时间
+        :return: [(分区集合名, 基础集合名)]
+        """
+        now = now or datetime.datetime.now()
+        cutoff = now.year * 12 + now.month - 1 - self.retention_months
+        result = []
+        for name in self._db().list_collection_names():
+            match = _PARTITION_RE.match(name)
+            if match and int(match.group(2)) * 12 + int(match.group(3)) - 1 < cutoff:
+                result.append((name, match.group(1)))
+        return sorted(result)
+
+    def _archive_to_collection(self, partition, base):
+        source = self._db()[partition]
+        target = self._db()[archive_collection_name(base)]
+        target.create_index([('ref_id', 1), ('time_min', -1)], background=True)
+
+        requests = []
+        count = 0
+
+        def _pack(ref_id, index, rows):
+            return ReplaceOne({'_id': '%s:%s:%d' % (partition, ref_id, index)}, {
+                'ref_id': ref_id,
+                'partition': partition,
+                'count': len(rows),
+                'time_min': rows[0].get('time'),
+                'time_max': rows[-1].get('time'),
+                'data': Binary(zlib.compress(b''.join(bson.encode(row) for row in rows),
+                                             settings.HISTORY_COMPRESS_LEVEL)),
+            }, upsert=True)
+
+        ref_id, index, rows = None, 0, []
+        for row in source.find({}, sort=[('ref_id', 1), ('time', 1), ('_id', 1)]):
+            if row.get('ref_id') != ref_id or len(rows) >= self.chunk_size:
+                if rows:
+                    requests.append(_pack(ref_id, index, rows))
+                index = index + 1 if row.get('ref_id') == ref_id else 0
+                ref_id, rows = row.get('ref_id'), []
+            rows.append(row)
+            count += 1
+            if len(requests) >= 100:
+                target.bulk_write(requests, ordered=False)
+                requests = []
+        if rows:
+            requests.append(_pack(ref_id, index, rows))
+        if requests:
+            target.bulk_write(requests, ordered=False)
+        return count
+
+    def _archive_to_file(self, partition):
+        os.makedirs(self.archive_dir, exist_ok=True)
+        path = os.path.join(self.archive_dir, '%s.bson.gz' % partition)
+        # 写入临时文件后重命名， 中断时不会留下不完整的归档文件
+        tmp_path = '%s.%s.tmp' % (path, os.getpid())
+        count = 0
+        with gzip.open(tmp_path, 'wb', compresslevel=settings.HISTORY_COMPRESS_LEVEL) as f:
+            for row in self._db()[partition].find({}, sort=[('_id', 1)]):
+                f.write(bson.encode(row))
+                count += 1
+        os.replace(tmp_path, path)
+        return count
+
+    def _archived_count(self, partition, base):
+        """
+        冷数据集合中分区的记录数量
+        """
+        rows = list(self._db()[archive_collection_name(base)].aggregate([
+            {'$match': {'partition': partition}},
+            {'$group': {'_id': None, 'count': {'$sum': '$count'}}},
+        ]))
+        return rows[0]['count'] if rows else 0
+
+    def archive_partition(self, partition, base):
+        """
+        归档并删除分区， 归档的记录数量与分区记录数量不一致时不删除
+        :param partition: 分区集合名
+        :param base: 基础集合名
+        :return: 归档的记录数量
+        """
+        expected = self._db()[partition].count_documents({})
+        if self.mode == 'file':
+            count = archived = self._archive_to_file(partition)
+        else:
+            count = self._archive_to_collection(partition, base)
+            archived = self._archived_count(partition, base)
+        if count != expected or archived != expected:
+            logger.error('[history][archive][%s]count mismatch: %s, archived %s/%s' %
+                         (partition, expected, count, archived))
+            return count
+        self._db().drop_collection(partition)
+        from basedoc import list_history_partitions
+        list_history_partitions(base, refresh=True)
+        logger.info('[history][archive][%s]%s' % (partition, count))
+        return count
+
+    def archive(self):
+        """
+        归档所有早于保留期的分区
+        :return: 归档的记录数量
+        """
+        if not self.retention_months:
+            return 0
+        total = 0
+        for partition, base in self.expired_partitions():
+            try:
+                total += self.archive_partition(partition, base)
+            except Exception as e:
+                logger.error('[history][archive][%s]%s' % (partition, e))
+        return total
+
+    def load_archived(self, base, ref_id):
+        """
+        读取归档到冷数据集合中的历史记录
+        :param base: 基础集合名
+        :param ref_id: 文档ID
+        :return: 历史记录原始文档列表， 按时间顺序
+        """
+        result = []
+        for item in self._db()[archive_collection_name(base)].find({'ref_id': ref_id}, sort=[('time_min', 1)]):
+            result.extend(bson.decode_all(zlib.decompress(item['data'])))
+        return result
+
+    async def tick(self):
+        """
+        获取归档锁后执行一次归档
+        :return: 归档的记录数量， 未获取到锁时返回None
+        """
+        lock_key = 'history:archive:lock'
+        token = '%s:%s' % (settings.FORK_ID or 0, uuid.uuid4().hex)
+        if not await self.cache.setnx(lock_key, token, timeout=self.lock_timeout):
+            return None
+        try:
+            return await asyncio.get_event_loop().run_in_executor(None, self.archive)
+        finally:
+            # 只释放自己持有的锁， 超时后被其他进程获取的锁不删除
+            await self.cache.release_lock(lock_key, token)
+
+    async def _run(self):
+        await self.cache.setup()
+        while True:
+            try:
+                await self.tick()
+            except Exception as e:
+                logger.error('[history][archive]%s' % e)
+            await asyncio.sleep(self.interval)
+
+    async def start(self):
+        """
+        启动归档任务， 未启用分区或保留期为0时不启动
+        :return:
+        """
+        if self._task or not settings.HISTORY_PARTITION_BY_MONTH or not self.retention_months:
+            return
+        self._task = asyncio.ensure_future(self._run())
+
+    async def stop(self):
+        """
+        停止归档任务
+        :return:
+        """
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+
+HistoryArchive = HistoryArchiver()
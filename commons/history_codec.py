@@ -0,0 +1,126 @@
+# !/usr/bin/python
+# -*- coding:utf-8 -*-
+"""
+历史记录编码
+
+历史记录的值为以下格式之一：
+    - FORMAT_PICKLE: 旧格式， pickle 序列化的完整文档
+    - FORMAT_SNAPSHOT: 完整快照， 压缩的BSON(to_mongo())
+    - FORMAT_DELTA: 相对上一版本的字段级增量， 压缩的BSON {'s': [[路径, 值], ...], 'u': [路径, ...]}
+路径为数据库字段名， 嵌套字段以 . 分隔， 数组元素为下标。
+任一版本由不晚于它的最近快照依次应用增量得到。
+"""
+
+import zlib
+
+import bson
+
+import settings
+
+FORMAT_PICKLE = 0
+FORMAT_SNAPSHOT = 1
+FORMAT_DELTA = 2
+
+_MISSING = object()
+
+
+def _compress(son):
+    return zlib.compress(bson.encode(son), settings.HISTORY_COMPRESS_LEVEL)
+
+
+def _decompress(value):
+    return bson.decode(zlib.decompress(value))
+
+
+def encode_snapshot(state):
+    """
+    编码完整快照
+    :param state: 文档(to_mongo()结果)
+    :return: bytes
+    """
+    return _compress(state)
+
+
+def encode_delta(set_data, unset_data):
+    """
+    编码增量
+    :param set_data: {路径: 值}
+    :param unset_data: 删除的路径列表
+    :return: bytes
+    """
+    return _compress({'s': [[path, value] for path, value in set_data.items()],
+                      'u': list(unset_data)})
+
+
+def decode_snapshot(value):
+    """
+    解码完整快照
+    :param value:
+    :return: dict
+    """
+    return _decompress(value)
+
+
+def decode_delta(value):
+    """
+    解码增量
+    :param value:
+    :return: ({路径: 值}, [路径])
+    """
+    delta = _decompress(value)
+    return {path: v for path, v in delta.get('s', [])}, delta.get('u', [])
+
+
+def diff_states(old, new):
+    """
+    比较两个版本的顶层字段
+    :param old: 上一版本
+    :param new: 当前版本
+    :return: ({路径: 值}, [路径])
+    """
+    set_data = {k: v for k, v in new.items() if old.get(k, _MISSING) != v}
+    unset_data = [k for k in old if k not in new]
+    return set_data, unset_data
+
+
+def _resolve(state, parts):
+    target = state
+    for part in parts:
+        if isinstance(target, list):
+            target = target[int(part)]
+        else:
+            target = target.setdefault(part, {})
+    return target
+
+
+def apply_delta(state, set_data, unset_data):
+    """
+    在上一版本上应用增量(原地修改)
+    :param state: 上一版本
+    :param set_data: {路径: 值}
+    :param unset_data: 删除的路径列表
+    :return: 当前版本
+    """
+    for path, value in set_data.items():
+        parts = path.split('.')
+        target = _resolve(state, parts[:-1])
+        if isinstance(target, list):
+            index = int(parts[-1])
+            if index >= len(target):
+                target.extend([None] * (index + 1 - len(target)))
+            target[index] = value
+        else:
+            target[parts[-1]] = value
+    for path in unset_data:
+        parts = path.split('.')
+        try:
+            target = _resolve(state, parts[:-1])
+        except (IndexError, ValueError, TypeError):
+            continue
+        if isinstance(target, list):
+            index = int(parts[-1])
+            if index < len(target):
+                target[index] = None
+        elif isinstance(target, dict):
+            target.pop(parts[-1], None)
+    return state
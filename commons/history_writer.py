@@ -0,0 +1,263 @@
+# !/usr/bin/python
+# -*- coding:utf-8 -*-
+"""
+历史记录异步写入(写回)
+
+历史记录先放入进程内有界队列， 后台任务每隔 HISTORY_FLUSH_INTERVAL_MS 毫秒或累计 HISTORY_FLUSH_BATCH_SIZE
+条后按集合 insert_many 批量写入， 写确认级别为 HISTORY_WRITE_CONCERN； 应用关闭时写入剩余记录。
+队列已满或写入失败的记录追加到 HISTORY_SPILL_DIR 下的文件， 启动时重新写入。
+(ref_id, seq) 唯一索引冲突(多个进程基于同一版本保存)的记录改为快照并使用新的版本号重新写入， 参考 basedoc.rebase_history。
+后台任务未启动时(如脚本中)直接同步写入。
+"""
+
+import asyncio
+import glob
+import os
+import threading
+from collections import deque
+
+from bson import json_util
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+from pymongo.write_concern import WriteConcern
+
+import settings
+from commons import logging
+
+logger = logging.get_logging()
+
+
+def _is_seq_conflict(collection, error, son):
+    """
+    是否为 (ref_id, seq) 唯一索引冲突， 其余的重复键错误为 _id 重复(重复写入)
+    :param collection: 历史记录集合
+    :param error: writeErrors 中的错误或 DuplicateKeyError.details
+    :param son: 写入的记录
+    :return:
+    """
+    key_pattern = error.get('keyPattern')
+    if key_pattern:
+        return 'seq' in key_pattern
+    # 服务端未返回 keyPattern 时按 _id 是否已存在判断
+    return collection.find_one({'_id': son['_id']}, {'_id': 1}) is None
+
+
+class HistoryWriter(object):
+    def __init__(self,
+                 max_size=settings.HISTORY_QUEUE_MAX_SIZE,
+                 batch_size=settings.HISTORY_FLUSH_BATCH_SIZE,
+                 interval_ms=settings.HISTORY_FLUSH_INTERVAL_MS,
+                 write_concern=settings.HISTORY_WRITE_CONCERN,
+                 spill_dir=settings.HISTORY_SPILL_DIR):
+        self.max_size = max_size
+        self.batch_size = batch_size
+        self.interval_ms = interval_ms
+        self.write_concern = write_concern
+        self.spill_dir = spill_dir
+        # (集合名, 文档)
+        self._queue = deque()
+        self._lock = threading.Lock()
+        self._spill_lock = threading.Lock()
+        self._loop = None
+        self._wakeup = None
+        self._task = None
+
+    @property
+    def running(self):
+        return self._task is not None
+
+    def _collection(self, collection_name):
+        from basedoc import History, ensure_history_indexes
+        ensure_history_indexes(collection_name)
+        return History._get_db().get_collection(
+            collection_name, write_concern=WriteConcern(w=self.write_concern))
+
+    def put(self, collection_name, son):
+        """
+        写入一条历史记录
+        :param collection_name: 历史记录集合名
+        :param son: 历史记录文档(to_mongo())
+        :return:
+        """
+        self.put_many(collection_name, [son])
+
+    def put_many(self, collection_name, sons):
+        """
+        写入多条历史记录
+        :param collection_name: 历史记录集合名
+        :param sons: 历史记录文档列表
+        :return:
+        """
+        if not sons:
+            return
+        if not self.running:
+            self._insert(collection_name, sons)
+            return
+        overflow = []
+        with self._lock:
+            for son in sons:
+                if len(self._queue) < self.max_size:
+                    self._queue.append((collection_name, son))
+                else:
+                    overflow.append(son)
+            size = len(self._queue)
+        if overflow:
+            self._spill(collection_name, overflow)
+        if self.batch_size and size >= self.batch_size:
+            # put 可能在线程池中调用
+            self._loop.call_soon_threadsafe(self._wakeup.set)
+
+    def _insert(self, collection_name, sons):
+        collection = None
+        try:
+            collection = self._collection(collection_name)
+            collection.insert_many(sons, ordered=False)
+        except BulkWriteError as e:
+            # insert_many 已为文档生成 _id， 重复写入的记录忽略， 版本号冲突的记录重新写入， 其余记录溢出到本地文件
+            failed, conflicts = [], []
+            for error in e.details.get('writeErrors', []):
+                son = sons[error['index']]
+                if error.get('code') != 11000:
+                    failed.append(son)
+                elif _is_seq_conflict(collection, error, son):
+                    conflicts.append(son)
+            logger.error('[history][%s]%s' % (collection_name, e))
+            if failed:
+                self._spill(collection_name, failed)
+            for son in conflicts:
+                self._rebase(collection_name, son)
+        except Exception as e:
+            logger.error('[history][%s]%s' % (collection_name, e))
+            self._spill(collection_name, sons)
+
+    def _rebase(self, collection_name, son, retries=3):
+        """
+        版本号冲突的记录改为快照并使用新的版本号写入
+        :param collection_name: 历史记录集合名
+        :param son: 版本号冲突的记录
+        :param retries: 再次冲突时的重试次数
+        :return:
+        """
+        from basedoc import rebase_history
+        collection = self._collection(collection_name)
+        for _ in range(retries):
+            try:
+                son = rebase_history(collection_name, son)
+                if son is None:
+                    logger.error('[history][%s][rebase]cannot restore previous version' % collection_name)
+                    return
+                collection.insert_one(son)
+                return
+            except DuplicateKeyError as e:
+                if not _is_seq_conflict(collection, e.details or {}, son):
+                    return
+            except Exception as e:
+                logger.error('[history][%s][rebase]%s' % (collection_name, e))
+                self._spill(collection_name, [son])
+                return
+        logger.error('[history][%s][rebase]seq conflict %s' % (collection_name, son.get('ref_id')))
+
+    def _spill_file(self):
+        return os.path.join(self.spill_dir, 'spill_%s.jsonl' % os.getpid())
+
+    def _spill(self, collection_name, sons):
+        """
+        追加到本地文件
+        :param collection_name: 历史记录集合名
+        :param sons: 历史记录文档列表
+        :return:
+        """
+        try:
+            with self._spill_lock:
+                os.makedirs(self.spill_dir, exist_ok=True)
+                with open(self._spill_file(), 'a', encoding='utf-8') as f:
+                    for son in sons:
+                        f.write(json_util.dumps({'c': collection_name, 'd': son}) + '\n')
+        except Exception as e:
+            logger.error('[history][spill][%s]%s' % (collection_name, e))
+
+    def flush(self):
+        """
+        将队列中的记录按集合批量写入
+        :return: 写入的记录数量
+        """
+        with self._lock:
+            items, self._queue = self._queue, deque()
+        if not items:
+            return 0
+        groups = {}
+        for collection_name, son in items:
+            groups.setdefault(collection_name, []).append(son)
+        for collection_name, sons in groups.items():
+            for i in range(0, len(sons), self.batch_size or len(sons)):
+                self._insert(collection_name, sons[i:i + (self.batch_size or len(sons))])
+        return len(items)
+
+    def recover(self):
+        """
+        重新写入溢出到本地文件的记录
+        :return: 写入的记录数量
+        """
+        recovered = 0
+        for path in glob.glob(os.path.join(self.spill_dir, 'spill_*.jsonl')):
+            # 重命名后处理， 避免多个进程重复写入
+            claimed = '%s.%s.replay' % (path, os.getpid())
+            try:
+                os.rename(path, claimed)
+            except OSError:
+                continue
+            groups = {}
+            with open(claimed, encoding='utf-8') as f:
+                for line in f:
+                    if line.strip():
+                        item = json_util.loads(line)
+                        groups.setdefault(item['c'], []).append(item['d'])
+            for collection_name, sons in groups.items():
+                self._insert(collection_name, sons)
+                recovered += len(sons)
+            os.remove(claimed)
+        return recovered
+
+    async def _run(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.interval_ms / 1000.0)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await loop.run_in_executor(None, self.flush)
+            except Exception as e:
+                logger.error('[history]%s' % e)
+
+    async def start(self):
+        """
+        启动定时写入任务， 并重新写入溢出的记录
+        :return:
+        """
+        if self._task:
+            return
+        self._loop = asyncio.get_event_loop()
+        self._wakeup = asyncio.Event()
+        try:
+            await self._loop.run_in_executor(None, self.recover)
+        except Exception as e:
+            logger.error('[history][recover]%s' % e)
+        self._task = asyncio.ensure_future(self._run())
+
+    async def stop(self):
+        """
+        停止定时写入任务并写入剩余记录
+        :return:
+        """
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await asyncio.get_event_loop().run_in_executor(None, self.flush)
+
+
+HistoryQueue = HistoryWriter()
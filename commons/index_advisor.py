@@ -0,0 +1,386 @@
+# !/usr/bin/python
+# -*- coding:utf-8 -*-
+"""
+索引建议
+
+INDEX_ADVISOR_CAPTURE 启用时， MongoMonitor 将每个查询命令的形状(等值字段、排序、范围字段、投影)
+交给 IndexAdvisor 统计， 也可通过 capture_profile 读取数据库 system.profile 中的记录。
+analyze 对高频形状执行 explain(传入的客户端或 INDEX_ADVISOR_URI， 应为本地或预发布环境， 不使用应用的数据库连接)，
+对使用 COLLSCAN 或内存 SORT
+的形状按 等值-排序-范围(ESR) 顺序生成 meta['indexes'] 建议， 已有索引可覆盖的不再重复建议。
+形状可通过 shapes/load_shapes 导出后在其他环境分析。INDEX_ADVISOR_REDACT 启用时形状的查询样例中的值替换为 '?'，
+explain 使用替换后的样例(只影响范围条件的扫描区间， 不影响是否使用索引及内存 SORT 的判断)。
+
+INDEX_ENSURE_AT_STARTUP 启用时， 应用启动后在后台线程中以 background 方式创建所有文档类声明的索引。
+"""
+
+import asyncio
+import json
+import threading
+
+import pymongo
+from bson import json_util
+
+import settings
+from commons import logging
+
+logger = logging.get_logging()
+
+# 逻辑组合， 只合并 $and 中的条件
+_LOGICAL_OPERATORS = frozenset(['$or', '$nor', '$text', '$where', '$expr', '$comment'])
+# 视为等值匹配的操作符
+_EQUALITY_OPERATORS = frozenset(['$eq', '$in', '$elemMatch'])
+
+
+def _filter_fields(filtered, equality, ranges):
+    """
+    按等值/范围分类查询条件中的字段
+    :param filtered: 查询条件
+    :param equality: 等值字段集合
+    :param ranges: 范围字段集合
+    :return:
+    """
+    for key, value in (filtered or {}).items():
+        if key == '$and':
+            for item in value:
+                _filter_fields(item, equality, ranges)
+        elif key in _LOGICAL_OPERATORS or key.startswith('$'):
+            continue
+        elif isinstance(value, dict) and any(k.startswith('$') for k in value):
+            if set(value) <= _EQUALITY_OPERATORS:
+                equality.add(key)
+            else:
+                ranges.add(key)
+        else:
+            equality.add(key)
+
+
+def _command_queries(command_name, command):
+    """
+    从命令中提取 (查询条件, 排序, 投影)
+    :param command_name: 命令名
+    :param command: 命令
+    :return: 列表
+    """
+    if command_name == 'find':
+        return [(command.get('filter'), command.get('sort'), command.get('projection'))]
+    if command_name in ('count', 'distinct'):
+        return [(command.get('query'), None, None)]
+    if command_name == 'findAndModify':
+        return [(command.get('query'), command.get('sort'), None)]
+    if command_name == 'delete':
+        return [(item.get('q'), None, None) for item in command.get('deletes', ())]
+    if command_name == 'update':
+        return [(item.get('q'), None, None) for item in command.get('updates', ())]
+    if command_name == 'aggregate':
+        filtered, sort = None, None
+        for stage in command.get('pipeline', ()):
+            if '$match' in stage and filtered is None and sort is None:
+                filtered = stage['$match']
+            elif '$sort' in stage and sort is None:
+                sort = stage['$sort']
+            else:
+                break
+        if filtered is not None or sort is not None:
+            return [(filtered, sort, None)]
+    return []
+
+
+def _plan_stages(plan, result):
+    """
+    收集执行计划中的所有阶段
+    :param plan: winningPlan
+    :param result: 阶段名集合
+    :return:
+    """
+    if not isinstance(plan, dict):
+        return result
+    if 'stage' in plan:
+        result.add(plan['stage'])
+    for key in ('inputStage', 'queryPlan', 'outerStage', 'innerStage'):
+        _plan_stages(plan.get(key), result)
+    for item in plan.get('inputStages', ()):
+        _plan_stages(item, result)
+    return result
+
+
+def _find_document_cls(collection_name):
+    from mongoengine.base.common import _document_registry
+    for document_cls in _document_registry.values():
+        if document_cls._meta.get('abstract'):
+            continue
+        if document_cls._get_collection_name() == collection_name:
+            return document_cls
+    return None
+
+
+def _index_fields(document_cls, keys):
+    """
+    数据库字段索引键转换为 meta['indexes'] 字段名列表
+    :param document_cls: 文档类， None 时使用数据库字段
+    :param keys: [(数据库字段, 1/-1)]
+    :return:
+    """
+    result = []
+    for db_field, direction in keys:
+        name, sep, sub = db_field.partition('.')
+        if document_cls is not None:
+            name = 'id' if name == '_id' else document_cls._reverse_db_field_map.get(name, name)
+        result.append(('-' if direction == -1 else '') + name + sep + sub)
+    return result
+
+
+class _QueryShape(object):
+    __slots__ = ('database', 'collection', 'equality', 'sort', 'ranges', 'projection', 'count', 'sample')
+
+    def __init__(self, database, collection, equality, sort, ranges, projection, sample):
+        self.database = database
+        self.collection = collection
+        self.equality = equality
+        self.sort = sort
+        self.ranges = ranges
+        self.projection = projection
+        self.count = 0
+        # 第一次出现时的查询条件， 用于 explain， INDEX_ADVISOR_REDACT 启用时值替换为 '?'
+        self.sample = sample
+
+    def suggested_keys(self):
+        """
+        按 等值-排序-范围 顺序的索引键
+        :return: [(数据库字段, 1/-1)]
+        """
+        keys, seen = [], set()
+        for field, direction in ([(f, 1) for f in self.equality] + list(self.sort) + [(f, 1) for f in self.ranges]):
+            if field not in seen:
+                seen.add(field)
+                keys.append((field, direction))
+        if [field for field, _ in keys] == ['_id']:
+            return []
+        return keys
+
+    def to_dict(self):
+        return {
+            'namespace': '%s.%s' % (self.database, self.collection),
+            'equality': list(self.equality),
+            'sort': [list(item) for item in self.sort],
+            'ranges': list(self.ranges),
+            'projection': list(self.projection),
+            'count': self.count,
+            # 扩展JSON， 便于通过接口导出
+            'sample': json.loads(json_util.dumps(self.sample)),
+        }
+
+
+class IndexAdvisorRecorder(object):
+    def __init__(self, max_shapes=settings.INDEX_ADVISOR_MAX_SHAPES):
+        self.max_shapes = max_shapes
+        self._lock = threading.Lock()
+        # {形状键: _QueryShape}
+        self._shapes = {}
+        self._task = None
+        self._client = None
+
+    @property
+    def capturing(self):
+        return settings.INDEX_ADVISOR_CAPTURE
+
+    def record(self, database, command_name, command):
+        """
+        记录命令中的查询形状
+        :param database: 数据库名
+        :param command_name: 命令名
+        :param command: 命令
+        :return:
+        """
+        collection = command.get(command_name)
+        if not isinstance(collection, str) or collection.startswith('system.'):
+            return
+        for filtered, sort, projection in _command_queries(command_name, command):
+            self._record(database, collection, filtered, sort, projection)
+
+    def _record(self, database, collection, filtered, sort, projection, count=1):
+        equality, ranges = set(), set()
+        _filter_fields(filtered, equality, ranges)
+        ranges -= equality
+        sort = tuple((k, -1 if v == -1 else 1) for k, v in (sort or {}).items() if isinstance(v, (int, float)))
+        projection = tuple(sorted(projection or ()))
+        equality, ranges = tuple(sorted(equality)), tuple(sorted(ranges))
+        key = (database, collection, equality, sort, ranges, projection)
+        with self._lock:
+            shape = self._shapes.get(key)
+            if shape is None:
+                if len(self._shapes) >= self.max_shapes:
+                    return
+                filtered = filtered or {}
+                if settings.INDEX_ADVISOR_REDACT:
+                    from commons.mongo_monitor import redact
+                    filtered = redact(filtered)
+                shape = self._shapes[key] = _QueryShape(database, collection, equality, sort, ranges, projection,
+                                                        {'filter': filtered, 'sort': dict(sort)})
+            shape.count += count
+
+    def capture_profile(self, db, limit=1000):
+        """
+        读取数据库性能分析器(db.setProfilingLevel)记录的慢操作
+        :param db: pymongo Database
+        :param limit: 读取数量
+        :return: 读取的记录数量
+        """
+        count = 0
+        for item in db['system.profile'].find({'command': {'$exists': True}}, sort=[('ts', -1)], limit=limit):
+            command = item['command']
+            if command:
+                self.record(db.name, next(iter(command)), command)
+                count += 1
+        return count
+
+    def shapes(self, min_count=1):
+        """
+        已记录的查询形状， 按次数倒序
+        :param min_count: 最少次数
+        :return: dict列表
+        """
+        with self._lock:
+            shapes = [shape for shape in self._shapes.values() if shape.count >= min_count]
+        return [shape.to_dict() for shape in sorted(shapes, key=lambda s: -s.count)]
+
+    def load_shapes(self, items):
+        """
+        导入其他环境导出的查询形状
+        :param items: shapes() 的结果
+        :return:
+        """
+        for item in items:
+            database, collection = item['namespace'].split('.', 1)
+            sample = json_util.loads(json.dumps(item.get('sample') or {}))
+            projection = {field: 1 for field in item.get('projection', ())}
+            self._record(database, collection, sample.get('filter'), sample.get('sort'), projection,
+                         item.get('count', 1))
+
+    def reset(self):
+        with self._lock:
+            self._shapes = {}
+
+    def explain_client(self):
+        """
+        执行 explain 的客户端(INDEX_ADVISOR_URI)， 首次使用时创建
+        :return: pymongo MongoClient
+        """
+        if not settings.INDEX_ADVISOR_URI:
+            raise RuntimeError('settings.INDEX_ADVISOR_URI is not set, pass a client to analyze')
+        with self._lock:
+            if self._client is None:
+                self._client = pymongo.MongoClient(settings.INDEX_ADVISOR_URI)
+            return self._client
+
+    def analyze(self, client=None, database=None, min_count=settings.INDEX_ADVISOR_MIN_COUNT,
+                top=settings.INDEX_ADVISOR_TOP):
+        """
+        对高频查询形状执行 explain 并生成索引建议
+        :param client: pymongo MongoClient， 默认使用 INDEX_ADVISOR_URI 的连接， 未设置时抛出 RuntimeError
+        :param database: 数据库名， 默认使用记录的数据库
+        :param min_count: 最少次数
+        :param top: 最多分析的形状数量
+        :return: 建议列表 [{'namespace', 'document', 'count', 'stages', 'keys', 'index'}]
+        """
+        if client is None:
+            client = self.explain_client()
+        with self._lock:
+            shapes = sorted([shape for shape in self._shapes.values() if shape.count >= min_count],
+                            key=lambda s: -s.count)[:top]
+
+        result, indexes = [], {}
+        for shape in shapes:
+            db = client[database or shape.database]
+            command = {'find': shape.collection, 'filter': shape.sample['filter']}
+            if shape.sort:
+                command['sort'] = shape.sample['sort']
+            if shape.projection:
+                command['projection'] = {field: 1 for field in shape.projection}
+            try:
+                explain = db.command('explain', command, verbosity='queryPlanner')
+            except Exception as e:
+                logger.error('[index_advisor][%s.%s]%s' % (db.name, shape.collection, e))
+                continue
+            stages = _plan_stages(explain.get('queryPlanner', {}).get('winningPlan'), set())
+            flagged = sorted(stages & {'COLLSCAN', 'SORT'})
+            keys = shape.suggested_keys()
+            if not flagged or not keys:
+                continue
+
+            namespace = '%s.%s' % (db.name, shape.collection)
+            if namespace not in indexes:
+                try:
+                    indexes[namespace] = [list(item['key']) for item in
+                                          db[shape.collection].index_information().values()]
+                except Exception as e:
+                    logger.error('[index_advisor][%s]%s' % (namespace, e))
+                    indexes[namespace] = []
+            # 已有索引或已建议的索引以该索引为前缀时不再建议
+            if any(existing[:len(keys)] == keys for existing in indexes[namespace]):
+                continue
+            indexes[namespace].append(keys)
+
+            document_cls = _find_document_cls(shape.collection)
+            result.append({
+                'namespace': namespace,
+                'document': document_cls.__name__ if document_cls else None,
+                'count': shape.count,
+                'stages': flagged,
+                'keys': keys,
+                'index': {'fields': _index_fields(document_cls, keys)},
+            })
+        # 被其他建议覆盖的前缀索引
+        return [item for item in result
+                if not any(other is not item and other['namespace'] == item['namespace']
+                           and len(other['keys']) > len(item['keys'])
+                           and other['keys'][:len(item['keys'])] == item['keys'] for other in result)]
+
+    def ensure_declared_indexes(self):
+        """
+        以 background 方式创建所有已加载文档类声明的索引， 不修改文档类的 meta；
+        非 ModelBase 的文档类按其 meta['index_background'] 创建
+        :return: 处理的文档类数量
+        """
+        from mongoengine.base.common import _document_registry
+        from basedoc import ModelBase
+        count = 0
+        for document_cls in list(_document_registry.values()):
+            meta = document_cls._meta
+            if meta.get('abstract') or not meta.get('index_specs'):
+                continue
+            # 嵌入文档没有集合
+            if not hasattr(document_cls, 'ensure_indexes'):
+                continue
+            try:
+                if issubclass(document_cls, ModelBase):
+                    document_cls.ensure_indexes(background=True)
+                else:
+                    document_cls.ensure_indexes()
+                count += 1
+            except Exception as e:
+                logger.error('[index_advisor][%s]%s' % (document_cls.__name__, e))
+        return count
+
+    async def start(self):
+        """
+        INDEX_ENSURE_AT_STARTUP 启用时在后台线程中创建声明的索引， 不阻塞启动
+        :return:
+        """
+        if self._task or not settings.INDEX_ENSURE_AT_STARTUP:
+            return
+        self._task = asyncio.get_event_loop().run_in_executor(None, self.ensure_declared_indexes)
+
+    async def stop(self):
+        """
+        线程中的索引创建无法取消， 关闭时不等待
+        :return:
+        """
+        self._task = None
+        with self._lock:
+            if self._client is not None:
+                self._client.close()
+                self._client = None
+
+
+IndexAdvisor = IndexAdvisorRecorder()
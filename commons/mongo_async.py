@@ -0,0 +1,155 @@
+# !/usr/bin/python
+# -*- coding:utf-8 -*-
+"""
+异步数据访问(motor)
+
+与 mongoengine 共用 MongoDBConf 的连接URI及连接池选项， 查询条件、排序及投影中的类字段名
+按 BaseDocument.get_translator 映射为数据库字段， 查询结果映射为文档对象或dict。
+用于 async def 处理函数中， 避免阻塞事件循环。
+与 SoftDeleteQuerySet 一致， 查询条件默认附加 is_delete: False(查询条件中已包含顶层 is_delete 条件时不再附加)，
+with_deleted=True 时包含已删除文档； 聚合管道不附加。
+"""
+
+import settings
+from commons.mongo_util import MongoDBConf
+
+
+class AsyncCollection(object):
+    def __init__(self, document_cls, as_dict=False, with_deleted=False):
+        """
+        :param document_cls: BaseDocument 子类
+        :param as_dict: True 返回dict(数据库字段)， False 返回文档对象
+        :param with_deleted: 是否包含已删除(is_delete=True)的文档
+        """
+        self.document_cls = document_cls
+        self.as_dict = as_dict
+        self.with_deleted = with_deleted
+        self._collection = None
+
+    @property
+    def collection(self):
+        if self._collection is None:
+            db_alias = self.document_cls._meta.get('db_alias')
+            # 连接别名与数据库名称一致， 参考 MongoDBConf._register
+            db_name = db_alias if db_alias and db_alias != 'default' else settings.DB_NAME
+            self._collection = MongoDBConf().get_async_database(db_name)[
+                self.document_cls._get_collection_name()]
+        return self._collection
+
+    def _soft_delete_field(self):
+        if self.with_deleted or not self.document_cls._meta.get('soft_delete', True):
+            return None
+        field = self.document_cls._fields.get('is_delete')
+        return field.db_field if field else None
+
+    def _filter(self, filtered):
+        filtered = self.document_cls.map_db_filter(filtered or {})
+        db_field = self._soft_delete_field()
+        if db_field and db_field not in filtered:
+            filtered = dict(filtered, **{db_field: False})
+        return filtered
+
+    def _sort(self, sort):
+        """
+        映射排序， 支持 ['-created_time', 'name'] 或 [('created_time', -1)]
+        :param sort:
+        :return:
+        """
+        return self.document_cls.map_db_sort(sort)
+
+    def _projection(self, projection):
+        """
+        映射投影， 支持字段名列表或 {字段名: 0/1}
+        :param projection:
+        :return:
+        """
+        return self.document_cls.map_db_projection(projection)
+
+    def _to_result(self, son):
+        if son is None or self.as_dict:
+            return son
+        return self.document_cls._from_son(son)
+
+    def _cursor(self, filtered=None, projection=None, sort=None, skip=0, limit=0, batch_size=0):
+        cursor = self.collection.find(self._filter(filtered), self._projection(projection))
+        sort = self._sort(sort)
+        if sort:
+            cursor = cursor.sort(sort)
+        if skip:
+            cursor = cursor.skip(skip)
+        if limit:
+            cursor = cursor.limit(limit)
+        if batch_size:
+            cursor = cursor.batch_size(batch_size)
+        return cursor
+
+    async def find(self, filtered=None, projection=None, sort=None, skip=0, limit=0):
+        """
+        查询
+        :param filtered: 查询条件
+        :param projection: 投影
+        :param sort: 排序
+        :param skip: 跳过数量
+        :param limit: 限制数量， 0：不限
+        :return: 文档对象或dict列表
+        """
+        cursor = self._cursor(filtered, projection, sort, skip, limit)
+        return [self._to_result(son) for son in await cursor.to_list(length=limit or None)]
+
+    async def find_one(self, filtered=None, projection=None, sort=None):
+        """
+        查询单个
+        :param filtered: 查询条件
+        :param projection: 投影
+        :param sort: 排序
+        :return: 文档对象或dict， 不存在时返回None
+        """
+        son = await self.collection.find_one(self._filter(filtered), self._projection(projection),
+                                             sort=self._sort(sort))
+        return self._to_result(son)
+
+    async def iterate(self, filtered=None, projection=None, sort=None, skip=0, limit=0,
+                      batch_size=settings.OPT_ASYNC_BATCH_SIZE):
+        """
+        游标迭代， 按批从服务端读取
+        :param filtered: 查询条件
+        :param projection: 投影
+        :param sort: 排序
+        :param skip: 跳过数量
+        :param limit: 限制数量， 0：不限
+        :param batch_size: 每批数量
+        :return: 异步迭代器
+        """
+        async for son in self._cursor(filtered, projection, sort, skip, limit, batch_size):
+            yield self._to_result(son)
+
+    async def count(self, filtered=None):
+        """
+        统计数量
+        :param filtered: 查询条件
+        :return:
+        """
+        filtered = self._filter(filtered)
+        if not filtered:
+            return await self.collection.estimated_document_count()
+        return await self.collection.count_documents(filtered)
+
+    async def aggregate(self, pipeline, **kwargs):
+        """
+        聚合， 管道中的字段需使用数据库字段
+        :param pipeline: 聚合管道
+        :param kwargs: aggregate 其他参数
+        :return: dict列表
+        """
+        return await self.collection.aggregate(pipeline, **kwargs).to_list(length=None)
+
+    async def bulk_write(self, requests, ordered=False):
+        """
+        批量写入
+        :param requests: pymongo 写操作(InsertOne/UpdateOne/...)列表， 字段需使用数据库字段
+        :param ordered: 是否按顺序执行
+        :return: BulkWriteResult
+        """
+        if not requests:
+            return None
+        return await self.collection.bulk_write(requests, ordered=ordered)
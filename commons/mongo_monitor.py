@@ -0,0 +1,433 @@
+# !/usr/bin/python
+# -*- coding:utf-8 -*-
+"""
+数据库命令及连接池监控
+
+MongoDBConf 创建客户端时注册 pymongo CommandListener 及 ConnectionPoolListener， 记录：
+    - 按 集合、命令 统计的耗时直方图(区间上限 MONGO_MONITOR_BUCKETS)、失败次数及返回文档数量
+    - 按 服务器地址 统计的连接数、已借出连接数、借出连接等待耗时直方图及借出失败次数
+耗时超过 MONGO_SLOW_QUERY_MS 的命令记录到慢查询日志(LOG_NAME_MONGO)， 附带发起请求的路由
+(由 MongoMonitorMiddleware 通过 contextvars 传递)； MONGO_SLOW_QUERY_REDACT 启用时命令中的值替换为 '?'。
+统计数据通过 MongoMonitor.snapshot() 读取， 后台任务每隔 MONGO_MONITOR_LOG_INTERVAL 秒输出汇总日志。
+"""
+
+import asyncio
+import collections
+import contextvars
+import datetime
+import threading
+import time
+
+from bson import json_util
+from pymongo import monitoring
+
+import settings
+from commons import logging
+from commons.index_advisor import IndexAdvisor
+
+logger = logging.get_logging()
+mongo_logger = logging.get_logging('mongo', settings.LOG_NAME_MONGO)
+mongo_logger.setLevel(settings.LOG_LEVEL_MONGO)
+
+_ROUTE = contextvars.ContextVar('mongo_route', default=None)
+
+# 不统计的连接握手、认证及心跳命令
+_IGNORED_COMMANDS = frozenset([
+    'isMaster', 'ismaster', 'hello', 'ping', 'buildInfo', 'buildinfo', 'getnonce', 'authenticate',
+    'saslStart', 'saslContinue', 'endSessions', 'killCursors',
+])
+
+# 不含数据的命令参数， 慢查询日志中保留原值
+_PLAIN_ARGUMENTS = frozenset([
+    '$db', 'sort', 'projection', 'fields', 'hint', 'limit', 'skip', 'batchSize', 'singleBatch', 'ordered',
+    'key', 'new', 'upsert', 'remove', 'maxTimeMS', 'allowDiskUse',
+])
+
+
+# 参数不含数据的查询操作符， 保留原值使替换后的查询条件仍可执行(explain)
+_PLAIN_OPERATORS = frozenset(['$exists', '$type', '$size', '$options'])
+
+
+def redact(value):
+    """
+    值替换为 '?'， 保留字段名、操作符及 bool/None
+    :param value: 查询条件、文档或其中的值
+    :return:
+    """
+    if isinstance(value, dict):
+        return {key: item if key in _PLAIN_OPERATORS else redact(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [redact(item) for item in value]
+    if value is None or isinstance(value, bool):
+        return value
+    return '?'
+
+
+def redact_command(command_name, command):
+    """
+    命令中的查询条件及文档替换为 '?'， 集合名及排序、投影等参数保留
+    :param command_name: 命令名
+    :param command: 命令
+    :return: dict
+    """
+    return {key: value if key == command_name or key in _PLAIN_ARGUMENTS else redact(value)
+            for key, value in command.items()}
+
+
+class MongoMonitorMiddleware(object):
+    """
+    记录当前请求的路由， 用于慢查询日志
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] not in ('http', 'websocket'):
+            await self.app(scope, receive, send)
+            return
+        token = _ROUTE.set('%s %s' % (scope.get('method') or scope['type'].upper(), scope['path']))
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            _ROUTE.reset(token)
+
+
+class Histogram(object):
+    """
+    固定区间耗时直方图(单位：毫秒)
+    """
+    __slots__ = ('buckets', 'counts', 'count', 'total', 'max')
+
+    def __init__(self, buckets=settings.MONGO_MONITOR_BUCKETS):
+        self.buckets = buckets
+        # 最后一个区间为超过最大区间上限的部分
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, value):
+        index = 0
+        while index < len(self.buckets) and value > self.buckets[index]:
+            index += 1
+        self.counts[index] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        for index, value in enumerate(other.counts):
+            self.counts[index] += value
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    def percentile(self, percent):
+        """
+        估算百分位数， 返回所在区间的上限
+        :param percent: 0-100
+        :return:
+        """
+        if not self.count:
+            return 0
+        rank = self.count * percent / 100.0
+        accumulated = 0
+        for index, value in enumerate(self.counts):
+            accumulated += value
+            if accumulated >= rank:
+                return self.buckets[index] if index < len(self.buckets) else self.max
+        return self.max
+
+    def to_dict(self):
+        return {
+            'count': self.count,
+            'avg': round(self.total / self.count, 3) if self.count else 0,
+            'max': round(self.max, 3),
+            'p50': self.percentile(50),
+            'p95': self.percentile(95),
+            'p99': self.percentile(99),
+            'buckets': {('<=%s' % b if i < len(self.buckets) else '>%s' % self.buckets[-1]): c
+                        for i, (b, c) in enumerate(zip(list(self.buckets) + [self.buckets[-1]], self.counts))},
+        }
+
+
+class _CommandStats(object):
+    __slots__ = ('latency', 'failures', 'docs')
+
+    def __init__(self):
+        self.latency = Histogram()
+        self.failures = 0
+        self.docs = 0
+
+
+class _PoolStats(object):
+    __slots__ = ('created', 'closed', 'checked_out', 'checkout_failures', 'cleared', 'wait')
+
+    def __init__(self):
+        self.created = 0
+        self.closed = 0
+        self.checked_out = 0
+        self.checkout_failures = collections.Counter()
+        self.cleared = 0
+        self.wait = Histogram()
+
+    def to_dict(self):
+        return {
+            'connections': self.created - self.closed,
+            'checked_out': self.checked_out,
+            'created': self.created,
+            'closed': self.closed,
+            'cleared': self.cleared,
+            'checkout_failures': dict(self.checkout_failures),
+            'checkout_wait': self.wait.to_dict(),
+        }
+
+
+def _collection_name(command_name, command):
+    if command_name == 'getMore':
+        return command.get('collection')
+    value = command.get(command_name)
+    # 数据库级别的命令(如 aggregate: 1)
+    return value if isinstance(value, str) else None
+
+
+def _returned_docs(reply):
+    cursor = reply.get('cursor')
+    if isinstance(cursor, dict):
+        return len(cursor.get('firstBatch', cursor.get('nextBatch', ())))
+    if 'value' in reply:
+        # findAndModify
+        return 1 if reply['value'] is not None else 0
+    return 0
+
+
+class MongoCommandMonitor(monitoring.CommandListener, monitoring.ConnectionPoolListener):
+    def __init__(self, slow_ms=settings.MONGO_SLOW_QUERY_MS, keep=settings.MONGO_SLOW_QUERY_KEEP,
+                 log_interval=settings.MONGO_MONITOR_LOG_INTERVAL, log_top=settings.MONGO_MONITOR_LOG_TOP):
+        self.slow_ms = slow_ms
+        self.log_interval = log_interval
+        self.log_top = log_top
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        # {(request_id, connection_id): (数据库, 集合, 命令名, 命令, 路由)}
+        self._pending = {}
+        # {(数据库.集合, 命令名): _CommandStats}
+        self._commands = {}
+        # {地址: _PoolStats}
+        self._pools = {}
+        self._slow_queries = collections.deque(maxlen=keep)
+        self._started_at = datetime.datetime.now()
+        self._task = None
+
+    def listeners(self):
+        """
+        客户端的 event_listeners 参数
+        :return:
+        """
+        return [self] if settings.MONGO_MONITOR_ENABLE else []
+
+    # CommandListener
+
+    def started(self, event):
+        if event.command_name in _IGNORED_COMMANDS:
+            return
+        collection = _collection_name(event.command_name, event.command)
+        if IndexAdvisor.capturing:
+            IndexAdvisor.record(event.database_name, event.command_name, event.command)
+        with self._lock:
+            self._pending[(event.request_id, event.connection_id)] = (
+                event.database_name, collection, event.command_name, event.command, _ROUTE.get())
+
+    def _finish(self, event, reply):
+        with self._lock:
+            pending = self._pending.pop((event.request_id, event.connection_id), None)
+        if pending is None:
+            return
+        database, collection, command_name, command, route = pending
+        duration = event.duration_micros / 1000.0
+        namespace = '%s.%s' % (database, collection) if collection else database
+        with self._lock:
+            stats = self._commands.get((namespace, command_name))
+            if stats is None:
+                stats = self._commands[(namespace, command_name)] = _CommandStats()
+            stats.latency.add(duration)
+            if reply is None:
+                stats.failures += 1
+            else:
+                stats.docs += _returned_docs(reply)
+        if self.slow_ms and duration >= self.slow_ms:
+            self._log_slow(namespace, command_name, command, route, duration, reply is None)
+
+    def succeeded(self, event):
+        self._finish(event, event.reply)
+
+    def failed(self, event):
+        self._finish(event, None)
+
+    def _log_slow(self, namespace, command_name, command, route, duration, failed):
+        if settings.MONGO_SLOW_QUERY_REDACT:
+            command = redact_command(command_name, command)
+        try:
+            text = json_util.dumps(command)
+        except Exception:
+            text = repr(command)
+        text = text[:settings.MONGO_SLOW_QUERY_MAX_LENGTH]
+        self._slow_queries.append({
+            'time': datetime.datetime.now().strftime(settings.TIME_FORMAT),
+            'namespace': namespace,
+            'command': command_name,
+            'duration': round(duration, 3),
+            'route': route,
+            'failed': failed,
+            'detail': text,
+        })
+        mongo_logger.warning('[mongo][slow][%s][%s][%.1fms][%s]%s' % (namespace, command_name, duration, route, text))
+
+    # ConnectionPoolListener
+
+    def _pool(self, address):
+        stats = self._pools.get(address)
+        if stats is None:
+            stats = self._pools[address] = _PoolStats()
+        return stats
+
+    def pool_created(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        with self._lock:
+            self._pool(event.address).cleared += 1
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_created(self, event):
+        with self._lock:
+            self._pool(event.address).created += 1
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        with self._lock:
+            self._pool(event.address).closed += 1
+
+    def connection_check_out_started(self, event):
+        # 同一线程中依次触发 check_out_started 及 checked_out/check_out_failed
+        if not hasattr(self._local, 'checkout'):
+            self._local.checkout = {}
+        self._local.checkout[event.address] = time.perf_counter()
+
+    def _checkout_wait(self, address):
+        started = getattr(self._local, 'checkout', {}).pop(address, None)
+        return (time.perf_counter() - started) * 1000 if started is not None else None
+
+    def connection_checked_out(self, event):
+        wait = self._checkout_wait(event.address)
+        with self._lock:
+            stats = self._pool(event.address)
+            stats.checked_out += 1
+            if wait is not None:
+                stats.wait.add(wait)
+
+    def connection_check_out_failed(self, event):
+        wait = self._checkout_wait(event.address)
+        with self._lock:
+            stats = self._pool(event.address)
+            stats.checkout_failures[str(event.reason)] += 1
+            if wait is not None:
+                stats.wait.add(wait)
+
+    def connection_checked_in(self, event):
+        with self._lock:
+            self._pool(event.address).checked_out -= 1
+
+    # 统计
+
+    def snapshot(self):
+        """
+        当前统计数据
+        :return: dict
+        """
+        with self._lock:
+            commands = {key: (stats.latency, stats.failures, stats.docs) for key, stats in self._commands.items()}
+            pools = {'%s:%s' % address: stats.to_dict() for address, stats in self._pools.items()}
+            by_collection, by_command, detail = {}, {}, []
+            for (namespace, command_name), (latency, failures, docs) in commands.items():
+                for group, key in ((by_collection, namespace), (by_command, command_name)):
+                    if key not in group:
+                        group[key] = Histogram()
+                    group[key].merge(latency)
+                detail.append(dict(latency.to_dict(), namespace=namespace, command=command_name,
+                                   failures=failures, docs=docs))
+            slow_queries = list(self._slow_queries)
+        detail.sort(key=lambda item: -item['avg'] * item['count'])
+        return {
+            'since': self._started_at.strftime(settings.TIME_FORMAT),
+            'collections': {key: value.to_dict() for key, value in by_collection.items()},
+            'commands': {key: value.to_dict() for key, value in by_command.items()},
+            'detail': detail,
+            'pools': pools,
+            'slow_queries': slow_queries,
+        }
+
+    def reset(self):
+        """
+        清空命令统计及慢查询， 连接数统计保留
+        :return:
+        """
+        with self._lock:
+            self._commands = {}
+            self._slow_queries.clear()
+            self._started_at = datetime.datetime.now()
+
+    def log_summary(self):
+        """
+        输出汇总日志： 总耗时最高的命令及连接池状态
+        :return:
+        """
+        snapshot = self.snapshot()
+        for item in snapshot['detail'][:self.log_top]:
+            mongo_logger.warning('[mongo][summary][%s][%s]count=%s avg=%s p95=%s max=%s failures=%s docs=%s' % (
+                item['namespace'], item['command'], item['count'], item['avg'], item['p95'], item['max'],
+                item['failures'], item['docs']))
+        for address, pool in snapshot['pools'].items():
+            wait = pool['checkout_wait']
+            mongo_logger.warning('[mongo][pool][%s]connections=%s checked_out=%s wait_p95=%s wait_max=%s failures=%s' % (
+                address, pool['connections'], pool['checked_out'], wait['p95'], wait['max'],
+                sum(pool['checkout_failures'].values())))
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.log_interval)
+            try:
+                self.log_summary()
+            except Exception as e:
+                logger.error('[mongo][summary]%s' % e)
+
+    async def start(self):
+        """
+        启动汇总日志任务
+        :return:
+        """
+        if self._task or not self.log_interval or not settings.MONGO_MONITOR_ENABLE:
+            return
+        self._task = asyncio.ensure_future(self._run())
+
+    async def stop(self):
+        """
+        停止汇总日志任务
+        :return:
+        """
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+
+MongoMonitor = MongoCommandMonitor()
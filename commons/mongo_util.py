@@ -8,6 +8,7 @@ import settings
 from mongoengine import connect, disconnect, register_connection
 from urllib.parse import quote_plus
 from commons import logging
+from commons.mongo_monitor import MongoMonitor
 
 logger = logging.get_logging()
 
@@ -26,8 +27,10 @@ class MongoDBConf(object):
     _read_preference = 'secondaryPreferred'
     _write_sync_number = 0
     _distributed_cached_enable = False
+    _distributed_cached_timeout = None
 
     _db_client = None
+    _async_db_client = None
 
     def __init__(self):
         pass
@@ -49,8 +52,25 @@ class MongoDBConf(object):
             cls._read_preference = settings.OPT_READ_PREFERENCE if settings.OPT_READ_PREFERENCE else 'secondaryPreferred'
             cls._write_sync_number = settings.OPT_WRITE_SYNC_NUMBER if settings.OPT_WRITE_SYNC_NUMBER else 0
             cls._distributed_cached_enable = True if settings.OPT_DISTRIBUTED_CACHED_ENABLE else False
+            cls._distributed_cached_timeout = settings.OPT_DISTRIBUTED_CACHED_TIMEOUT or None
         return cls._instance
 
+    @property
+    def distributed_cached_enable(self):
+        """
+        是否启用数据库分布式缓存
+        :return:
+        """
+        return self._distributed_cached_enable
+
+    @property
+    def distributed_cached_timeout(self):
+        """
+        数据库分布式缓存数据超时时间(单位：秒)， None：永不超时
+        :return:
+        """
+        return self._distributed_cached_timeout
+
     def _register(self):
         """
         注册数据库
@@ -58,9 +78,11 @@ class MongoDBConf(object):
         """
         uri = self._get_connection_uri()
         logger.debug(f"connect addr:{uri}")
-        self._db_client = connect(settings.DB_NAME, host=uri)
+        # 命令及连接池监控， 参考 commons.mongo_monitor
+        event_listeners = MongoMonitor.listeners()
+        self._db_client = connect(settings.DB_NAME, host=uri, event_listeners=event_listeners)
         if settings.DB_NAME_HIS:
-            register_connection(settings.DB_NAME_HIS, settings.DB_NAME_HIS, host=uri)
+            register_connection(settings.DB_NAME_HIS, settings.DB_NAME_HIS, host=uri, event_listeners=event_listeners)
 
     def client(self):
         if not self._db_client:
@@ -71,6 +93,28 @@ class MongoDBConf(object):
         if self._db_client:
             disconnect(settings.DB_NAME)
             disconnect(settings.DB_NAME_HIS)
+        if self._async_db_client:
+            self._async_db_client.close()
+            self._async_db_client = None
+
+    def async_client(self):
+        """
+        获取异步客户端(motor)， 与同步客户端使用相同的连接URI及连接池选项
+        :return:
+        """
+        if not self._async_db_client:
+            from motor.motor_asyncio import AsyncIOMotorClient
+            self._async_db_client = AsyncIOMotorClient(self._get_connection_uri(),
+                                                       event_listeners=MongoMonitor.listeners())
+        return self._async_db_client
+
+    def get_async_database(self, db_name=None):
+        """
+        获取异步数据库连接
+        :param db_name: 数据库名称
+        :return:
+        """
+        return self.async_client()[db_name if db_name else self._db]
 
     def get_database(self, db_name=None):
         """
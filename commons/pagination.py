@@ -0,0 +1,216 @@
+# !/usr/bin/python
+# -*- coding:utf-8 -*-
+"""
+键集(seek)分页
+
+按排序字段的值定位下一页/上一页， 以范围条件代替 skip， 任一页的查询代价相同。
+排序固定以 _id 结尾保证唯一； 游标为签名后的边界文档排序字段值， 与集合及排序绑定，
+篡改或用于其他排序时抛出 InvalidCursor。排序字段需为顶层字段且不为空的标量，
+建议建立 查询条件字段 + 排序字段 的索引。
+查询集为 SoftDeleteQuerySet 时同样排除已删除文档。
+签名密钥 PAGINATION_SECRET 未设置或为公开的默认值时拒绝生成及校验游标。
+"""
+
+import base64
+import datetime
+import hashlib
+import hmac
+import json
+
+import pymongo
+from bson import Decimal128, ObjectId, json_util
+
+import settings
+
+DEFAULT_SORT = ('created_time', 'id')
+# 曾作为默认值公开的密钥， 不可使用
+_PUBLIC_SECRETS = ('dj-pagination-secret',)
+# 游标中允许的排序字段值类型， 解析结果会拼接到 __raw__ 查询条件中， 不允许dict(操作符)、数组及正则等
+_CURSOR_VALUE_TYPES = (type(None), bool, int, float, str, ObjectId, datetime.datetime, Decimal128)
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def check_secret():
+    """
+    校验游标签名密钥， 未设置或为公开的默认值时抛出 RuntimeError
+    :return: 密钥
+    """
+    secret = settings.PAGINATION_SECRET
+    if not secret or secret in _PUBLIC_SECRETS:
+        raise RuntimeError('settings.PAGINATION_SECRET is not set or is a public default')
+    return secret
+
+
+class KeysetPage(object):
+    """
+    一页结果
+    """
+
+    def __init__(self, items, next_cursor, prev_cursor, total=None, total_is_estimate=False):
+        self.items = items
+        self.next_cursor = next_cursor
+        self.prev_cursor = prev_cursor
+        self.total = total
+        self.total_is_estimate = total_is_estimate
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self.items)
+
+
+def _normalize_sort(document_cls, sort):
+    """
+    排序规范化为 [(类字段名, 数据库字段, 1/-1)]， 以 _id 结尾
+    :param document_cls: 文档类
+    :param sort: '-created_time'、 ['-created_time', 'id'] 或 [('created_time', -1)]
+    :return:
+    """
+    if isinstance(sort, str):
+        sort = [sort]
+    result = []
+    for item in sort or DEFAULT_SORT:
+        if isinstance(item, str):
+            direction = pymongo.DESCENDING if item.startswith('-') else pymongo.ASCENDING
+            item = (item.lstrip('+-'), direction)
+        name = 'id' if item[0] in ('id', 'pk', '_id') else item[0]
+        result.append((name, document_cls.get_db_field(name), item[1]))
+    if result[-1][1] != '_id':
+        result = [item for item in result if item[1] != '_id']
+        result.append(('id', '_id', result[-1][2] if result else pymongo.ASCENDING))
+    return result
+
+
+def _sign(data, scope):
+    return hmac.new(check_secret().encode('utf-8'), scope.encode('utf-8') + b'|' + data,
+                    hashlib.sha256).hexdigest()[:32]
+
+
+def _scope(document_cls, sort):
+    return '%s|%s' % (document_cls._get_collection_name(), ','.join('%s:%d' % (f, d) for _, f, d in sort))
+
+
+def encode_cursor(document_cls, sort, values, backward):
+    """
+    生成签名游标
+    :param document_cls: 文档类
+    :param sort: _normalize_sort 的结果
+    :param values: 边界文档的排序字段值(数据库格式)
+    :param backward: 是否为上一页游标
+    :return: str
+    """
+    data = base64.urlsafe_b64encode(json_util.dumps({'v': values, 'b': int(backward)}).encode('utf-8'))
+    return '%s.%s' % (data.decode('utf-8').rstrip('='), _sign(data.rstrip(b'='), _scope(document_cls, sort)))
+
+
+def decode_cursor(document_cls, sort, cursor):
+    """
+    校验并解析游标
+    :param document_cls: 文档类
+    :param sort: _normalize_sort 的结果
+    :param cursor: encode_cursor 的结果
+    :return: (排序字段值, 是否为上一页)
+    """
+    try:
+        data, signature = cursor.rsplit('.', 1)
+        data = data.encode('utf-8')
+        if not hmac.compare_digest(signature, _sign(data, _scope(document_cls, sort))):
+            raise InvalidCursor('invalid cursor signature')
+        payload = json_util.loads(base64.urlsafe_b64decode(data + b'=' * (-len(data) % 4)).decode('utf-8'))
+        values = payload['v']
+    except InvalidCursor:
+        raise
+    except (ValueError, KeyError, TypeError, json.JSONDecodeError) as e:
+        raise InvalidCursor('invalid cursor: %s' % e)
+    if not isinstance(values, list) or len(values) != len(sort):
+        raise InvalidCursor('invalid cursor: sort mismatch')
+    if not all(isinstance(value, _CURSOR_VALUE_TYPES) for value in values):
+        raise InvalidCursor('invalid cursor: unsupported value')
+    return values, bool(payload.get('b'))
+
+
+def seek_filter(sort, values, backward=False):
+    """
+    排序在边界文档之后(backward 时之前)的范围条件：
+    (f1 > v1) or (f1 = v1 and f2 > v2) or ...
+    :param sort: _normalize_sort 的结果
+    :param values: 边界文档的排序字段值
+    :param backward: 是否向前
+    :return: 原始查询条件
+    """
+    branches = []
+    for i, (_, db_field, direction) in enumerate(sort):
+        ascending = (direction == pymongo.ASCENDING) != backward
+        branch = {sort[j][1]: values[j] for j in range(i)}
+        branch[db_field] = {'$gt' if ascending else '$lt': values[i]}
+        branches.append(branch)
+    return {'$or': branches} if len(branches) > 1 else branches[0]
+
+
+def _sort_values(document_cls, sort, doc):
+    values = []
+    for name, db_field, _ in sort:
+        value = doc.pk if name == 'id' else getattr(doc, name)
+        field = document_cls._fields.get(name)
+        values.append(field.to_mongo(value) if field is not None and value is not None else value)
+    return values
+
+
+def approximate_total(queryset, limit=settings.PAGINATION_COUNT_LIMIT):
+    """
+    估算总数： 无查询条件时读取集合元数据， 否则最多计数到 limit；
+    集合元数据包含已删除文档， 查询集附加了软删除条件时同样计数
+    :param queryset: 查询集
+    :param limit: 计数上限， 0：不限
+    :return: (总数, 是否为估算值)
+    """
+    collection = queryset._collection
+    if not queryset._query:
+        return collection.estimated_document_count(), True
+    total = collection.count_documents(queryset._query, limit=limit) if limit else \
+        collection.count_documents(queryset._query)
+    return total, bool(limit) and total >= limit
+
+
+def paginate(queryset, limit=settings.PAGINATION_DEFAULT_LIMIT, cursor=None, sort=None, with_total=False):
+    """
+    键集分页
+    :param queryset: 查询集(已包含查询条件)
+    :param limit: 每页数量， 不超过 PAGINATION_MAX_LIMIT
+    :param cursor: 上一次返回的 next_cursor 或 prev_cursor， None 时为第一页
+    :param sort: 排序， 默认 ('created_time', 'id')
+    :param with_total: 是否返回(估算)总数
+    :return: KeysetPage
+    """
+    document_cls = queryset._document
+    limit = max(1, min(int(limit), settings.PAGINATION_MAX_LIMIT))
+    sort = _normalize_sort(document_cls, sort)
+
+    backward = False
+    page_queryset = queryset
+    if cursor:
+        values, backward = decode_cursor(document_cls, sort, cursor)
+        page_queryset = page_queryset.filter(__raw__=seek_filter(sort, values, backward))
+    ordering = [('-' if (direction == pymongo.DESCENDING) != backward else '') + name for name, _, direction in sort]
+    items = list(page_queryset.order_by(*ordering).limit(limit + 1))
+    has_more = len(items) > limit
+    items = items[:limit]
+    if backward:
+        items.reverse()
+
+    next_cursor = prev_cursor = None
+    if items:
+        # 由游标向后翻页时前面还有数据， 向前翻页时后面还有数据
+        if has_more or backward:
+            next_cursor = encode_cursor(document_cls, sort, _sort_values(document_cls, sort, items[-1]), False)
+        if (has_more if backward else cursor):
+            prev_cursor = encode_cursor(document_cls, sort, _sort_values(document_cls, sort, items[0]), True)
+
+    total, total_is_estimate = None, False
+    if with_total:
+        total, total_is_estimate = approximate_total(queryset)
+    return KeysetPage(items, next_cursor, prev_cursor, total, total_is_estimate)
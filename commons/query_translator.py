@@ -0,0 +1,212 @@
+# !/usr/bin/python
+# -*- coding:utf-8 -*-
+"""
+查询字段映射(类字段名 -> 数据库字段)
+
+每个文档类首次使用时创建一个 FieldTranslator：
+    - 字段路径逐段映射， 支持嵌入文档、嵌入文档列表、MapField 及数组下标/位置操作符($、$[])，
+      映射结果按路径缓存
+    - 查询条件按 键序列(形状) 编译为映射计划并缓存， 相同形状的查询只按计划复制一次；
+      支持 $and/$or/$nor 及 $elemMatch(按数组元素的文档类映射)
+    - 排序、投影按规格缓存
+缓存数量超过 OPT_QUERY_TRANSLATOR_CACHE_SIZE 时清空。
+"""
+
+from mongoengine.fields import DictField, EmbeddedDocumentField, ListField
+
+import settings
+
+_LOGICAL_OPERATORS = frozenset(['$and', '$or', '$nor'])
+
+# 计划中的键类型
+_KEY_FIELD = 0
+_KEY_LOGICAL = 1
+_KEY_OPERATOR = 2
+
+_translators = {}
+
+
+def get_translator(document_cls):
+    """
+    获取文档类的字段映射器
+    :param document_cls: 文档类(含嵌入文档类)
+    :return: FieldTranslator
+    """
+    translator = _translators.get(document_cls)
+    if translator is None:
+        translator = _translators[document_cls] = FieldTranslator(document_cls)
+    return translator
+
+
+def _child(field):
+    """
+    字段的下一层
+    :param field: 字段
+    :return: (是否需要跳过一段映射键, 子文档类或None)
+    """
+    is_map = False
+    while field is not None:
+        if isinstance(field, EmbeddedDocumentField):
+            return is_map, field.document_type
+        if isinstance(field, ListField):
+            field = field.field
+        elif isinstance(field, DictField):
+            if is_map:
+                break
+            is_map = True
+            field = field.field
+        else:
+            break
+    return is_map, None
+
+
+class FieldTranslator(object):
+    def __init__(self, document_cls, cache_size=settings.OPT_QUERY_TRANSLATOR_CACHE_SIZE):
+        self.document_cls = document_cls
+        self.cache_size = cache_size
+        self._paths = {}
+        self._plans = {}
+        self._sorts = {}
+        self._projections = {}
+        self._elements = {}
+
+    def _fields(self):
+        get_field_mappings = getattr(self.document_cls, 'get_field_mappings', None)
+        return get_field_mappings() if get_field_mappings else self.document_cls._fields
+
+    def _remember(self, cache, key, value):
+        if len(cache) >= self.cache_size:
+            cache.clear()
+        cache[key] = value
+        return value
+
+    def _resolve(self, path):
+        """
+        逐段映射字段路径
+        :param path: 类字段路径
+        :return: (数据库字段路径, 最后一段对应的字段)
+        """
+        parts = path.split('.')
+        result = []
+        fields = self._fields()
+        field = None
+        skip_key = False
+        for index, part in enumerate(parts):
+            if skip_key or fields is None or part.isdigit() or part.startswith('$'):
+                # 映射键、数组下标及位置操作符保持不变
+                result.append(part)
+                if skip_key:
+                    skip_key = False
+                continue
+            if index == 0 and part == 'pk':
+                part = self.document_cls._meta.get('id_field') or 'id'
+            field = fields.get(part)
+            if field is None:
+                result.append(part)
+                fields = None
+                continue
+            result.append(field.db_field or part)
+            skip_key, document_cls = _child(field)
+            fields = get_translator(document_cls)._fields() if document_cls else None
+        return '.'.join(result), field
+
+    def db_path(self, path):
+        """
+        映射字段路径
+        :param path: 类字段路径， 如 items.0.name
+        :return: 数据库字段路径
+        """
+        result = self._paths.get(path)
+        if result is None:
+            result = self._remember(self._paths, path, self._resolve(path)[0])
+        return result
+
+    def _element_translator(self, path):
+        """
+        数组元素的字段映射器， 用于 $elemMatch
+        :param path: 类字段路径
+        :return: FieldTranslator 或 None
+        """
+        if path in self._elements:
+            return self._elements[path]
+        field = self._resolve(path)[1]
+        document_cls = _child(field)[1] if field is not None else None
+        return self._remember(self._elements, path, get_translator(document_cls) if document_cls else None)
+
+    def _compile(self, keys):
+        plan = []
+        for key in keys:
+            if key in _LOGICAL_OPERATORS:
+                plan.append((key, _KEY_LOGICAL, None))
+            elif key.startswith('$'):
+                plan.append((key, _KEY_OPERATOR, None))
+            else:
+                plan.append((self.db_path(key), _KEY_FIELD, key))
+        return plan
+
+    def filter(self, filtered):
+        """
+        映射查询条件
+        :param filtered: 查询条件
+        :return: 新的查询条件
+        """
+        if not isinstance(filtered, dict) or not filtered:
+            return filtered
+        keys = tuple(filtered)
+        plan = self._plans.get(keys)
+        if plan is None:
+            plan = self._remember(self._plans, keys, self._compile(keys))
+        result = {}
+        for (db_key, kind, path), value in zip(plan, filtered.values()):
+            if kind == _KEY_LOGICAL and isinstance(value, (list, tuple)):
+                value = [self.filter(item) for item in value]
+            elif kind == _KEY_FIELD and isinstance(value, dict) and '$elemMatch' in value:
+                translator = self._element_translator(path)
+                if translator is not None:
+                    value = dict(value, **{'$elemMatch': translator.filter(value['$elemMatch'])})
+            result[db_key] = value
+        return result
+
+    def sort(self, sort):
+        """
+        映射排序
+        :param sort: '-created_time'、 ('created_time', -1)、 ['-created_time', 'name']、 [('created_time', -1)]
+                     或 {'created_time': -1}
+        :return: [(数据库字段, 1/-1)]， sort 为空时返回None
+        """
+        if not sort:
+            return None
+        if isinstance(sort, dict):
+            sort = list(sort.items())
+        elif isinstance(sort, (str, tuple)):
+            sort = [sort]
+        try:
+            key = tuple(sort)
+            result = self._sorts.get(key)
+        except TypeError:
+            key, result = None, None
+        if result is None:
+            result = []
+            for item in sort:
+                if isinstance(item, str):
+                    item = (item.lstrip('+-'), -1 if item.startswith('-') else 1)
+                result.append((self.db_path(item[0]), item[1]))
+            if key is not None:
+                self._remember(self._sorts, key, result)
+        return list(result)
+
+    def projection(self, projection):
+        """
+        映射投影
+        :param projection: 字段名列表或 {字段名: 0/1/表达式}
+        :return: dict， projection 为空时返回None
+        """
+        if not projection:
+            return None
+        if isinstance(projection, dict):
+            return {self.db_path(k): v for k, v in projection.items()}
+        key = tuple(projection)
+        result = self._projections.get(key)
+        if result is None:
+            result = self._remember(self._projections, key, {self.db_path(k): 1 for k in projection})
+        return dict(result)
@@ -0,0 +1,215 @@
+# !/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+流式响应适配
+
+将(异步)迭代器按块编码后直接输出到 StreamingResponse， 避免在内存中拼接完整结果。
+"""
+
+import csv
+import io
+import json
+from urllib.parse import quote
+
+from starlette.responses import StreamingResponse
+
+from commons.common_utils import FrontendJsonEncoder, to_str
+
+STREAM_CHUNK_SIZE = 200  # 每个输出块包含的元素数量
+
+# 以这些字符开头的单元格在电子表格中会被当作公式执行(CSV注入)， 输出时加 ' 前缀
+_FORMULA_PREFIXES = ('=', '+', '-', '@', '\t', '\r')
+
+_encoder = FrontendJsonEncoder()
+
+
+def dumps(obj):
+    """
+    序列化单个元素， ObjectId/datetime/bytes 的转换规则与 FrontendJsonEncoder 一致
+    :param obj:
+    :return:
+    """
+    return json.dumps(to_str(obj), default=_encoder.default, ensure_ascii=False)
+
+
+async def aiterate(items):
+    """
+    统一同步与异步迭代器
+    :param items: 可迭代对象或异步迭代器
+    :return: 异步迭代器
+    """
+    if hasattr(items, '__aiter__'):
+        async for item in items:
+            yield item
+    else:
+        for item in items:
+            yield item
+
+
+async def iter_ndjson(items, chunk_size=STREAM_CHUNK_SIZE):
+    """
+    编码为NDJSON， 每行一个元素
+    :param items: 可迭代对象或异步迭代器
+    :param chunk_size: 每个输出块包含的元素数量
+    :return: 异步迭代器， 元素为bytes
+    """
+    lines = []
+    async for item in aiterate(items):
+        lines.append(dumps(item))
+        if len(lines) >= chunk_size:
+            yield ('\n'.join(lines) + '\n').encode('utf-8')
+            lines = []
+    if lines:
+        yield ('\n'.join(lines) + '\n').encode('utf-8')
+
+
+def _lookup(row, key):
+    """
+    读取元素的值， 支持 a.b 形式的嵌套键
+    """
+    for part in key.split('.'):
+        if not isinstance(row, dict):
+            return None
+        row = row.get(part)
+    return row
+
+
+def _cell(value):
+    """
+    CSV单元格， ObjectId/datetime 的转换规则与 FrontendJsonEncoder 一致， 嵌套对象序列化为JSON，
+    以 = + - @ 等开头的字符串加 ' 前缀
+    :param value:
+    :return:
+    """
+    value = to_str(value)
+    if value is None:
+        return ''
+    if isinstance(value, str):
+        return "'" + value if value.startswith(_FORMULA_PREFIXES) else value
+    if isinstance(value, (int, float, bool)):
+        return value
+    if isinstance(value, (dict, list, tuple)):
+        return dumps(value)
+    return _encoder.default(value)
+
+
+async def iter_csv(rows, columns, chunk_size=STREAM_CHUNK_SIZE, bom=False):
+    """
+    编码为CSV， 第一行为列名； 可能被电子表格当作公式的字符串单元格加 ' 前缀
+    :param rows: dict的可迭代对象或异步迭代器
+    :param columns: 列名列表或 [(列名, 键)]， 键支持 a.b 形式
+    :param chunk_size: 每个输出块包含的行数
+    :param bom: 是否输出UTF-8 BOM(Excel打开时正确识别编码)
+    :return: 异步迭代器， 元素为bytes
+    """
+    columns = [column if isinstance(column, (tuple, list)) else (column, column) for column in columns]
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    if bom:
+        buffer.write('\ufeff')
+    writer.writerow([name for name, _ in columns])
+    count = 0
+    async for row in aiterate(rows):
+        writer.writerow([_cell(_lookup(row, key)) for _, key in columns])
+        count += 1
+        if count >= chunk_size:
+            yield buffer.getvalue().encode('utf-8')
+            buffer.seek(0)
+            buffer.truncate()
+            count = 0
+    yield buffer.getvalue().encode('utf-8')
+
+
+def attachment_headers(filename):
+    """
+    下载文件名响应头
+    :param filename: 文件名
+    :return:
+    """
+    return {'Content-Disposition': "attachment; filename*=UTF-8''%s" % quote(filename)}
+
+
+async def iter_json_array(items, chunk_size=STREAM_CHUNK_SIZE):
+    """
+    编码为JSON数组
+    :param items: 可迭代对象或异步迭代器， 如 smembers/lrange 的迭代结果
+    :param chunk_size: 每个输出块包含的元素数量
+    :return: 异步迭代器， 元素为bytes
+    """
+    parts = ['[']
+    first = True
+    async for item in aiterate(items):
+        parts.append(dumps(item) if first else ',' + dumps(item))
+        first = False
+        if len(parts) >= chunk_size:
+            yield ''.join(parts).encode('utf-8')
+            parts = []
+    parts.append(']')
+    yield ''.join(parts).encode('utf-8')
+
+
+async def iter_json_object(pairs, chunk_size=STREAM_CHUNK_SIZE):
+    """
+    编码为JSON对象
+    :param pairs: (键, 值)的可迭代对象或异步迭代器， 如 hscan_iter 的迭代结果
+    :param chunk_size: 每个输出块包含的元素数量
+    :return: 异步迭代器， 元素为bytes
+    """
+    parts = ['{']
+    first = True
+    async for key, value in aiterate(pairs):
+        item = '%s:%s' % (json.dumps(str(to_str(key)), ensure_ascii=False),
+                          dumps(value))
+        parts.append(item if first else ',' + item)
+        first = False
+        if len(parts) >= chunk_size:
+            yield ''.join(parts).encode('utf-8')
+            parts = []
+    parts.append('}')
+    yield ''.join(parts).encode('utf-8')
+
+
+def ndjson_response(items, chunk_size=STREAM_CHUNK_SIZE, **kwargs):
+    """
+    NDJSON流式响应
+    :param items: 可迭代对象或异步迭代器
+    :param chunk_size: 每个输出块包含的元素数量
+    :param kwargs: StreamingResponse 其他参数
+    :return:
+    """
+    return StreamingResponse(iter_ndjson(items, chunk_size), media_type='application/x-ndjson', **kwargs)
+
+
+def json_array_response(items, chunk_size=STREAM_CHUNK_SIZE, **kwargs):
+    """
+    JSON数组流式响应
+    :param items: 可迭代对象或异步迭代器
+    :param chunk_size: 每个输出块包含的元素数量
+    :param kwargs: StreamingResponse 其他参数
+    :return:
+    """
+    return StreamingResponse(iter_json_array(items, chunk_size), media_type='application/json', **kwargs)
+
+
+def json_object_response(pairs, chunk_size=STREAM_CHUNK_SIZE, **kwargs):
+    """
+    JSON对象流式响应
+    :param pairs: (键, 值)的可迭代对象或异步迭代器
+    :param chunk_size: 每个输出块包含的元素数量
+    :param kwargs: StreamingResponse 其他参数
+    :return:
+    """
+    return StreamingResponse(iter_json_object(pairs, chunk_size), media_type='application/json', **kwargs)
+
+
+def csv_response(rows, columns, chunk_size=STREAM_CHUNK_SIZE, bom=False, **kwargs):
+    """
+    CSV流式响应
+    :param rows: dict的可迭代对象或异步迭代器
+    :param columns: 列名列表或 [(列名, 键)]
+    :param chunk_size: 每个输出块包含的行数
+    :param bom: 是否输出UTF-8 BOM
+    :param kwargs: StreamingResponse 其他参数
+    :return:
+    """
+    return StreamingResponse(iter_csv(rows, columns, chunk_size, bom), media_type='text/csv; charset=utf-8', **kwargs)
@@ -17,20 +17,31 @@ _._ _..._ .-',     _.._(`))
 @Author : 戴军 
 @Email  : 18018030656@163.com
 """
+import hmac
 from typing import Optional
 from fastapi.exceptions import RequestValidationError
-from fastapi import FastAPI
+from fastapi import Depends, FastAPI, Header, HTTPException
 
 import uvicorn
 from starlette.middleware.cors import CORSMiddleware
 
 import settings
 from commons.mongo_util import MongoDBConf
+from commons.history_writer import HistoryQueue
+from commons.history_archive import HistoryArchive
+from commons.mongo_monitor import MongoMonitor, MongoMonitorMiddleware
+from commons.index_advisor import IndexAdvisor
+from commons.pagination import InvalidCursor, check_secret as check_pagination_secret
+from caches.refresh_ahead import RefreshAhead
+from caches.prefix_index import PrefixIndexMaintenance
+from caches.counters import Counters
+from caches.document_cache import IdentityMapMiddleware
 from starlette.exceptions import HTTPException as StarletteHTTPException
 from starlette.responses import JSONResponse
 from commons import logging
 from apps.admin import handlers as admin_handlers, validation as admin_validation
-from starlette.status import HTTP_200_OK
+from starlette.status import HTTP_200_OK, HTTP_400_BAD_REQUEST
+from apps import ErrorData
 
 logger = logging.get_logging()
 app = FastAPI()
@@ -50,14 +61,83 @@ def read_item(item_id: int, q: Optional[str] = None):
     return {"item_id": item_id, "q": q}
 
 
+def require_monitor_token(x_monitor_token: Optional[str] = Header(None)):
+    """
+    监控接口鉴权， 未配置 MONITOR_TOKEN 时监控接口不可用
+    :param x_monitor_token: 请求头 X-Monitor-Token
+    :return:
+    """
+    if not settings.MONITOR_TOKEN:
+        raise HTTPException(status_code=404)
+    if not x_monitor_token or not hmac.compare_digest(x_monitor_token.encode(), settings.MONITOR_TOKEN.encode()):
+        raise HTTPException(status_code=403)
+
+
+@app.get("/monitor/mongo", dependencies=[Depends(require_monitor_token)])
+def read_mongo_monitor():
+    """
+    数据库命令耗时、连接池及慢查询统计
+    :return:
+    """
+    return MongoMonitor.snapshot()
+
+
+@app.post("/monitor/mongo/reset", dependencies=[Depends(require_monitor_token)])
+def reset_mongo_monitor():
+    """
+    返回当前统计后清空命令统计及慢查询
+    :return:
+    """
+    result = MongoMonitor.snapshot()
+    MongoMonitor.reset()
+    return result
+
+
+@app.get("/monitor/mongo/indexes", dependencies=[Depends(require_monitor_token)])
+def read_index_advice():
+    """
+    已记录的查询形状
+    :return:
+    """
+    return {'shapes': IndexAdvisor.shapes()}
+
+
+@app.post("/monitor/mongo/indexes/analyze", dependencies=[Depends(require_monitor_token)])
+def analyze_index_advice():
+    """
+    对高频查询形状执行 explain 并生成索引建议， 在 INDEX_ADVISOR_URI 指定的数据库上执行， 未设置时不可用
+    :return:
+    """
+    if not settings.INDEX_ADVISOR_URI:
+        raise HTTPException(status_code=409, detail='settings.INDEX_ADVISOR_URI is not set')
+    return {'shapes': IndexAdvisor.shapes(), 'suggestions': IndexAdvisor.analyze()}
+
+
 @app.on_event('startup')
 async def start_app():
     """
     APP启动触发
     :return:
     """
+    # 分页游标签名密钥为公开的默认值时拒绝启动
+    if settings.PAGINATION_SECRET:
+        check_pagination_secret()
     # 初始化DB
     MongoDBConf().client()
+    # 数据库监控汇总日志
+    await MongoMonitor.start()
+    # 后台创建声明的索引
+    await IndexAdvisor.start()
+    # 热点缓存提前刷新
+    await RefreshAhead.start()
+    # 键前缀索引维护
+    await PrefixIndexMaintenance.start()
+    # 计数器本地聚合定时写入
+    await Counters.start()
+    # 历史记录批量写入
+    await HistoryQueue.start()
+    # 历史记录分区归档
+    await HistoryArchive.start()
 
 
 @app.on_event("shutdown")
@@ -66,6 +146,19 @@ async def stop_app():
     APP关闭触发
     :return:
     """
+    # 停止热点缓存提前刷新
+    await RefreshAhead.stop()
+    # 停止键前缀索引维护
+    await PrefixIndexMaintenance.stop()
+    # 写入计数器剩余增量
+    await Counters.stop()
+    # 停止历史记录分区归档
+    await HistoryArchive.stop()
+    # 写入剩余历史记录
+    await HistoryQueue.stop()
+    # 停止数据库监控汇总日志
+    await MongoMonitor.stop()
+    await IndexAdvisor.stop()
     # 关闭数据库
     MongoDBConf().close_client()
 
@@ -82,6 +175,13 @@ async def validation_exception_handler(request, exc):
     return JSONResponse(ret, status_code=HTTP_200_OK)
 
 
+@app.exception_handler(InvalidCursor)
+async def invalid_cursor_handler(request, exc):
+    # 分页游标格式不正确或被篡改
+    ret = ErrorData(status_code=HTTP_400_BAD_REQUEST, code=HTTP_400_BAD_REQUEST, msg=str(exc)).to_dict()
+    return JSONResponse(ret, status_code=HTTP_400_BAD_REQUEST)
+
+
 app.add_middleware(
     CORSMiddleware,
     allow_origins=origins,
@@ -90,6 +190,9 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+app.add_middleware(IdentityMapMiddleware)
+app.add_middleware(MongoMonitorMiddleware)
+
 
 if __name__ == "__main__":
     uvicorn.run(app, host=settings.SERVER_HOST, port=settings.SERVER_PORT)
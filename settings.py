@@ -48,6 +48,21 @@ REDIS_OPTIONS = dict(
 )
 REDIS_DB_INDEX = 8  # 库下标, REDIS_CLUSTER=True是该设置无效
 REDIS_CACHED_TIMEOUT = 2 * 24 * 60 * 60  # 默认缓存超时时间(单位：秒)， 0：永不超时
+REDIS_PIPELINE_MAX_BUFFER = 1000  # 异步管道缓冲命令数达到该值时自动提交一批， 0：不自动提交
+REDIS_NAMESPACE_VERSION_TTL = 5  # 缓存命名空间版本号本地缓存时间(单位：秒)
+REDIS_LOADING_TIMEOUT = 30  # 缓存加载锁超时时间(单位：秒)
+REDIS_SCAN_COUNT = 500  # 游标迭代(HSCAN/SSCAN/ZSCAN/分段LRANGE)每页数量
+REDIS_PREFIX_INDEX = []  # 维护键数量索引的前缀列表， 如 ['user:', 'order:']
+REDIS_PREFIX_INDEX_REPAIR_INTERVAL = 10 * 60  # 前缀索引修复间隔(单位：秒)
+COUNTER_FLUSH_INTERVAL_MS = 1000  # 本地聚合计数器写入间隔(单位：毫秒)
+COUNTER_FLUSH_THRESHOLD = 1000  # 本地聚合计数器累计自增次数达到该值时立即写入， 0：仅定时写入
+REFRESH_AHEAD_INTERVAL = 10  # 热点缓存提前刷新检查间隔(单位：秒)
+REFRESH_AHEAD_WINDOW = 0.1  # 剩余超时时间低于缓存超时时间的该比例时提前刷新
+REFRESH_AHEAD_MIN_HITS = 5  # 热度阈值， 访问热度低于该值的键任其自然过期
+REFRESH_AHEAD_CONCURRENCY = 8  # 同时刷新的最大键数量
+REFRESH_AHEAD_LOCK_TIMEOUT = 60  # 刷新锁超时时间(单位：秒)， 保证同一键只有一个进程刷新
+TIMELINE_MAX_LENGTH = 1000  # 时间线默认最大长度， 0：不限
+TIMELINE_MAX_AGE = 7 * 24 * 60 * 60  # 时间线默认最长保留时间(单位：秒)， 0：不限
 
 DB_ADDRESS_LIST = [
     '127.0.0.1:27017',
@@ -65,8 +80,49 @@ OPT_WAIT_QUEUE_TIMEOUT_MS = 1000 * 10  # 连接队列等待超时时间, 单位:
 OPT_REPLICA_SET_NAME = 'BMS_REP'  # 副本集名称
 OPT_READ_PREFERENCE = 'secondaryPreferred'  # 副本集读写方式, primary|primaryPreferred|secondary|secondaryPreferred
 OPT_WRITE_SYNC_NUMBER = 1  # 阻塞写操作直到同步指定数量的从服务器为止, 0: 禁用写确认, 使用事务是该值必须大于0，且小于等于从服务器数量
-OPT_DISTRIBUTED_CACHED_ENABLE = True  # 启用数据库分布式缓存， 开启此选项请启用缓存
+OPT_ASYNC_BATCH_SIZE = 500  # 异步游标迭代每批读取数量
+OPT_BULK_WRITE_CHUNK_SIZE = 1000  # 批量保存每次 bulk_write 的文档数量， 0：不分批
+OPT_QUERY_TRANSLATOR_CACHE_SIZE = 1024  # 每个文档类缓存的查询字段映射(路径、查询形状、排序、投影)数量
+HISTORY_SNAPSHOT_INTERVAL = 20  # 历史记录每隔多少个版本保存一次完整快照， 其余版本保存增量
+HISTORY_COMPRESS_LEVEL = 6  # 历史记录压缩级别(zlib 0-9)
+HISTORY_QUEUE_MAX_SIZE = 10000  # 历史记录写入队列最大长度， 超出的记录溢出到本地文件
+HISTORY_FLUSH_BATCH_SIZE = 500  # 历史记录写入队列累计该数量时立即批量写入
+HISTORY_FLUSH_INTERVAL_MS = 1000  # 历史记录写入队列写入间隔(单位：毫秒)
+HISTORY_WRITE_CONCERN = 1  # 历史记录写确认级别， 0：不等待确认
+HISTORY_SPILL_DIR = os.path.join(SITE_ROOT, 'logs', 'history_spill')  # 历史记录溢出文件目录
+HISTORY_PARTITION_BY_MONTH = False  # 历史记录是否按月分区写入 history_<cname>_<yyyymm> 集合
+HISTORY_PARTITION_FANOUT = 4  # 读取历史记录时并发查询的分区数量
+HISTORY_PARTITION_CACHE_TTL = 60  # 历史记录分区列表本地缓存时间(单位：秒)
+HISTORY_RETENTION_MONTHS = 0  # 历史记录分区保留月数， 更早的分区归档后删除， 0：不归档
+HISTORY_ARCHIVE_MODE = 'collection'  # 历史记录归档方式， collection：压缩写入 <集合名>_archive， file：导出到本地文件
+HISTORY_ARCHIVE_DIR = os.path.join(SITE_ROOT, 'logs', 'history_archive')  # 历史记录归档文件目录
+HISTORY_ARCHIVE_CHUNK_SIZE = 1000  # 历史记录归档时每个归档文档包含的最大记录数量
+HISTORY_ARCHIVE_INTERVAL = 3600  # 历史记录归档检查间隔(单位：秒)
+HISTORY_ARCHIVE_LOCK_TIMEOUT = 3600  # 历史记录归档锁超时时间(单位：秒)
+OPT_DISTRIBUTED_CACHED_ENABLE = True  # 启用数据库分布式缓存， 开启此选项请启用缓存； 模型需在 meta 中设置 'distributed_cache': True
 OPT_DISTRIBUTED_CACHED_TIMEOUT = REDIS_CACHED_TIMEOUT  # 数据库分布式缓存数据超时时间(单位：秒)， 0：永不超时
+OPT_DISTRIBUTED_CACHED_MAX_DOCS = 1000  # 查询结果超过该数量时不缓存
+OPT_DISTRIBUTED_CACHED_COMPRESS_MIN_SIZE = 1024  # 缓存数据达到该大小(单位：字节)时压缩， 0：不压缩
+MONGO_MONITOR_ENABLE = True  # 启用数据库命令及连接池监控
+MONGO_MONITOR_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)  # 耗时直方图区间上限(单位：毫秒)
+MONGO_MONITOR_LOG_INTERVAL = 5 * 60  # 监控汇总日志输出间隔(单位：秒)， 0：不输出
+MONGO_MONITOR_LOG_TOP = 10  # 监控汇总日志输出总耗时最高的命令数量
+MONGO_SLOW_QUERY_MS = 100  # 慢查询阈值(单位：毫秒)， 0：不记录
+MONGO_SLOW_QUERY_KEEP = 100  # 内存中保留的最近慢查询数量
+MONGO_SLOW_QUERY_MAX_LENGTH = 1000  # 慢查询日志中命令内容的最大长度
+MONGO_SLOW_QUERY_REDACT = True  # 慢查询日志中查询条件及文档的值替换为 '?'， 只保留字段名及操作符
+MONITOR_TOKEN = None  # 监控接口(/monitor/*)令牌， 请求头 X-Monitor-Token 需与之一致， None：关闭监控接口
+INDEX_ADVISOR_CAPTURE = False  # 记录查询形状用于索引建议
+INDEX_ADVISOR_MAX_SHAPES = 1000  # 最多记录的查询形状数量
+INDEX_ADVISOR_MIN_COUNT = 10  # 执行次数达到该值的查询形状才生成索引建议
+INDEX_ADVISOR_TOP = 50  # 每次最多分析的查询形状数量
+INDEX_ADVISOR_REDACT = True  # 查询形状的查询样例中的值替换为 '?'， 只保留字段名及操作符
+INDEX_ADVISOR_URI = None  # 执行 explain 的数据库连接URI(本地或预发布环境)， None：索引建议接口不可用， 不使用应用的数据库连接
+INDEX_ENSURE_AT_STARTUP = False  # 应用启动时在后台创建文档类声明的索引
+PAGINATION_SECRET = None  # 分页游标签名密钥， 部署时必须设置， 未设置时无法生成游标， 设置为公开的默认值时拒绝启动
+PAGINATION_DEFAULT_LIMIT = 20  # 分页默认每页数量
+PAGINATION_MAX_LIMIT = 200  # 分页最大每页数量
+PAGINATION_COUNT_LIMIT = 10000  # 分页估算总数时的计数上限， 超过时返回该值， 0：不限
 
 # 服务框架配置
 DATE_FORMAT = '%Y-%m-%d'
@@ -79,4 +135,6 @@ LOG_LEVEL = 'ERROR'  # DEBUG|INFO|WARNING|ERROR|NONE
 LOG_STDERR = False  # 输出到标准错误流
 LOG_NAME = 'dj.log'  # 主日志
 LOG_NAME_ACCESS = 'access.log'  # 执行日志
+LOG_NAME_MONGO = 'mongo.log'  # 数据库慢查询及监控汇总日志
+LOG_LEVEL_MONGO = 'WARNING'  # 数据库慢查询及监控汇总日志等级
 LOG_BACKUP_COUNT = 64  # 日志记录数量
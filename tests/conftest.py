@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+"""
+测试环境
+
+默认使用 fakeredis(REDIS_MOCK)， 设置环境变量 REDIS_TEST_NODE=host:port 时使用真实Redis。
+数据库使用 mongomock， 不支持部分索引(partialFilterExpression 不生效)。
+"""
+
+import functools
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import settings  # noqa: E402
+
+settings.LOG_PATH = tempfile.mkdtemp(prefix='logs_')
+settings.LOG_STDERR = False
+settings.REDIS_MOCK = not os.environ.get('REDIS_TEST_NODE')
+if not settings.REDIS_MOCK:
+    settings.REDIS_NODES = [os.environ['REDIS_TEST_NODE']]
+    settings.REDIS_CLUSTER = False
+
+
+def _patch_fake_lua():
+    """
+    fakeredis 使用的 lupa 可能为 Lua 5.4， 缺少 Redis(Lua 5.1) 中的 unpack 及 redis.replicate_commands；
+    fakeredis 1.4 的 SCRIPT 命令只支持 LOAD， 补充 EXISTS 及 FLUSH
+    """
+    from fakeredis._server import FakeSocket
+
+    compat = b'local unpack = unpack or table.unpack\n' \
+             b'redis.replicate_commands = redis.replicate_commands or function() end\n'
+    evaluate = FakeSocket.eval
+
+    @functools.wraps(evaluate)
+    def wrapper(self, script, numkeys, *keys_and_args):
+        return evaluate(self, compat + script, numkeys, *keys_and_args)
+
+    FakeSocket.eval = wrapper
+
+    script = FakeSocket.script
+
+    @functools.wraps(script)
+    def script_wrapper(self, subcmd, *args):
+        if subcmd.lower() == b'exists':
+            return [int(sha in self._server.script_cache) for sha in args]
+        if subcmd.lower() == b'flush':
+            self._server.script_cache.clear()
+            return b'OK'
+        return script(self, subcmd, *args)
+
+    FakeSocket.script = script_wrapper
+
+
+def _connect_mongomock():
+    from mongoengine import connect, register_connection
+
+    connect(settings.DB_NAME, host='mongomock://localhost')
+    register_connection(settings.DB_NAME_HIS, settings.DB_NAME_HIS, host='mongomock://localhost')
+
+
+if settings.REDIS_MOCK:
+    _patch_fake_lua()
+_connect_mongomock()
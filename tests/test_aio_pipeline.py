@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+"""
+异步缓冲管道(_AioPipeline)： 结果顺序、 缓冲区满时自动提交、 execute(return_exceptions) 及脚本不存在时重新执行
+连接为桩对象， 命令由 fakeredis 执行并按批记录
+"""
+
+import asyncio
+import contextlib
+import unittest
+
+from aioredis.errors import PipelineError
+from fakeredis import FakeServer, FakeStrictRedis
+
+from caches.LuaManager import GetExpireLua
+from caches.redis_utils import _AioPipeline, _AioRedis
+
+
+class _StubConnection(object):
+    def __init__(self):
+        self.server = FakeStrictRedis(server=FakeServer())
+        # 返回原始回复， 由 aioredis 转换
+        self.server.response_callbacks = {}
+        # 每次写入连接的命令， 一批对应一次往返
+        self.batches = []
+        self._batch = None
+
+    @contextlib.contextmanager
+    def _buffered(self):
+        self._batch = []
+        try:
+            yield self
+        finally:
+            self.batches.append(self._batch)
+            self._batch = None
+
+    def execute(self, command, *args, **kwargs):
+        if self._batch is None:
+            self.batches.append([command])
+        else:
+            self._batch.append(command)
+        future = asyncio.get_event_loop().create_future()
+        try:
+            future.set_result(self.server.execute_command(command.decode('utf-8'), *args))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+
+class AioPipelineTest(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.conn = _StubConnection()
+
+    def tearDown(self):
+        self.loop.close()
+        asyncio.set_event_loop(None)
+
+    def wait(self, coro):
+        return self.loop.run_until_complete(coro)
+
+    def pipeline(self, max_buffer=0):
+        return _AioPipeline(self.conn, _AioRedis, max_buffer=max_buffer)
+
+    def test_results_in_command_order(self):
+        async def main():
+            pipe = self.pipeline()
+            await pipe.set('a', 'v')
+            await pipe.incr('n')
+            await pipe.get('a')
+            await pipe.incr('n', 5)
+            self.assertEqual(self.conn.batches, [])
+            self.assertEqual(await pipe.execute(), [True, 1, b'v', 6])
+            self.assertEqual(len(self.conn.batches), 1)
+        self.wait(main())
+
+    def test_auto_flush_at_max_buffer(self):
+        async def main():
+            pipe = self.pipeline(max_buffer=2)
+            for _ in range(5):
+                await pipe.incr('n')
+            # 已提交两批， 最后一条仍在缓冲区
+            self.assertEqual([len(batch) for batch in self.conn.batches], [2, 2])
+            self.assertEqual(len(pipe), 5)
+            self.assertEqual(await pipe.execute(), [1, 2, 3, 4, 5])
+            self.assertEqual([len(batch) for batch in self.conn.batches], [2, 2, 1])
+        self.wait(main())
+
+    def test_execute_return_exceptions(self):
+        async def main():
+            pipe = self.pipeline(max_buffer=2)
+            await pipe.set('a', 'v')
+            await pipe.incr('a')
+            await pipe.get('a')
+            results = await pipe.execute(return_exceptions=True)
+            self.assertEqual(results[0], True)
+            self.assertIsInstance(results[1], Exception)
+            self.assertEqual(results[2], b'v')
+
+            pipe = self.pipeline(max_buffer=2)
+            await pipe.incr('a')
+            await pipe.get('a')
+            with self.assertRaises(PipelineError):
+                await pipe.execute()
+        self.wait(main())
+
+    def test_noscript_is_retried(self):
+        async def main():
+            script = GetExpireLua(_AioRedis(self.conn))
+            # 脚本已加载后Redis重启或 SCRIPT FLUSH
+            script.flag = True
+            self.conn.server.set('a', 'v')
+            pipe = self.pipeline()
+            await pipe.incr('n')
+            await script.async_run_script(['a'], [100], client=pipe)
+            await pipe.get('a')
+            self.assertEqual(await pipe.execute(), [1, b'v', b'v'])
+            self.assertGreater(self.conn.server.ttl('a'), 0)
+            # 重新执行时已重新加载脚本
+            self.assertEqual(self.conn.server.execute_command('SCRIPT', 'EXISTS', script.hashcode), [1])
+        self.wait(main())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+"""
+ModelBase.bulk_save 及 my_save 新建时的单次写入
+"""
+
+import unittest
+from unittest import mock
+
+from bson import ObjectId
+from mongoengine import StringField
+from pymongo.errors import BulkWriteError
+
+import basedoc
+from basedoc import History, HistoryBase, ModelBase, ObjectDict
+
+
+class BulkDoc(ModelBase, HistoryBase):
+    name = StringField(db_field='nm', unique=True)
+    note = StringField()
+
+    meta = {'collection': 'test_bulk_doc'}
+
+
+class BulkSaveTest(unittest.TestCase):
+    def setUp(self):
+        BulkDoc.drop_collection()
+        BulkDoc.ensure_indexes()
+        self.histories = History._get_db()[BulkDoc.get_collection_name('test_bulk_doc')]
+        self.histories.drop()
+        self.executer = ObjectDict(id=ObjectId())
+
+    def history_seqs(self, doc):
+        return sorted(h['seq'] for h in self.histories.find({'ref_id': str(doc.id)}))
+
+    def test_insert(self):
+        docs = BulkDoc.bulk_save([BulkDoc(name='a'), BulkDoc(name='b'), BulkDoc(name='c')], self.executer, chunk_size=2)
+        self.assertEqual(sorted(doc.name for doc in BulkDoc.objects), ['a', 'b', 'c'])
+        for doc in docs:
+            self.assertFalse(doc._created)
+            self.assertEqual(doc._get_changed_fields(), [])
+            self.assertEqual(doc.creater_id, self.executer.id)
+            self.assertEqual(doc.history_seq, 1)
+            self.assertEqual(self.history_seqs(doc), [1])
+
+    def test_replace_document_with_preset_id(self):
+        doc = BulkDoc(id=ObjectId(), name='a', note='first')
+        BulkDoc.bulk_save([doc], self.executer)
+        self.assertEqual(BulkDoc.objects.get(id=doc.id).note, 'first')
+        # 指定ID的新对象整体替换已有文档
+        doc = BulkDoc(id=doc.id, name='a')
+        BulkDoc.bulk_save([doc], self.executer)
+        son = BulkDoc._get_collection().find_one({'_id': doc.id})
+        self.assertNotIn('note', son)
+
+    def test_update_changed_fields_only(self):
+        a, b = BulkDoc.bulk_save([BulkDoc(name='a', note='x'), BulkDoc(name='b', note='y')], self.executer)
+        a = BulkDoc.objects.get(id=a.id)
+        b = BulkDoc.objects.get(id=b.id)
+        a.note = 'changed'
+        # 直接修改数据库中 b 的值， 修改时只 $set 修改的字段， 不会被覆盖
+        BulkDoc._get_collection().update_one({'_id': b.id}, {'$set': {'note': 'outside'}})
+        BulkDoc.bulk_save([a, b], self.executer)
+        self.assertEqual(BulkDoc.objects.get(id=a.id).note, 'changed')
+        self.assertEqual(BulkDoc.objects.get(id=b.id).note, 'outside')
+        self.assertEqual(BulkDoc.objects.get(id=a.id).updater_id, self.executer.id)
+        self.assertEqual(self.history_seqs(a), [1, 2])
+
+    def test_failed_middle_chunk(self):
+        BulkDoc(name='dup').my_save(self.executer)
+        docs = [BulkDoc(name='a'), BulkDoc(name='b'), BulkDoc(name='c'), BulkDoc(name='dup'), BulkDoc(name='e')]
+        with mock.patch.object(basedoc, 'invalidate_collection') as invalidate_collection, \
+                mock.patch.object(basedoc, 'invalidate_documents') as invalidate_documents:
+            with self.assertRaises(BulkWriteError):
+                BulkDoc.bulk_save(docs, self.executer, chunk_size=2)
+        invalidate_collection.assert_called_once_with('test_bulk_doc')
+        invalidate_documents.assert_called_once_with(docs)
+
+        a, b, c, dup, e = docs
+        self.assertEqual(sorted(doc.name for doc in BulkDoc.objects), ['a', 'b', 'c', 'dup'])
+        for doc in (a, b, c):
+            self.assertFalse(doc._created)
+            self.assertEqual(doc.history_seq, 1)
+            self.assertEqual(self.history_seqs(doc), [1])
+        # 写入失败的文档及未执行的批次回退版本号， 保留新建标记， 不写入历史记录
+        for doc in (dup, e):
+            self.assertTrue(doc._created)
+            self.assertEqual(doc.history_seq, 0)
+            self.assertEqual(self.history_seqs(doc), [])
+
+        dup.name = 'd'
+        BulkDoc.bulk_save([dup, e], self.executer)
+        self.assertEqual(BulkDoc.objects.count(), 6)
+        self.assertEqual(self.history_seqs(e), [1])
+
+
+class SingleWriteCreateTest(unittest.TestCase):
+    def setUp(self):
+        BulkDoc.drop_collection()
+        self.executer = ObjectDict(id=ObjectId())
+
+    def test_is_update(self):
+        doc = BulkDoc(name='a')
+        self.assertFalse(doc._is_update(self.executer))
+        self.assertIsInstance(doc.id, ObjectId)
+        self.assertTrue(doc._created)
+        self.assertEqual(doc.creater_id, self.executer.id)
+        self.assertEqual(BulkDoc.objects.count(), 0)
+
+        doc.my_save(self.executer)
+        self.assertTrue(doc._is_update(self.executer))
+        self.assertEqual(doc.updater_id, self.executer.id)
+
+    def test_create_is_one_insert(self):
+        collection = BulkDoc._get_collection()
+        # save 按写确认级别创建新的集合对象， 在类上统计写入
+        cls = type(collection)
+
+        def spy(name):
+            return mock.patch.object(cls, name, autospec=True, side_effect=getattr(cls, name))
+
+        with spy('insert_one') as insert_one, spy('update_one') as update_one, spy('replace_one') as replace_one:
+            doc = BulkDoc(name='a')
+            doc.my_save(self.executer)
+        self.assertEqual(insert_one.call_count, 1)
+        self.assertEqual(update_one.call_count, 0)
+        self.assertEqual(replace_one.call_count, 0)
+        self.assertFalse(doc._created)
+        son = collection.find_one({'_id': doc.id})
+        self.assertEqual(son['history_seq'], 1)
+        histories = History._get_db()[BulkDoc.get_collection_name('test_bulk_doc')]
+        self.assertEqual(histories.count_documents({'ref_id': str(doc.id), 'seq': 1}), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
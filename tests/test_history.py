@@ -0,0 +1,215 @@
+# -*- coding: utf-8 -*-
+"""
+历史记录： 快照+增量编码、 按版本号还原、 版本号缺失、 版本号冲突改为快照及旧格式(pickle)记录迁移
+"""
+
+import datetime
+import pickle
+import unittest
+from unittest import mock
+
+from bson import ObjectId
+from mongoengine import DictField, ListField, StringField
+
+import basedoc
+import settings
+from basedoc import History, HistoryBase, ModelBase, ObjectDict, rebase_history, replay_histories
+from commons import history_codec
+from commons.pagination import InvalidCursor
+
+
+class HistoryDoc(ModelBase, HistoryBase):
+    name = StringField(db_field='nm')
+    tags = ListField(StringField())
+    extra = DictField()
+
+    meta = {'collection': 'test_history_doc'}
+
+
+def _ensure_plain_seq_index(collection):
+    # mongomock 不支持部分索引， 没有版本号的旧格式记录会违反 (ref_id, seq) 唯一索引
+    collection.create_index([('ref_id', 1), ('seq', 1)])
+
+
+class HistoryCodecTest(unittest.TestCase):
+    def test_snapshot_round_trip(self):
+        state = {'_id': ObjectId(), 'nm': 'a', 'tags': ['x'], 'extra': {'k': 1}}
+        self.assertEqual(history_codec.decode_snapshot(history_codec.encode_snapshot(state)), state)
+
+    def test_delta_round_trip(self):
+        old = {'nm': 'a', 'tags': ['x', 'y'], 'extra': {'k': 1, 'j': 2}, 'gone': 1}
+        new = {'nm': 'b', 'tags': ['x', 'z'], 'extra': {'k': 1, 'j': 2}}
+        set_data, unset_data = history_codec.diff_states(old, new)
+        self.assertEqual(set_data, {'nm': 'b', 'tags': ['x', 'z']})
+        self.assertEqual(unset_data, ['gone'])
+        decoded = history_codec.decode_delta(history_codec.encode_delta(set_data, unset_data))
+        self.assertEqual(history_codec.apply_delta(dict(old), *decoded), new)
+
+    def test_apply_nested_paths(self):
+        state = {'tags': ['x'], 'extra': {'k': 1, 'j': 2}}
+        history_codec.apply_delta(state, {'tags.2': 'z', 'extra.k': 3, 'extra.sub.a': 1}, ['extra.j', 'tags.0'])
+        self.assertEqual(state, {'tags': [None, None, 'z'], 'extra': {'k': 3, 'sub': {'a': 1}}})
+
+
+class HistoryReplayTest(unittest.TestCase):
+    def setUp(self):
+        self.interval = mock.patch.object(settings, 'HISTORY_SNAPSHOT_INTERVAL', 3)
+        self.interval.start()
+        HistoryDoc.drop_collection()
+        self.cn = HistoryDoc.get_collection_name('test_history_doc')
+        self.histories = History._get_db()[self.cn]
+        self.histories.drop()
+        basedoc._history_indexed.discard(self.cn)
+        self.executer = ObjectDict(id=ObjectId())
+
+    def tearDown(self):
+        self.interval.stop()
+
+    def save_versions(self, count):
+        """
+        保存 count 个版本， 第 n 个版本 name 为 v<n>
+        :return: 文档及各版本的 (name, tags, extra)
+        """
+        doc = HistoryDoc(name='v1', tags=['t1'], extra={'k': 1})
+        doc.my_save(self.executer)
+        versions = {1: ('v1', ['t1'], {'k': 1})}
+        for n in range(2, count + 1):
+            doc = HistoryDoc.objects.get(id=doc.id)
+            doc.name = 'v%d' % n
+            doc.tags.append('t%d' % n)
+            doc.extra['k'] = n
+            if n == 4:
+                doc.extra['removed'] = True
+            if n == 5:
+                del doc.extra['removed']
+            doc.my_save(self.executer)
+            versions[n] = (doc.name, list(doc.tags), dict(doc.extra))
+        return doc, versions
+
+    def test_snapshot_and_deltas(self):
+        doc, versions = self.save_versions(7)
+        rows = {row['seq']: row['fmt'] for row in self.histories.find({'ref_id': str(doc.id)})}
+        snapshot, delta = history_codec.FORMAT_SNAPSHOT, history_codec.FORMAT_DELTA
+        self.assertEqual(rows, {1: snapshot, 2: delta, 3: delta, 4: snapshot, 5: delta, 6: delta, 7: snapshot})
+
+        info = doc.get_history_info(100)
+        self.assertEqual([h.seq for h, _ in info], [7, 6, 5, 4, 3, 2, 1])
+        for h, state in info:
+            self.assertEqual((state.name, state.tags, state.extra), versions[h.seq])
+
+    def test_reconstruct_single_version(self):
+        doc, versions = self.save_versions(6)
+        cname, ref_id = doc._get_cname_and_ref_id()
+        for seq in (3, 6):
+            histories = doc.get_histories(cname, ref_id=ref_id, seq=seq)
+            state, = doc.decode_histories(cname, ref_id, histories)
+            self.assertEqual((state.name, state.tags, state.extra), versions[seq])
+
+    def test_gap_in_chain(self):
+        doc, versions = self.save_versions(7)
+        self.histories.delete_one({'ref_id': str(doc.id), 'seq': 2})
+        states = {h.seq: state for h, state in doc.get_history_info(100)}
+        # 缺失版本之后的增量无法还原， 直到下一个快照
+        self.assertIsNone(states[3])
+        self.assertEqual(states[1].name, 'v1')
+        for seq in (4, 5, 6, 7):
+            self.assertEqual((states[seq].name, states[seq].tags, states[seq].extra), versions[seq])
+
+    def test_duplicated_seq_is_not_replayed(self):
+        doc, _ = self.save_versions(3)
+        chain = [History._from_son(row) for row in self.histories.find({'ref_id': str(doc.id)}, sort=[('seq', 1)])]
+        duplicated = History._from_son(dict(chain[1].to_mongo(), _id=ObjectId()))
+        states = replay_histories(chain[:2] + [duplicated] + chain[2:], {1, 2, 3})
+        self.assertEqual(set(states), {1})
+
+    def test_rebase_conflicting_delta(self):
+        doc, _ = self.save_versions(2)
+        stale = HistoryDoc.objects.get(id=doc.id)
+        stale.history_seq = 1
+        stale.extra['k'] = 'stale'
+        cname, ref_id, value, position, fmt, seq = stale._prepare_history(True)
+        self.assertEqual((fmt, seq), (history_codec.FORMAT_DELTA, 2))
+        son = stale._new_history(ref_id, value, position, self.executer, fmt, seq).to_mongo()
+
+        rebased = rebase_history(self.cn, son)
+        self.assertEqual(rebased['seq'], 3)
+        self.assertEqual(rebased['fmt'], history_codec.FORMAT_SNAPSHOT)
+        # 上一版本(1)应用冲突记录的增量
+        state = history_codec.decode_snapshot(rebased['value'])
+        self.assertEqual((state['nm'], state['extra']), ('v1', {'k': 'stale'}))
+
+
+class HistoryPageTest(unittest.TestCase):
+    def setUp(self):
+        HistoryDoc.drop_collection()
+        History._get_db()[HistoryDoc.get_collection_name('test_history_doc')].drop()
+        self.executer = ObjectDict(id=ObjectId())
+        self.doc = HistoryDoc(name='v1')
+        self.doc.my_save(self.executer)
+        for n in range(2, 6):
+            self.doc.name = 'v%d' % n
+            self.doc.my_save(self.executer)
+
+    def test_pages(self):
+        pages, cursor = [], None
+        while True:
+            page = self.doc.get_history_page(limit=2, cursor=cursor)
+            pages.append([h.seq for h in page])
+            cursor = page.next_cursor
+            if not cursor:
+                break
+        self.assertEqual(pages, [[5, 4], [3, 2], [1]])
+        self.assertEqual([doc.name for doc in page.documents], ['v1'])
+
+    def test_malformed_cursor(self):
+        oid = str(ObjectId())
+        for cursor in ('abc', '123', '12x_%s' % oid, '-1_%s' % oid, '123_bad', '%d_%s' % (10 ** 20, oid), 123):
+            with self.assertRaises(InvalidCursor):
+                self.doc.get_history_page(limit=2, cursor=cursor)
+
+
+class HistoryMigrationTest(unittest.TestCase):
+    def setUp(self):
+        HistoryDoc.drop_collection()
+        self.cn = HistoryDoc.get_collection_name('test_history_doc')
+        self.histories = History._get_db()[self.cn]
+        self.histories.drop()
+        basedoc._history_indexed.discard(self.cn)
+        self.seq_index = mock.patch.object(basedoc, '_ensure_seq_index', _ensure_plain_seq_index)
+        self.seq_index.start()
+        self.executer = ObjectDict(id=ObjectId())
+
+    def tearDown(self):
+        self.seq_index.stop()
+        basedoc._history_indexed.discard(self.cn)
+
+    def test_migrate_pickle_rows_then_new_version(self):
+        # 旧版本直接保存文档， 历史记录为 pickle 序列化的完整文档
+        doc = HistoryDoc(name='p0', tags=[])
+        doc.save()
+        start = datetime.datetime.now() - datetime.timedelta(minutes=10)
+        for i in range(5):
+            doc.name = 'p%d' % i
+            doc.tags = ['t%d' % j for j in range(i)]
+            self.histories.insert_one({'ref_id': str(doc.id), 'value': pickle.dumps(doc),
+                                       'time': start + datetime.timedelta(seconds=i), 'p_id': 1})
+
+        self.assertEqual(HistoryDoc.migrate_histories(), 5)
+        rows = list(self.histories.find({'ref_id': str(doc.id)}, sort=[('time', 1)]))
+        self.assertEqual([row['seq'] for row in rows], [-5, -4, -3, -2, -1])
+        self.assertEqual(rows[0]['fmt'], history_codec.FORMAT_SNAPSHOT)
+        self.assertEqual(rows[1]['fmt'], history_codec.FORMAT_DELTA)
+
+        doc = HistoryDoc.objects.get(id=doc.id)
+        doc.name = 'n1'
+        doc.my_save(self.executer)
+        self.assertEqual(doc.history_seq, 1)
+
+        info = doc.get_history_info(100)
+        self.assertEqual([h.seq for h, _ in info], [1, -1, -2, -3, -4, -5])
+        self.assertEqual([state.name for _, state in info], ['n1', 'p4', 'p3', 'p2', 'p1', 'p0'])
+        self.assertEqual(info[1][1].tags, ['t0', 't1', 't2', 't3'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+"""
+索引建议： 启动时创建声明的索引及 explain 使用的数据库连接
+"""
+
+import unittest
+from unittest import mock
+
+import mongomock
+from mongoengine import StringField
+
+import settings
+from basedoc import ModelBase
+from commons import index_advisor
+from commons.index_advisor import IndexAdvisorRecorder
+
+
+class AdvisedDoc(ModelBase):
+    name = StringField()
+
+    meta = {'collection': 'test_advised_doc', 'indexes': ['name']}
+
+
+class EnsureDeclaredIndexesTest(unittest.TestCase):
+    def setUp(self):
+        AdvisedDoc.drop_collection()
+
+    def test_background_without_meta_change(self):
+        collection = AdvisedDoc._get_collection()
+        with mock.patch.object(collection, 'create_index', wraps=collection.create_index) as create_index:
+            self.assertGreater(IndexAdvisorRecorder().ensure_declared_indexes(), 0)
+        (fields,), opts = create_index.call_args
+        self.assertEqual(fields, [('name', 1)])
+        self.assertTrue(opts['background'])
+        self.assertFalse(AdvisedDoc._meta['index_background'])
+
+        with mock.patch.object(collection, 'create_index', wraps=collection.create_index) as create_index:
+            AdvisedDoc.ensure_indexes()
+        self.assertFalse(create_index.call_args[1]['background'])
+
+
+class ExplainClientTest(unittest.TestCase):
+    def test_requires_uri(self):
+        advisor = IndexAdvisorRecorder()
+        with mock.patch.object(settings, 'INDEX_ADVISOR_URI', None), \
+                mock.patch('commons.mongo_util.MongoDBConf.client') as app_client:
+            with self.assertRaises(RuntimeError):
+                advisor.analyze(min_count=1)
+        app_client.assert_not_called()
+
+    def test_uri_client(self):
+        advisor = IndexAdvisorRecorder()
+        with mock.patch.object(settings, 'INDEX_ADVISOR_URI', 'mongodb://advisor:27017'), \
+                mock.patch.object(index_advisor.pymongo, 'MongoClient', mongomock.MongoClient) as client_cls:
+            self.assertEqual(advisor.analyze(min_count=1), [])
+            client = advisor.explain_client()
+            self.assertIsInstance(client, client_cls)
+            self.assertIs(advisor.explain_client(), client)
+        self.assertEqual(client.address, ('advisor', 27017))
+
+    def test_explicit_client(self):
+        advisor = IndexAdvisorRecorder()
+        advisor.record('db', 'find', {'find': 'test_advised_doc', 'filter': {'name': 'a'}})
+        client = mock.MagicMock()
+        client.__getitem__.return_value.command.return_value = {
+            'queryPlanner': {'winningPlan': {'stage': 'COLLSCAN'}}}
+        client.__getitem__.return_value.name = 'db'
+        with mock.patch.object(settings, 'INDEX_ADVISOR_URI', None):
+            suggestions = advisor.analyze(client, min_count=1)
+        self.assertEqual([item['index'] for item in suggestions], [{'fields': ['name']}])
+
+
+if __name__ == '__main__':
+    unittest.main()
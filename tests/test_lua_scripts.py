@@ -0,0 +1,286 @@
+# -*- coding: utf-8 -*-
+"""
+组合Lua脚本(GET_EXPIRE/GET_OR_LOADING/HINCR_CAP/SET_IF_VERSION_GREATER/SET_IF_GENERATION/POP_N)及 slot_key
+同步客户端与异步客户端分别直接执行及在管道中执行
+"""
+
+import asyncio
+import unittest
+import uuid
+
+import settings
+from caches.LuaManager import slot_key
+from caches.redis_utils import AIORedisDB, RedisDB
+
+
+def _new_client(cls):
+    # 客户端为单例， 测试使用独立实例
+    client = object.__new__(cls)
+    client.__init__()
+    return client
+
+
+class SlotKeyTest(unittest.TestCase):
+    def test_plain_name_is_wrapped(self):
+        self.assertEqual(slot_key('user:1', 'loading'), '{user:1}:loading')
+        self.assertEqual(slot_key(b'user:1', 'loading'), '{user:1}:loading')
+
+    def test_existing_hash_tag_is_kept(self):
+        self.assertEqual(slot_key('{user}:1', 'version'), '{user}:1:version')
+        self.assertEqual(slot_key('a{b}c', 'version'), 'a{b}c:version')
+
+    def test_empty_hash_tag_is_not_a_tag(self):
+        # {}{x} 的第一个 } 紧随 { ， 没有hash tag， 不能按 {x} 处理
+        self.assertEqual(slot_key('{}', 'loading'), '{{}}:loading')
+        self.assertEqual(slot_key('{}{x}', 'loading'), '{{}{x}}:loading')
+        self.assertEqual(slot_key('{user', 'loading'), '{{user}:loading')
+
+    def test_unwrappable_name_in_cluster(self):
+        cluster = settings.REDIS_CLUSTER
+        settings.REDIS_CLUSTER = True
+        try:
+            with self.assertRaises(ValueError):
+                slot_key('{}{x}', 'loading')
+            with self.assertRaises(ValueError):
+                slot_key('a}b', 'loading')
+            self.assertEqual(slot_key('{user', 'loading'), '{{user}:loading')
+        finally:
+            settings.REDIS_CLUSTER = cluster
+
+
+class SyncLuaScriptsTest(unittest.TestCase):
+    def setUp(self):
+        self.cache = _new_client(RedisDB)
+        self.prefix = 'test:lua:%s:' % uuid.uuid4().hex
+
+    def tearDown(self):
+        for name in self.cache.db.scan_iter('*%s*' % self.prefix):
+            self.cache.db.delete(name)
+
+    def key(self, name):
+        return self.prefix + name
+
+    def test_get_expire(self):
+        name = self.key('get_expire')
+        self.assertIsNone(self.cache.get_expire(name, 100))
+        self.cache.db.set(name, 'v', ex=10)
+        self.assertEqual(self.cache.get_expire(name, 100), b'v')
+        self.assertGreater(self.cache.db.ttl(name), 10)
+
+        pipe = self.cache.pipeline
+        self.cache.get_expire(name, 200, pipe=pipe)
+        self.cache.get_expire(self.key('missing'), 200, pipe=pipe)
+        self.assertEqual(pipe.execute(), [b'v', None])
+        self.assertGreater(self.cache.db.ttl(name), 100)
+
+    def test_get_or_mark_loading(self):
+        name = self.key('loading')
+        value, token = self.cache.get_or_mark_loading(name, 30)
+        self.assertIsNone(value)
+        self.assertTrue(token)
+        self.assertEqual(self.cache.get_or_mark_loading(name, 30), (None, None))
+        self.assertTrue(self.cache.set_loaded(name, 'v', token, timeout=60))
+        self.assertFalse(self.cache.db.exists(self.cache.loading_key(name)))
+        self.assertEqual(self.cache.get_or_mark_loading(name, 30), (b'v', None))
+
+        pipe = self.cache.pipeline
+        self.cache.get_or_mark_loading(name, 30, pipe=pipe)
+        token = self.cache.get_or_mark_loading(self.key('other'), 30, pipe=pipe)
+        self.assertEqual(pipe.execute(), [[2, b'v'], [0]])
+        self.assertEqual(self.cache.db.get(self.cache.loading_key(self.key('other'))), token.encode())
+
+    def test_set_loaded_keeps_lock_of_other_loader(self):
+        name = self.key('loading')
+        _, token = self.cache.get_or_mark_loading(name, 30)
+        # 加载超时， 锁已被其他调用方获取
+        self.cache.db.set(self.cache.loading_key(name), 'other')
+        self.assertFalse(self.cache.set_loaded(name, 'v', token, timeout=60))
+        self.assertEqual(self.cache.db.get(name), b'v')
+        self.assertEqual(self.cache.db.get(self.cache.loading_key(name)), b'other')
+
+    def test_hincr_capped(self):
+        name = self.key('hincr')
+        self.assertEqual(self.cache.hincr_capped(name, 'f', 1, cap=2, timeout=60), (True, 1))
+        self.assertEqual(self.cache.hincr_capped(name, 'f', 1, cap=2, timeout=60), (True, 2))
+        self.assertEqual(self.cache.hincr_capped(name, 'f', 1, cap=2, timeout=60), (False, 2))
+        self.assertGreater(self.cache.db.ttl(name), 0)
+
+        pipe = self.cache.pipeline
+        self.cache.hincr_capped(name, 'g', 2, cap=3, pipe=pipe)
+        self.cache.hincr_capped(name, 'g', 2, cap=3, pipe=pipe)
+        self.assertEqual(pipe.execute(), [[1, 2], [0, 2]])
+
+    def test_set_if_version_greater(self):
+        name = self.key('version')
+        self.assertTrue(self.cache.set_if_version_greater(name, 'v1', 1, timeout=60))
+        self.assertFalse(self.cache.set_if_version_greater(name, 'v0', 1, timeout=60))
+        self.assertTrue(self.cache.set_if_version_greater(name, 'v2', 2, timeout=None))
+        self.assertEqual(self.cache.db.get(name), b'v2')
+
+        pipe = self.cache.pipeline
+        self.cache.set_if_version_greater(name, 'v1', 1, pipe=pipe)
+        self.cache.set_if_version_greater(name, 'v3', 3, pipe=pipe)
+        self.assertEqual(pipe.execute(), [0, 1])
+        self.assertEqual(self.cache.db.get(name), b'v3')
+
+    def test_set_if_generation(self):
+        name = self.key('generation')
+        self.assertTrue(self.cache.set_if_generation(name, 'v1', None, timeout=60))
+        generation = self.cache.db.get(self.cache.generation_key(name))
+        self.cache.bump_generation(name, timeout=60)
+        self.assertIsNone(self.cache.db.get(name))
+        self.assertFalse(self.cache.set_if_generation(name, 'v0', generation, timeout=60))
+        self.assertIsNone(self.cache.db.get(name))
+
+        generation = self.cache.db.get(self.cache.generation_key(name))
+        pipe = self.cache.pipeline
+        self.cache.set_if_generation(name, 'v0', None, pipe=pipe)
+        self.cache.set_if_generation(name, 'v2', generation, pipe=pipe)
+        self.assertEqual(pipe.execute(), [0, 1])
+        self.assertEqual(self.cache.db.get(name), b'v2')
+
+    def test_pop_n(self):
+        name = self.key('list')
+        self.cache.db.rpush(name, 1, 2, 3, 4, 5)
+        self.assertEqual(self.cache.pop_n(name, 0), [])
+        self.assertEqual(self.cache.pop_n(name, 2), [b'1', b'2'])
+        self.assertEqual(self.cache.pop_n(name, 2, right=True), [b'5', b'4'])
+
+        pipe = self.cache.pipeline
+        self.cache.pop_n(name, 5, pipe=pipe)
+        self.cache.pop_n(name, 1, pipe=pipe)
+        self.assertEqual(pipe.execute(), [[b'3'], []])
+
+
+class AsyncLuaScriptsTest(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.cache = _new_client(AIORedisDB)
+        self.wait(self.cache.setup())
+        self.prefix = 'test:lua:%s:' % uuid.uuid4().hex
+
+    def tearDown(self):
+        self.wait(self._clean())
+        self.loop.close()
+        asyncio.set_event_loop(None)
+
+    async def _clean(self):
+        async for name in self.cache.iter_prefix_keys(self.prefix):
+            await self.cache.db.delete(name)
+        for name in (self.cache.loading_key(self.key('loading')), self.cache.loading_key(self.key('other')),
+                     slot_key(self.key('version'), 'version'), self.cache.generation_key(self.key('generation'))):
+            await self.cache.db.delete(name)
+
+    def wait(self, coro):
+        return self.loop.run_until_complete(coro)
+
+    def key(self, name):
+        return self.prefix + name
+
+    def test_get_expire(self):
+        async def main():
+            name = self.key('get_expire')
+            self.assertIsNone(await self.cache.get_expire(name, 100))
+            await self.cache.db.set(name, 'v', ex=10)
+            self.assertEqual(await self.cache.get_expire(name, 100), b'v')
+            self.assertGreater(await self.cache.db.ttl(name), 10)
+
+            pipe = self.cache.pipeline
+            await self.cache.get_expire(name, 200, pipe=pipe)
+            await self.cache.get_expire(self.key('missing'), 200, pipe=pipe)
+            self.assertEqual(await pipe.execute(), [b'v', None])
+        self.wait(main())
+
+    def test_get_or_mark_loading(self):
+        async def main():
+            name = self.key('loading')
+            value, token = await self.cache.get_or_mark_loading(name, 30)
+            self.assertIsNone(value)
+            self.assertTrue(token)
+            self.assertEqual(await self.cache.get_or_mark_loading(name, 30), (None, None))
+            self.assertTrue(await self.cache.set_loaded(name, 'v', token, timeout=60))
+            self.assertFalse(await self.cache.db.exists(self.cache.loading_key(name)))
+            self.assertEqual(await self.cache.get_or_mark_loading(name, 30), (b'v', None))
+
+            pipe = self.cache.pipeline
+            await self.cache.get_or_mark_loading(name, 30, pipe=pipe)
+            token = await self.cache.get_or_mark_loading(self.key('other'), 30, pipe=pipe)
+            self.assertEqual(await pipe.execute(), [[2, b'v'], [0]])
+            self.assertEqual(await self.cache.db.get(self.cache.loading_key(self.key('other'))), token.encode())
+        self.wait(main())
+
+    def test_set_loaded_keeps_lock_of_other_loader(self):
+        async def main():
+            name = self.key('loading')
+            _, token = await self.cache.get_or_mark_loading(name, 30)
+            await self.cache.db.set(self.cache.loading_key(name), 'other')
+            self.assertFalse(await self.cache.set_loaded(name, 'v', token, timeout=60))
+            self.assertEqual(await self.cache.db.get(name), b'v')
+            self.assertEqual(await self.cache.db.get(self.cache.loading_key(name)), b'other')
+        self.wait(main())
+
+    def test_hincr_capped(self):
+        async def main():
+            name = self.key('hincr')
+            self.assertEqual(await self.cache.hincr_capped(name, 'f', 1, cap=2, timeout=60), (True, 1))
+            self.assertEqual(await self.cache.hincr_capped(name, 'f', 1, cap=2, timeout=60), (True, 2))
+            self.assertEqual(await self.cache.hincr_capped(name, 'f', 1, cap=2, timeout=60), (False, 2))
+            self.assertGreater(await self.cache.db.ttl(name), 0)
+
+            pipe = self.cache.pipeline
+            await self.cache.hincr_capped(name, 'g', 2, cap=3, pipe=pipe)
+            await self.cache.hincr_capped(name, 'g', 2, cap=3, pipe=pipe)
+            self.assertEqual(await pipe.execute(), [[1, 2], [0, 2]])
+        self.wait(main())
+
+    def test_set_if_version_greater(self):
+        async def main():
+            name = self.key('version')
+            self.assertTrue(await self.cache.set_if_version_greater(name, 'v1', 1, timeout=60))
+            self.assertFalse(await self.cache.set_if_version_greater(name, 'v0', 1, timeout=60))
+            self.assertTrue(await self.cache.set_if_version_greater(name, 'v2', 2, timeout=None))
+            self.assertEqual(await self.cache.db.get(name), b'v2')
+
+            pipe = self.cache.pipeline
+            await self.cache.set_if_version_greater(name, 'v1', 1, pipe=pipe)
+            await self.cache.set_if_version_greater(name, 'v3', 3, pipe=pipe)
+            self.assertEqual(await pipe.execute(), [0, 1])
+            self.assertEqual(await self.cache.db.get(name), b'v3')
+        self.wait(main())
+
+    def test_set_if_generation(self):
+        async def main():
+            name = self.key('generation')
+            self.assertTrue(await self.cache.set_if_generation(name, 'v1', None, timeout=60))
+            generation = await self.cache.db.get(self.cache.generation_key(name))
+            await self.cache.bump_generation(name, timeout=60)
+            self.assertIsNone(await self.cache.db.get(name))
+            self.assertFalse(await self.cache.set_if_generation(name, 'v0', generation, timeout=60))
+            self.assertIsNone(await self.cache.db.get(name))
+
+            generation = await self.cache.db.get(self.cache.generation_key(name))
+            pipe = self.cache.pipeline
+            await self.cache.set_if_generation(name, 'v0', None, pipe=pipe)
+            await self.cache.set_if_generation(name, 'v2', generation, pipe=pipe)
+            self.assertEqual(await pipe.execute(), [0, 1])
+            self.assertEqual(await self.cache.db.get(name), b'v2')
+        self.wait(main())
+
+    def test_pop_n(self):
+        async def main():
+            name = self.key('list')
+            await self.cache.db.rpush(name, 1, 2, 3, 4, 5)
+            self.assertEqual(await self.cache.pop_n(name, 0), [])
+            self.assertEqual(await self.cache.pop_n(name, 2), [b'1', b'2'])
+            self.assertEqual(await self.cache.pop_n(name, 2, right=True), [b'5', b'4'])
+
+            pipe = self.cache.pipeline
+            await self.cache.pop_n(name, 5, pipe=pipe)
+            await self.cache.pop_n(name, 1, pipe=pipe)
+            self.assertEqual(await pipe.execute(), [[b'3'], []])
+        self.wait(main())
+
+
+if __name__ == '__main__':
+    unittest.main()
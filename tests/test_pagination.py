@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+"""
+键集分页： 排序字段值相同时的前后翻页、 游标签名及取值校验、 总数估算
+"""
+
+import datetime
+import unittest
+from unittest import mock
+
+from bson import ObjectId
+from mongoengine import IntField, StringField
+
+import settings
+from basedoc import ModelBase, ObjectDict
+from commons import pagination
+from commons.pagination import InvalidCursor
+
+
+class PageDoc(ModelBase):
+    name = StringField()
+    grp = IntField(db_field='g')
+
+    meta = {'collection': 'test_page_doc'}
+
+
+class PaginationTest(unittest.TestCase):
+    def setUp(self):
+        self.secret = mock.patch.object(settings, 'PAGINATION_SECRET', 'test-pagination-secret')
+        self.secret.start()
+        PageDoc.drop_collection()
+        executer = ObjectDict(id=ObjectId())
+        start = datetime.datetime(2026, 1, 1)
+        for i in range(13):
+            doc = PageDoc(name='n%02d' % i, grp=i % 3)
+            doc.my_save(executer)
+            # 每两个文档的创建时间相同， 由 _id 区分先后
+            PageDoc.objects(id=doc.id).update(set__created_time=start + datetime.timedelta(seconds=i // 2))
+        PageDoc.objects(name='n05').first().my_delete(executer)
+        self.names = ['n%02d' % i for i in range(13) if i != 5]
+
+    def tearDown(self):
+        self.secret.stop()
+
+    def walk(self, queryset=None, sort=None, limit=5):
+        """
+        从第一页向后翻到最后一页
+        :return: (每页的 name 列表, 最后一页)
+        """
+        pages, cursor = [], None
+        while True:
+            page = PageDoc.paginate(queryset, limit=limit, cursor=cursor, sort=sort)
+            pages.append([doc.name for doc in page])
+            cursor = page.next_cursor
+            if not cursor:
+                return pages, page
+
+    def test_forward_across_ties(self):
+        pages, _ = self.walk()
+        self.assertEqual(sum(pages, []), self.names)
+        self.assertEqual([len(names) for names in pages], [5, 5, 2])
+        self.assertIsNone(PageDoc.paginate(limit=5).prev_cursor)
+
+    def test_backward_across_ties(self):
+        _, page = self.walk(limit=3)
+        pages = [[doc.name for doc in page]]
+        while page.prev_cursor:
+            page = PageDoc.paginate(limit=3, cursor=page.prev_cursor)
+            pages.insert(0, [doc.name for doc in page])
+        self.assertEqual(sum(pages, []), self.names)
+        # 回到第一页后仍可向后翻页
+        self.assertEqual([doc.name for doc in PageDoc.paginate(limit=3, cursor=page.next_cursor)], self.names[3:6])
+
+    def test_descending_compound_sort(self):
+        pages, _ = self.walk(sort=['-grp', '-created_time'], limit=4)
+        expected = sorted(PageDoc.objects, key=lambda doc: (doc.grp, doc.created_time, doc.id), reverse=True)
+        self.assertEqual(sum(pages, []), [doc.name for doc in expected])
+
+    def test_tampered_cursor(self):
+        cursor = PageDoc.paginate(limit=5).next_cursor
+        data, signature = cursor.rsplit('.', 1)
+        with self.assertRaises(InvalidCursor):
+            PageDoc.paginate(limit=5, cursor='%s.%s' % (data[:-1] + ('A' if data[-1] != 'A' else 'B'), signature))
+        with self.assertRaises(InvalidCursor):
+            PageDoc.paginate(limit=5, cursor=cursor[:-1] + ('0' if cursor[-1] != '0' else '1'))
+        with self.assertRaises(InvalidCursor):
+            PageDoc.paginate(limit=5, cursor='not-a-cursor')
+        # 游标与排序绑定
+        with self.assertRaises(InvalidCursor):
+            PageDoc.paginate(limit=5, cursor=cursor, sort='-created_time')
+
+    def test_non_scalar_cursor_value(self):
+        sort = pagination._normalize_sort(PageDoc, None)
+        for values in ([{'$ne': None}, ObjectId()], [['a'], ObjectId()], [datetime.datetime.now()]):
+            cursor = pagination.encode_cursor(PageDoc, sort, values, False)
+            with self.assertRaises(InvalidCursor):
+                PageDoc.paginate(limit=5, cursor=cursor)
+
+    def test_secret_required(self):
+        for secret in (None, 'dj-pagination-secret'):
+            with mock.patch.object(settings, 'PAGINATION_SECRET', secret), self.assertRaises(RuntimeError):
+                PageDoc.paginate(limit=5)
+
+    def test_total_excludes_deleted(self):
+        page = PageDoc.paginate(limit=5, with_total=True)
+        self.assertEqual((page.total, page.total_is_estimate), (12, False))
+        page = PageDoc.paginate(PageDoc.objects(grp=1), limit=5, with_total=True)
+        self.assertEqual((page.total, page.total_is_estimate), (4, False))
+        # 无查询条件时读取集合元数据， 包含已删除文档
+        page = PageDoc.paginate(PageDoc.objects.with_deleted(), limit=5, with_total=True)
+        self.assertEqual((page.total, page.total_is_estimate), (13, True))
+        self.assertEqual(pagination.approximate_total(PageDoc.objects, limit=10), (10, True))
+
+
+if __name__ == '__main__':
+    unittest.main()
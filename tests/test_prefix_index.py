@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+"""
+前缀索引： 写入命令与 SADD/SREM 在同一管道中提交
+"""
+
+import asyncio
+import unittest
+import uuid
+
+from caches.prefix_index import PrefixIndexes
+from caches.redis_utils import AIORedisDB, RedisDB
+
+
+def _new_client(cls):
+    client = object.__new__(cls)
+    client.__init__()
+    return client
+
+
+class SyncPrefixIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.cache = _new_client(RedisDB)
+        self.prefix = 'test:prefix:%s:' % uuid.uuid4().hex
+        self.index_key = PrefixIndexes.index_key(self.prefix)
+        PrefixIndexes.register(self.prefix)
+
+    def tearDown(self):
+        PrefixIndexes.unregister(self.prefix)
+        for name in self.cache.db.scan_iter('*%s*' % self.prefix):
+            self.cache.db.delete(name)
+
+    def members(self):
+        return {name.decode('utf-8') for name in self.cache.db.smembers(self.index_key)}
+
+    def test_writes_are_indexed(self):
+        self.assertEqual(self.cache.incr(self.prefix + 'counter', 2), 2)
+        self.cache.hset(self.prefix + 'hash', 'f', 'v')
+        self.cache.rpush(self.prefix + 'list', 1, 2)
+        self.assertEqual(self.cache.setbits(self.prefix + 'bits', [1, 3]), [0, 0])
+        self.cache.incr('test:other:%s' % uuid.uuid4().hex)
+        self.assertEqual(self.members(), {self.prefix + name for name in ('counter', 'hash', 'list', 'bits')})
+        self.assertEqual(self.cache.count_keys(self.prefix), 4)
+
+    def test_negative_expire_unindexes(self):
+        name = self.prefix + 'counter'
+        self.cache.incr(name)
+        self.cache.set_expire(name, -1)
+        self.assertFalse(self.cache.db.exists(name))
+        self.assertEqual(self.members(), set())
+
+
+class AsyncPrefixIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.cache = _new_client(AIORedisDB)
+        self.wait(self.cache.setup())
+        self.prefix = 'test:prefix:%s:' % uuid.uuid4().hex
+        self.index_key = PrefixIndexes.index_key(self.prefix)
+        PrefixIndexes.register(self.prefix)
+
+    def tearDown(self):
+        self.wait(self._clean())
+        PrefixIndexes.unregister(self.prefix)
+        self.loop.close()
+        asyncio.set_event_loop(None)
+
+    async def _clean(self):
+        async for name in self.cache.iter_prefix_keys(self.prefix):
+            await self.cache.db.delete(name)
+        await self.cache.db.delete(self.index_key)
+
+    def wait(self, coro):
+        return self.loop.run_until_complete(coro)
+
+    async def members(self):
+        return {name.decode('utf-8') for name in await self.cache.db.smembers(self.index_key)}
+
+    def test_writes_are_indexed(self):
+        async def main():
+            self.assertEqual(await self.cache.incr(self.prefix + 'counter', 2), 2)
+            await self.cache.hset(self.prefix + 'hash', 'f', 'v')
+            await self.cache.rpush(self.prefix + 'list', 1, 2)
+            self.assertEqual(await self.cache.setbits(self.prefix + 'bits', [1, 3]), [0, 0])
+            self.assertEqual(await self.members(),
+                             {self.prefix + name for name in ('counter', 'hash', 'list', 'bits')})
+            self.assertEqual(await self.cache.count_keys(self.prefix), 4)
+        self.wait(main())
+
+    def test_negative_expire_unindexes(self):
+        async def main():
+            name = self.prefix + 'counter'
+            await self.cache.incr(name)
+            await self.cache.set_expire(name, -1)
+            self.assertFalse(await self.cache.db.exists(name))
+            self.assertEqual(await self.members(), set())
+        self.wait(main())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+"""
+查询结果缓存： 缓存命中、 my_save/my_delete/查询集写入后失效及缓存键
+"""
+
+import unittest
+from unittest import mock
+
+from bson import ObjectId
+from mongoengine import IntField, StringField
+
+from basedoc import ModelBase, ObjectDict
+from caches.query_cache import invalidate_collection
+from commons.mongo_util import MongoDBConf
+
+
+class CachedDoc(ModelBase):
+    name = StringField(db_field='nm')
+    n = IntField()
+
+    meta = {'collection': 'test_cached_doc', 'distributed_cache': True}
+
+
+class QueryCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.enable = mock.patch.object(MongoDBConf, '_distributed_cached_enable', True)
+        self.enable.start()
+        CachedDoc.drop_collection()
+        invalidate_collection('test_cached_doc')
+        self.executer = ObjectDict(id=ObjectId())
+        for i in range(5):
+            CachedDoc(name='a%d' % i, n=i).my_save(self.executer)
+        self.collection = CachedDoc._get_collection()
+
+    def tearDown(self):
+        self.enable.stop()
+
+    def spy_find(self):
+        # 查询集按写确认级别等创建新的集合对象， 在类上统计查询
+        cls = type(self.collection)
+        return mock.patch.object(cls, 'find', autospec=True, side_effect=cls.find)
+
+    def update_outside(self, n, name):
+        # 绕过 my_save 直接修改数据库， 缓存不会失效
+        self.collection.update_one({'n': n}, {'$set': {'nm': name}})
+
+    def test_hit(self):
+        with self.spy_find() as find:
+            first = [doc.name for doc in CachedDoc.objects(n__gte=2).order_by('-n')]
+            second = [doc.name for doc in CachedDoc.objects(n__gte=2).order_by('-n')]
+            self.assertEqual(CachedDoc.objects(n=3).first().name, 'a3')
+            self.assertEqual(CachedDoc.objects(n=3).first().name, 'a3')
+            self.assertEqual(CachedDoc.objects.get(n=4).name, 'a4')
+            self.assertEqual(CachedDoc.objects.get(n=4).name, 'a4')
+        self.assertEqual(first, ['a4', 'a3', 'a2'])
+        self.assertEqual(second, first)
+        self.assertEqual(find.call_count, 3)
+
+        self.update_outside(3, 'outside')
+        self.assertEqual(CachedDoc.objects(n=3).first().name, 'a3')
+        self.assertEqual([doc.name for doc in CachedDoc.objects(n__gte=2).order_by('-n')], first)
+        self.assertEqual([son['nm'] for son in CachedDoc.objects(n__gte=2).order_by('-n').as_pymongo()], first)
+        # scalar 只读取指定字段， 投影不同， 不命中整个文档的缓存
+        self.assertEqual(list(CachedDoc.objects(n__gte=2).order_by('-n').scalar('name')), ['a4', 'outside', 'a2'])
+
+    def test_count_hit(self):
+        self.assertEqual(CachedDoc.objects(n__gte=2).count(), 3)
+        self.collection.delete_one({'n': 2})
+        self.assertEqual(CachedDoc.objects(n__gte=2).count(), 3)
+        invalidate_collection('test_cached_doc')
+        self.assertEqual(CachedDoc.objects(n__gte=2).count(), 2)
+
+    def test_invalidate_on_my_save(self):
+        self.assertEqual(CachedDoc.objects(n=3).first().name, 'a3')
+        doc = CachedDoc.objects(n=3).first()
+        doc.name = 'changed'
+        doc.my_save(self.executer)
+        self.assertEqual(CachedDoc.objects(n=3).first().name, 'changed')
+        CachedDoc(name='a5', n=5).my_save(self.executer)
+        self.assertEqual(CachedDoc.objects(n__gte=3).count(), 3)
+
+    def test_invalidate_on_my_delete(self):
+        self.assertEqual(CachedDoc.objects.count(), 5)
+        CachedDoc.objects(n=0).first().my_delete(self.executer)
+        self.assertEqual(CachedDoc.objects.count(), 4)
+        self.assertIsNone(CachedDoc.objects(n=0).first())
+
+    def test_invalidate_on_queryset_update(self):
+        self.assertEqual(CachedDoc.objects(n=4).first().name, 'a4')
+        CachedDoc.objects(n=4).update(set__name='updated')
+        self.assertEqual(CachedDoc.objects(n=4).first().name, 'updated')
+        CachedDoc.objects(n=4).delete()
+        self.assertIsNone(CachedDoc.objects(n=4).first())
+
+    def test_distinct_keys(self):
+        queryset = CachedDoc.objects(n__gte=1)
+        variants = [queryset, queryset.only('name'), queryset.exclude('name'), queryset.order_by('-n'),
+                    queryset.order_by('n'), queryset[1:3], queryset.skip(1), queryset.limit(2),
+                    CachedDoc.objects(n__gte=2), queryset.with_deleted()]
+        keys = [variant._cache_key() for variant in variants]
+        self.assertEqual(len(set(keys)), len(keys))
+        self.assertEqual(queryset.clone()._cache_key(), queryset._cache_key())
+        self.assertEqual(CachedDoc.objects(n__gte=1)._cache_key(), queryset._cache_key())
+
+    def test_variants_cached_separately(self):
+        self.assertEqual([doc.n for doc in CachedDoc.objects.only('name').order_by('n')], [None] * 5)
+        self.assertEqual([doc.n for doc in CachedDoc.objects.order_by('n')], [0, 1, 2, 3, 4])
+        self.assertEqual([doc.n for doc in CachedDoc.objects.order_by('-n')], [4, 3, 2, 1, 0])
+        self.assertEqual([doc.n for doc in CachedDoc.objects.order_by('n')[1:3]], [1, 2])
+        self.assertEqual([doc.n for doc in CachedDoc.objects.order_by('n')[3:]], [3, 4])
+        self.assertEqual(CachedDoc.objects.order_by('-n')[1].n, 3)
+        with self.assertRaises(IndexError):
+            CachedDoc.objects.order_by('n')[5]
+
+    def test_disabled(self):
+        with mock.patch.object(MongoDBConf, '_distributed_cached_enable', False):
+            self.assertEqual(CachedDoc.objects(n=3).first().name, 'a3')
+            self.update_outside(3, 'outside')
+            self.assertEqual(CachedDoc.objects(n=3).first().name, 'outside')
+
+
+if __name__ == '__main__':
+    unittest.main()
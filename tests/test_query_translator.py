@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+"""
+查询字段映射： 操作符、 逻辑操作符嵌套、 嵌入文档路径、 排序及投影映射和缓存
+"""
+
+import unittest
+from unittest import mock
+
+from mongoengine import DictField, EmbeddedDocument, EmbeddedDocumentField, EmbeddedDocumentListField, ListField, \
+    MapField, StringField
+
+from basedoc import ModelBase
+from commons.query_translator import FieldTranslator, get_translator
+
+
+class Addr(EmbeddedDocument):
+    city = StringField(db_field='c')
+
+
+class Item(EmbeddedDocument):
+    sku = StringField(db_field='s')
+    addr = EmbeddedDocumentField(Addr, db_field='ad')
+
+
+class Order(ModelBase):
+    name = StringField(db_field='nm')
+    items = EmbeddedDocumentListField(Item, db_field='its')
+    tags = ListField(StringField(), db_field='tg')
+    by_key = MapField(EmbeddedDocumentField(Item), db_field='bk')
+    raw = DictField(db_field='rw')
+
+    meta = {'collection': 'test_query_translator_order'}
+
+
+class FieldPathTest(unittest.TestCase):
+    def test_db_path(self):
+        self.assertEqual(Order.get_db_field('name'), 'nm')
+        self.assertEqual(Order.get_db_field('id'), '_id')
+        self.assertEqual(Order.get_db_field('pk'), '_id')
+        self.assertEqual(Order.get_db_field('items.sku'), 'its.s')
+        self.assertEqual(Order.get_db_field('items.0.addr.city'), 'its.0.ad.c')
+        self.assertEqual(Order.get_db_field('items.$.sku'), 'its.$.s')
+        self.assertEqual(Order.get_db_field('items.$[].addr.city'), 'its.$[].ad.c')
+        # MapField 的键保持不变
+        self.assertEqual(Order.get_db_field('by_key.k1.addr.city'), 'bk.k1.ad.c')
+        self.assertEqual(Order.get_db_field('raw.name.x'), 'rw.name.x')
+        self.assertEqual(Order.get_db_field('unknown.name'), 'unknown.name')
+        self.assertEqual(Order.get_db_field(1), 1)
+
+
+class FilterTest(unittest.TestCase):
+    def test_operators(self):
+        filtered = {'name': {'$in': ['a', 'b']}, 'created_time': {'$gte': 1, '$lt': 2}, 'tags': {'$all': ['x']}}
+        self.assertEqual(Order.map_db_filter(filtered),
+                         {'nm': {'$in': ['a', 'b']}, 'created_time': {'$gte': 1, '$lt': 2}, 'tg': {'$all': ['x']}})
+
+    def test_logical_tree(self):
+        filtered = {'$and': [{'name': 'a'},
+                             {'$or': [{'items.sku': {'$in': ['s']}}, {'$nor': [{'by_key.k.addr.city': 'c'}]}]}],
+                    '$comment': 'keep'}
+        self.assertEqual(Order.map_db_filter(filtered),
+                         {'$and': [{'nm': 'a'}, {'$or': [{'its.s': {'$in': ['s']}}, {'$nor': [{'bk.k.ad.c': 'c'}]}]}],
+                          '$comment': 'keep'})
+
+    def test_elem_match(self):
+        filtered = {'items': {'$elemMatch': {'sku': 's', 'addr.city': 'c'}, '$size': 2}}
+        self.assertEqual(Order.map_db_filter(filtered),
+                         {'its': {'$elemMatch': {'s': 's', 'ad.c': 'c'}, '$size': 2}})
+
+    def test_input_not_mutated(self):
+        filtered = {'name': 'a', '$or': [{'items.sku': 's'}]}
+        Order.map_db_filter(filtered)
+        self.assertEqual(filtered, {'name': 'a', '$or': [{'items.sku': 's'}]})
+        self.assertIsNone(Order.map_db_filter(None))
+        self.assertEqual(Order.map_db_filter({}), {})
+
+    def test_plan_per_shape(self):
+        translator = FieldTranslator(Order)
+        with mock.patch.object(translator, '_compile', wraps=translator._compile) as compile_plan:
+            self.assertEqual(translator.filter({'name': 'a', 'tags': 't'}), {'nm': 'a', 'tg': 't'})
+            self.assertEqual(translator.filter({'name': 'b', 'tags': 'u'}), {'nm': 'b', 'tg': 'u'})
+            self.assertEqual(compile_plan.call_count, 1)
+            # 键不同或顺序不同的查询条件使用各自的计划
+            self.assertEqual(translator.filter({'tags': 't', 'name': 'a'}), {'tg': 't', 'nm': 'a'})
+            self.assertEqual(list(translator.filter({'tags': 't', 'name': 'a'})), ['tg', 'nm'])
+            self.assertEqual(translator.filter({'name': 'a', 'items.sku': 's'}), {'nm': 'a', 'its.s': 's'})
+            self.assertEqual(translator.filter({'name': 'a'}), {'nm': 'a'})
+            self.assertEqual(compile_plan.call_count, 4)
+        self.assertEqual(set(translator._plans),
+                         {('name', 'tags'), ('tags', 'name'), ('name', 'items.sku'), ('name',)})
+
+    def test_cache_size(self):
+        translator = FieldTranslator(Order, cache_size=2)
+        for shape in ({'name': 1}, {'tags': 1}, {'raw': 1}):
+            translator.filter(shape)
+        self.assertEqual(list(translator._plans), [('raw',)])
+        self.assertEqual(translator.filter({'name': 1, 'tags': 2}), {'nm': 1, 'tg': 2})
+
+
+class SortProjectionTest(unittest.TestCase):
+    def test_sort(self):
+        self.assertEqual(Order.map_db_sort('-name'), [('nm', -1)])
+        self.assertEqual(Order.map_db_sort(('name', 1)), [('nm', 1)])
+        self.assertEqual(Order.map_db_sort(['-name', 'items.sku']), [('nm', -1), ('its.s', 1)])
+        self.assertEqual(Order.map_db_sort([('items.addr.city', -1)]), [('its.ad.c', -1)])
+        self.assertEqual(Order.map_db_sort({'name': -1, 'tags': 1}), [('nm', -1), ('tg', 1)])
+        self.assertIsNone(Order.map_db_sort(None))
+
+    def test_sort_memoized(self):
+        translator = FieldTranslator(Order)
+        first = translator.sort(['-name', 'tags'])
+        first.append(('x', 1))
+        # 返回缓存结果的副本
+        self.assertEqual(translator.sort(['-name', 'tags']), [('nm', -1), ('tg', 1)])
+        self.assertEqual(list(translator._sorts), [('-name', 'tags')])
+
+    def test_projection(self):
+        self.assertEqual(Order.map_db_projection(['name', 'items.sku']), {'nm': 1, 'its.s': 1})
+        self.assertEqual(Order.map_db_projection({'name': 0, 'items': {'$slice': 1}}), {'nm': 0, 'its': {'$slice': 1}})
+        self.assertIsNone(Order.map_db_projection([]))
+
+        translator = FieldTranslator(Order)
+        translator.projection(['name']).update(tags=1)
+        self.assertEqual(translator.projection(['name']), {'nm': 1})
+        self.assertEqual(list(translator._projections), [('name',)])
+
+
+class DocumentApiTest(unittest.TestCase):
+    def test_map_filter_2_field_in_place(self):
+        filtered = {'name': 'a', 'items.sku': {'$in': ['s']}}
+        result = Order().map_filter_2_field(filtered)
+        self.assertIs(result, filtered)
+        self.assertEqual(filtered, {'nm': 'a', 'its.s': {'$in': ['s']}})
+        self.assertEqual(Order().map_filter_2_field(['name']), ['name'])
+
+    def test_classmethods(self):
+        self.assertEqual(Order.get_db_field('items.sku'), Order().get_db_field('items.sku'))
+        self.assertIs(Order.get_translator(), get_translator(Order))
+        self.assertIs(get_translator(Item), get_translator(Item))
+
+
+if __name__ == '__main__':
+    unittest.main()
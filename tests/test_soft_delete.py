@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+"""
+软删除： SoftDeleteQuerySet 默认排除已删除文档、 声明索引的 partialFilterExpression 及按ID读取
+"""
+
+import unittest
+from unittest import mock
+
+from bson import ObjectId
+from mongoengine import StringField
+
+from basedoc import ModelBase, ObjectDict
+
+
+class SoftDoc(ModelBase):
+    name = StringField()
+    code = StringField()
+    serial = StringField()
+
+    meta = {'collection': 'test_soft_doc',
+            'indexes': ['name', {'fields': ['code'], 'unique': True},
+                        {'fields': ['serial'], 'sparse': True},
+                        {'fields': ['created_time'], 'partialFilterExpression': {'code': {'$exists': True}}}]}
+
+
+class HardDoc(ModelBase):
+    name = StringField()
+
+    meta = {'collection': 'test_hard_doc', 'indexes': ['name'], 'soft_delete': False}
+
+
+class SoftDeleteQuerySetTest(unittest.TestCase):
+    def setUp(self):
+        SoftDoc.drop_collection()
+        HardDoc.drop_collection()
+        self.executer = ObjectDict(id=ObjectId())
+        self.a = SoftDoc(name='a', code='1')
+        self.a.my_save(self.executer)
+        self.b = SoftDoc(name='b', code='2')
+        self.b.my_save(self.executer)
+        self.b.my_delete(self.executer)
+
+    def test_excludes_deleted_by_default(self):
+        self.assertEqual([doc.name for doc in SoftDoc.objects], ['a'])
+        self.assertEqual(SoftDoc.objects.count(), 1)
+        self.assertEqual(SoftDoc.objects.filter(name='b').count(), 0)
+        self.assertEqual(SoftDoc.objects.filter(name='a')._query, {'name': 'a', 'is_delete': False})
+
+    def test_with_deleted(self):
+        self.assertEqual(sorted(doc.name for doc in SoftDoc.objects.with_deleted()), ['a', 'b'])
+        queryset = SoftDoc.objects.with_deleted().filter(name='b').order_by('name')
+        self.assertEqual(queryset._query, {'name': 'b'})
+        self.assertEqual(queryset.count(), 1)
+        # 过滤后的查询集仍包含已删除文档
+        self.assertEqual(queryset.clone().count(), 1)
+
+    def test_explicit_is_delete(self):
+        self.assertEqual([doc.name for doc in SoftDoc.objects(is_delete=True)], ['b'])
+
+    def test_soft_delete_disabled(self):
+        doc = HardDoc(name='x')
+        doc.my_save(self.executer)
+        doc.my_delete(self.executer)
+        self.assertEqual(HardDoc.objects.count(), 1)
+        self.assertEqual(HardDoc.get_by_id(doc.id).name, 'x')
+
+    def test_get_by_id(self):
+        self.assertEqual(SoftDoc.get_by_id(self.a.id).name, 'a')
+        self.assertIsNone(SoftDoc.get_by_id(self.b.id))
+        self.assertEqual(SoftDoc.get_by_id(self.b.id, with_deleted=True).name, 'b')
+        docs = SoftDoc.get_many_by_ids([self.b.id, self.a.id, ObjectId()])
+        self.assertEqual([doc and doc.name for doc in docs], [None, 'a', None])
+        docs = SoftDoc.get_many_by_ids([self.b.id, self.a.id], with_deleted=True)
+        self.assertEqual([doc.name for doc in docs], ['b', 'a'])
+
+
+class SoftDeleteIndexTest(unittest.TestCase):
+    def setUp(self):
+        SoftDoc.drop_collection()
+        HardDoc.drop_collection()
+
+    def created_indexes(self, document_cls):
+        """
+        :return: {字段: create_index 的选项}， mongomock 的 index_information 不返回 partialFilterExpression
+        """
+        collection = document_cls._get_collection()
+        with mock.patch.object(collection, 'create_index', wraps=collection.create_index) as create_index:
+            document_cls.ensure_indexes()
+        return {args[0][0][0]: kwargs for args, kwargs in create_index.call_args_list}
+
+    def test_partial_filter_for_non_unique(self):
+        indexes = self.created_indexes(SoftDoc)
+        self.assertEqual(indexes['name']['partialFilterExpression'], {'is_delete': False})
+        # 唯一索引及稀疏索引包含全部文档
+        self.assertNotIn('partialFilterExpression', indexes['code'])
+        self.assertTrue(indexes['code']['unique'])
+        self.assertNotIn('partialFilterExpression', indexes['serial'])
+        # 已指定 partialFilterExpression 时不覆盖
+        self.assertEqual(indexes['created_time']['partialFilterExpression'], {'code': {'$exists': True}})
+
+    def test_soft_delete_disabled(self):
+        indexes = self.created_indexes(HardDoc)
+        self.assertNotIn('partialFilterExpression', indexes['name'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+"""
+标签失效： 单节点使用 INVALIDATE_TAGS_LUA， 集群模式分两次管道完成
+"""
+
+import asyncio
+import unittest
+import uuid
+
+import settings
+from caches.redis_utils import AIORedisDB, RedisDB
+
+
+def _new_client(cls):
+    client = object.__new__(cls)
+    client.__init__()
+    return client
+
+
+class SyncTagsTest(unittest.TestCase):
+    def setUp(self):
+        self.cache = _new_client(RedisDB)
+        self.prefix = 'test:tags:%s:' % uuid.uuid4().hex
+
+    def tearDown(self):
+        self.cache._cluster = settings.REDIS_CLUSTER
+
+    def check_invalidate(self):
+        a, b, c = self.prefix + 'a', self.prefix + 'b', self.prefix + 'c'
+        self.cache.set(a, 1, timeout=60, tags=[self.prefix + 't1'])
+        self.cache.set(b, 1, timeout=60, tags=[self.prefix + 't1', self.prefix + 't2'])
+        self.cache.set(c, 1, timeout=60, tags=[self.prefix + 't3'])
+        self.assertEqual(self.cache.invalidate_tags(self.prefix + 't1', self.prefix + 't2'), 2)
+        self.assertFalse(self.cache.db.exists(a))
+        self.assertFalse(self.cache.db.exists(b))
+        self.assertTrue(self.cache.db.exists(c))
+        self.assertFalse(self.cache.db.exists(self.cache.tag_key(self.prefix + 't1')))
+        self.assertEqual(self.cache.invalidate_tags(), 0)
+
+    def test_invalidate_tags(self):
+        self.check_invalidate()
+
+    def test_invalidate_tags_in_cluster(self):
+        self.cache._cluster = True
+        self.check_invalidate()
+
+
+class AsyncTagsTest(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.cache = _new_client(AIORedisDB)
+        self.loop.run_until_complete(self.cache.setup())
+        self.prefix = 'test:tags:%s:' % uuid.uuid4().hex
+        self.cluster = settings.REDIS_CLUSTER
+
+    def tearDown(self):
+        settings.REDIS_CLUSTER = self.cluster
+        self.loop.close()
+        asyncio.set_event_loop(None)
+
+    async def check_invalidate(self):
+        a, b, c = self.prefix + 'a', self.prefix + 'b', self.prefix + 'c'
+        await self.cache.set(a, 1, timeout=60, tags=[self.prefix + 't1'])
+        await self.cache.set(b, 1, timeout=60, tags=[self.prefix + 't1', self.prefix + 't2'])
+        await self.cache.set(c, 1, timeout=60, tags=[self.prefix + 't3'])
+        self.assertEqual(await self.cache.invalidate_tags(self.prefix + 't1', self.prefix + 't2'), 2)
+        self.assertFalse(await self.cache.db.exists(a))
+        self.assertFalse(await self.cache.db.exists(b))
+        self.assertTrue(await self.cache.db.exists(c))
+        self.assertFalse(await self.cache.db.exists(self.cache.tag_key(self.prefix + 't1')))
+
+    def test_invalidate_tags(self):
+        self.loop.run_until_complete(self.check_invalidate())
+
+    def test_invalidate_tags_in_cluster(self):
+        settings.REDIS_CLUSTER = True
+        self.loop.run_until_complete(self.check_invalidate())
+
+
+if __name__ == '__main__':
+    unittest.main()